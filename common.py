@@ -0,0 +1,57 @@
+'''
+Helpers shared by main.py and the modules that it imports (compare.py,
+github.py, history.py).
+
+These are in their own module so that those modules do not need to import
+main.py, which would load main.py a second time, as module `main`, when it is
+run as a script.
+'''
+
+import os
+import sys
+import threading
+
+
+# Held while writing to stdout in log(). We also hold it while forking, so
+# that no other thread can be part way through log() in the child, and give
+# the child a new lock because the inherited one is locked.
+_log_lock = threading.Lock()
+
+def _log_lock_after_fork_in_child():
+    global _log_lock
+    _log_lock = threading.Lock()
+
+os.register_at_fork(
+        before=lambda: _log_lock.acquire(),
+        after_in_parent=lambda: _log_lock.release(),
+        after_in_child=_log_lock_after_fork_in_child,
+        )
+
+
+def log(text):
+    with _log_lock:
+        print(f'{os.getpid()=}: {text}')
+        sys.stdout.flush()
+
+
+def params_text(params, sep=' '):
+    '''
+    Returns text representation of params dict, e.g. 'alpha=1 dpi=300'.
+    '''
+    return sep.join(f'{name}={value}' for name, value in sorted((params or dict()).items()))
+
+
+def result_key(result):
+    '''
+    Returns a tuple identifying the test that generated `result`, an item in
+    main.py's `results['data']`. Can be used to match results from different
+    runs.
+    '''
+    return (
+            result['testname'],
+            result['path'],
+            result['toolname'],
+            result.get('start', 'cold'),
+            result.get('io', 'disk'),
+            params_text(result.get('params')),
+            )
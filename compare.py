@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+'''
+Compares two performance results files and reports regressions and
+improvements.
+
+Usage:
+
+    compare.py [<args>] <old.json> <new.json>
+
+Args:
+
+    --alpha <alpha>
+        Significance level for the Mann-Whitney U test. Default is 0.05.
+
+    --fail 0|1
+        If 1, we exit with non-zero code if there are any significant
+        regressions.
+
+    --out <path>
+        Write comparison as JSON to <path>.
+
+    --threshold <fraction>
+        Minimum relative change in median time for a difference to be
+        reported as a regression or improvement. Default is 0.05.
+
+Results are matched using common.result_key(), i.e. by (testname, path,
+toolname, start, io, params).
+
+A difference is significant if the relative change in median time is more than
+`threshold` and, if both results have enough samples (see main.py's --repeat),
+the Mann-Whitney U test gives p < `alpha`. With few samples the test cannot
+give p < `alpha` however large the difference is, e.g. with 3 samples each the
+smallest possible p is 0.1; in this case, or if either result has only one
+sample, we instead require the relative change to be more than twice
+`threshold`, and the report warns that no significance test was possible.
+
+We also summarise changes for each category of input file (see
+corpus.describe()), to show which kinds of document a change has sped up or
+slowed down.
+
+paired() compares interleaved samples from main.py's --ab mode, where each
+sample of one tool has a matching sample of the other taken at nearly the same
+time.
+'''
+
+import json
+import math
+import sys
+
+import common
+import stats
+
+
+def compare(old, new, threshold=0.05, alpha=0.05):
+    '''
+    Compares results dicts `old` and `new`.
+
+    Returns a dict with:
+        'items':
+            List of dicts, one for each result in `old` or `new`, sorted with
+            worst regressions first and best improvements last. Each dict has
+            the identifying items of the result (`testname`, `path`, etc),
+            plus:
+                't_old', 't_new': Median times or None.
+                'change': Relative change in time, e.g. 0.1 is 10% slower.
+                'p':
+                    p-value from Mann-Whitney U test, or None if there were
+                    too few samples for the test to give p < `alpha`.
+                'verdict':
+                    One of 'regression', 'improvement', 'unchanged', 'new',
+                    'missing', 'error'.
+                'category': Category of input file, or None.
+                'diverged':
+                    True if `new` has output fingerprints that diverged; see
+                    main.py's --validate.
+        'categories':
+            List of dicts, one for each (category, testname, toolname), with
+            `category`, `testname`, `toolname`, `n` (number of items with a
+            change) and `change` (geometric mean of relative change in time).
+        'regressions': Number of significant regressions.
+        'improvements': Number of significant improvements.
+        'untested':
+            Number of items with a change whose results had too few samples
+            for a significance test.
+        'toolversions':
+            Dict mapping toolname to dict with `old` and `new` versions,
+            for tools whose version has changed. For PyMuPDF variants this
+            contains `pymupdf_git_sha` and `mupdf_git_sha` ranges, so that a
+            regression can be traced to a range of commits.
+        'dates':
+            Dict with `old` and `new` date strings.
+    '''
+    old_results = {common.result_key(r): r for r in old['data']}
+    new_results = {common.result_key(r): r for r in new['data']}
+    items = list()
+    for key in sorted(set(old_results) | set(new_results), key=str):
+        r_old = old_results.get(key)
+        r_new = new_results.get(key)
+        r = r_new or r_old
+        item = dict(
+                testname=r['testname'],
+                path=r['path'],
+                toolname=r['toolname'],
+                params=r.get('params') or dict(),
+                start=r.get('start', 'cold'),
+                io=r.get('io', 'disk'),
+                t_old=None,
+                t_new=None,
+                change=None,
+                p=None,
+                category=r.get('category'),
+                diverged=bool(r_new and r_new.get('diverged')),
+                )
+        items.append(item)
+        if not r_old:
+            item['verdict'] = 'new'
+            continue
+        if not r_new:
+            item['verdict'] = 'missing'
+            continue
+        item['t_old'] = r_old['t']
+        item['t_new'] = r_new['t']
+        if r_old['e'] or r_new['e'] or not r_old['t'] or r_new['t'] is None:
+            item['verdict'] = 'error'
+            item['e_old'] = r_old['e']
+            item['e_new'] = r_new['e']
+            continue
+        change = r_new['t'] / r_old['t'] - 1
+        item['change'] = change
+        samples_old = r_old.get('samples') or [r_old['t']]
+        samples_new = r_new.get('samples') or [r_new['t']]
+        if mann_whitney_u_p_min(len(samples_old), len(samples_new)) < alpha:
+            p = mann_whitney_u(samples_old, samples_new)
+            item['p'] = p
+            significant = p < alpha and abs(change) > threshold
+        else:
+            significant = abs(change) > 2 * threshold
+        if not significant:
+            item['verdict'] = 'unchanged'
+        elif change > 0:
+            item['verdict'] = 'regression'
+        else:
+            item['verdict'] = 'improvement'
+
+    def sort_key(item):
+        # Worst regressions first, then anything without a change, then
+        # improvements.
+        change = item['change']
+        if item['verdict'] in ('regression', 'improvement'):
+            return (0, -change)
+        return (1, -(change or 0))
+    items.sort(key=sort_key)
+
+    categories = dict()
+    for item in items:
+        if item['category'] and item['change'] is not None and not item['params']:
+            key = item['category'], item['testname'], item['toolname']
+            categories.setdefault(key, list()).append(math.log(1 + item['change']))
+    categories = [
+            dict(
+                category=category,
+                testname=testname,
+                toolname=toolname,
+                n=len(logs),
+                change=math.exp(sum(logs) / len(logs)) - 1,
+                )
+            for (category, testname, toolname), logs in sorted(categories.items())
+            ]
+
+    toolversions = dict()
+    old_versions = old.get('toolversions', dict())
+    new_versions = new.get('toolversions', dict())
+    for toolname in sorted(set(old_versions) | set(new_versions)):
+        v_old = old_versions.get(toolname)
+        v_new = new_versions.get(toolname)
+        if v_old == v_new:
+            continue
+        toolversions[toolname] = dict(old=v_old, new=v_new)
+        if isinstance(v_old, dict) and isinstance(v_new, dict):
+            for name in 'pymupdf_git_sha', 'mupdf_git_sha':
+                if v_old.get(name) != v_new.get(name):
+                    toolversions[toolname][name] = f'{v_old.get(name)}..{v_new.get(name)}'
+
+    return dict(
+            items=items,
+            categories=categories,
+            regressions=sum(1 for item in items if item['verdict'] == 'regression'),
+            improvements=sum(1 for item in items if item['verdict'] == 'improvement'),
+            untested=sum(1 for item in items if item['change'] is not None and item['p'] is None),
+            toolversions=toolversions,
+            dates=dict(
+                    old=old.get('date', dict()).get('string'),
+                    new=new.get('date', dict()).get('string'),
+                    ),
+            )
+
+
+# Largest total number of samples for which mann_whitney_u() calculates the
+# exact p-value.
+_mann_whitney_u_exact_max = 50
+
+
+def mann_whitney_u_p_min(n1, n2):
+    '''
+    Returns smallest two-sided p-value that the Mann-Whitney U test can give
+    for samples of sizes `n1` and `n2`, i.e. if all of one sample is less than
+    all of the other. Ties can only make this larger.
+    '''
+    if n1 < 1 or n2 < 1:
+        return 1.0
+    return min(1.0, 2 / math.comb(n1 + n2, n1))
+
+
+def mann_whitney_u(a, b):
+    '''
+    Returns two-sided p-value of Mann-Whitney U test for lists of floats `a`
+    and `b`. For up to `_mann_whitney_u_exact_max` samples in total we use
+    the exact distribution of the rank sum given the ranks (including any
+    ties), otherwise the normal approximation with tie correction, which is
+    inaccurate for small samples.
+    '''
+    n1 = len(a)
+    n2 = len(b)
+    values = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    # Assign ranks, using average rank for ties.
+    ranks = [0] * len(values)
+    tie_sum = 0
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        for k in range(i, j + 1):
+            ranks[k] = rank
+        t = j - i + 1
+        tie_sum += t ** 3 - t
+        i = j + 1
+    r1 = sum(rank for rank, (v, group) in zip(ranks, values) if group == 0)
+    n = n1 + n2
+    if n <= _mann_whitney_u_exact_max:
+        return _rank_sum_p_exact(ranks, n1, r1)
+    u1 = r1 - n1 * (n1 + 1) / 2
+    mu = n1 * n2 / 2
+    sigma2 = n1 * n2 / 12 * ((n + 1) - tie_sum / (n * (n - 1)))
+    if sigma2 <= 0:
+        return 1.0
+    # Continuity correction.
+    z = (abs(u1 - mu) - 0.5) / math.sqrt(sigma2)
+    z = max(z, 0)
+    return math.erfc(z / math.sqrt(2))
+
+
+def _rank_sum_p_exact(ranks, n1, r1):
+    '''
+    Returns two-sided p-value of rank sum `r1` of `n1` of `ranks`, i.e. the
+    proportion of the `n1`-sized subsets of `ranks` whose sum is at least as
+    far from the mean as `r1`.
+    '''
+    # Ranks are multiples of 0.5, so we work with twice the ranks, which are
+    # integers. counts[k][s] is the number of k-sized subsets of the ranks
+    # seen so far whose doubled sum is s.
+    ranks2 = [round(2 * rank) for rank in ranks]
+    counts = [dict() for k in range(n1 + 1)]
+    counts[0][0] = 1
+    for rank2 in ranks2:
+        for k in range(n1, 0, -1):
+            for s, c in counts[k - 1].items():
+                counts[k][s + rank2] = counts[k].get(s + rank2, 0) + c
+    mean2 = n1 * (len(ranks) + 1)
+    d = abs(round(2 * r1) - mean2)
+    extreme = sum(c for s, c in counts[n1].items() if abs(s - mean2) >= d)
+    return min(1.0, extreme / math.comb(len(ranks), n1))
+
+
+def paired(a, b, threshold=0.05):
+    '''
+    Returns dict describing paired comparison of lists of floats `a` and `b`,
+    where `a[i]` and `b[i]` were measured in the same round of an interleaved
+    A/B run (see main.py's --ab), so that drift of the machine's speed during
+    the run affects both equally:
+
+        'n': Number of pairs.
+        'change':
+            Geometric mean of `b[i] / a[i]`, minus 1; e.g. 0.1 is `b` 10%
+            slower than `a`. None if fewer than two pairs.
+        'ci95':
+            [low, high], 95% confidence interval of `change`, from Student's
+            t distribution of `log(b[i] / a[i])`. None if fewer than two
+            pairs.
+        'verdict':
+            'slower' or 'faster' if `ci95` excludes zero, otherwise 'no
+            significant difference'.
+        'equivalent':
+            True if `ci95` is within +/- `threshold`, i.e. any difference is
+            too small to matter.
+    '''
+    d = [math.log(y / x) for x, y in zip(a, b) if x and y and x > 0 and y > 0]
+    n = len(d)
+    if n < 2:
+        return dict(n=n, change=None, ci95=None, verdict='no significant difference', equivalent=False)
+    mean = sum(d) / n
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in d) / (n - 1))
+    h = stats.t95_critical(n - 1) * stddev / math.sqrt(n)
+    low = math.exp(mean - h) - 1
+    high = math.exp(mean + h) - 1
+    if low > 0:
+        verdict = 'slower'
+    elif high < 0:
+        verdict = 'faster'
+    else:
+        verdict = 'no significant difference'
+    return dict(
+            n=n,
+            change=math.exp(mean) - 1,
+            ci95=[low, high],
+            verdict=verdict,
+            equivalent=-threshold <= low and high <= threshold,
+            )
+
+
+def ab_report(ab):
+    '''
+    Returns text report for list of A/B comparisons, as in main.py's
+    `results['ab']`.
+    '''
+    lines = list()
+    lines.append(f'A/B comparisons:')
+    for item in ab:
+        text = f'    {item["testname"]} {item["path"]}'
+        if item.get('params'):
+            text += f' {common.params_text(item["params"])}'
+        if item['start'] != 'cold':
+            text += f' start={item["start"]}'
+        if item['io'] != 'disk':
+            text += f' io={item["io"]}'
+        lines.append(f'{text} ({item["rounds"]} rounds):')
+        for pair in item['pairs']:
+            text = f'        {pair["b"]} vs {pair["a"]}: '
+            if pair['change'] is None:
+                text += f'not enough data (n={pair["n"]})'
+            else:
+                low, high = pair['ci95']
+                text += f'{pair["change"]*100:+.1f}% (95% CI {low*100:+.1f}%..{high*100:+.1f}%, n={pair["n"]}): {pair["verdict"]}'
+                if pair['equivalent']:
+                    text += ', equivalent'
+            lines.append(text)
+    return '\n'.join(lines)
+
+
+def report(comparison):
+    '''
+    Returns text report for dict returned by compare().
+    '''
+    lines = list()
+    dates = comparison['dates']
+    lines.append(f'Comparison of {dates["old"]} with {dates["new"]}:')
+    lines.append(f'    regressions:  {comparison["regressions"]}')
+    lines.append(f'    improvements: {comparison["improvements"]}')
+    if comparison.get('untested'):
+        lines.append(f'    *** Warning: {comparison["untested"]} results had too few samples for a significance test,'
+                f' so only changes of more than twice the threshold are reported; use more --repeat.'
+                )
+    for toolname, versions in comparison['toolversions'].items():
+        for name in 'pymupdf_git_sha', 'mupdf_git_sha':
+            if name in versions:
+                lines.append(f'    {toolname}: {name}: {versions[name]}')
+    for c in comparison.get('categories', list()):
+        lines.append(f'    category {c["category"]:12} {c["testname"]} {c["toolname"]}: {c["change"]*100:+.1f}% (n={c["n"]})')
+    for item in comparison['items']:
+        if item['verdict'] in ('unchanged',):
+            continue
+        text = f'    {item["verdict"]:12} {item["testname"]} {item["toolname"]} {item["path"]}'
+        if item.get('params'):
+            text += f' {common.params_text(item["params"])}'
+        if item['start'] != 'cold':
+            text += f' start={item["start"]}'
+        if item['io'] != 'disk':
+            text += f' io={item["io"]}'
+        if item['change'] is not None:
+            text += f': {item["t_old"]:.3f}s -> {item["t_new"]:.3f}s ({item["change"]*100:+.1f}%)'
+        if item['p'] is not None:
+            text += f' p={item["p"]:.3g}'
+        if item['diverged']:
+            text += ' OUTPUT DIVERGED'
+        lines.append(text)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    alpha = 0.05
+    fail = False
+    out = None
+    threshold = 0.05
+    paths = list()
+    args = iter(sys.argv[1:])
+    while 1:
+        try:
+            arg = next(args)
+        except StopIteration:
+            break
+        if arg == '-h' or arg == '--help':
+            common.log(__doc__)
+            sys.exit()
+        elif arg == '--alpha':
+            alpha = float(next(args))
+        elif arg == '--fail':
+            fail = int(next(args))
+        elif arg == '--out':
+            out = next(args)
+        elif arg == '--threshold':
+            threshold = float(next(args))
+        else:
+            paths.append(arg)
+    assert len(paths) == 2, f'Expected two results files: {paths=}'
+    with open(paths[0]) as f:
+        old = json.load(f)
+    with open(paths[1]) as f:
+        new = json.load(f)
+    comparison = compare(old, new, threshold, alpha)
+    common.log(report(comparison))
+    if out:
+        with open(out, 'w') as f:
+            json.dump(comparison, f, indent='    ', sort_keys=1)
+        common.log(f'Have written comparison to: {out}')
+    if fail and comparison['regressions']:
+        sys.exit(1)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+'''
+Generates synthetic PDF files with controlled properties, for measuring how
+performance scales with document size and content.
+
+Usage:
+
+    corpus.py <path> [<name>=<value> ...]
+
+        Generates PDF file <path> with parameters <name>=<value>; see
+        `params_default` for names and default values.
+
+    corpus.py --describe <path> ...
+
+        Shows manifest entries for PDF files; see describe().
+
+Files are generated by PyMuPDF, and are deterministic for a given set of
+parameters, including `seed`.
+
+We also maintain a manifest of input files, recording page count, size,
+content counts and a category for each file. This is cached in a JSON file,
+keyed by each file's SHA-256 checksum, so it only needs to be recomputed when
+a file changes.
+'''
+
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+
+
+# Default values of parameters for generate().
+#
+params_default = dict(
+        seed=0,         # Seed for random number generator.
+        pages=10,       # Number of pages.
+        text=40,        # Lines of text per page.
+        fonts=1,        # Number of different fonts.
+        cjk=0,          # If non-zero, one in every <cjk> lines is CJK text.
+        images=0,       # Number of images per page.
+        image_res=100,  # Width and height of each image in pixels.
+        paths=0,        # Number of vector path segments per page.
+        objects=0,      # Number of extra objects added to the xref table.
+        )
+
+# Base-14 fonts, and CJK fonts built in to MuPDF.
+#
+_fonts = ['helv', 'tiro', 'cour', 'hebo', 'tibo', 'cobo', 'heit', 'tiit', 'coit', 'hebi', 'tibi', 'cobi']
+_fonts_cjk = ['china-s', 'china-t', 'japan', 'korea']
+
+_words = (
+        'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod'
+        ' tempor incididunt ut labore et dolore magna aliqua ut enim ad minim'
+        ' veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea'
+        ' commodo consequat'
+        ).split()
+
+_words_cjk = ['中文', '测试', '文档', '页面', '字体', '渲染', '提取', '性能', '日本語', '한국어']
+
+
+def name(params):
+    '''
+    Returns a filename leaf for PDF generated with `params`, which only
+    contains non-default parameters.
+    '''
+    params = {k: v for k, v in params.items() if params_default[k] != v}
+    text = '-'.join(f'{k}-{v}' for k, v in sorted(params.items())) or 'default'
+    h = hashlib.md5(json.dumps(params, sort_keys=1).encode('utf8')).hexdigest()[:8]
+    return f'synthetic-{text}-{h}.pdf'
+
+
+def generate(path, **params):
+    '''
+    Generates PDF file `path` with `params`, which override items in
+    `params_default`.
+    '''
+    import pymupdf
+    for k in params:
+        assert k in params_default, f'Unrecognised param {k!r}, should be one of: {list(params_default)}'
+    p = dict(params_default)
+    p.update(params)
+    rng = random.Random(p['seed'])
+    doc = pymupdf.open()
+    fonts = [_fonts[i % len(_fonts)] for i in range(max(p['fonts'], 1))]
+    for pno in range(p['pages']):
+        page = doc.new_page()
+        width = page.rect.width
+        height = page.rect.height
+        margin = 36
+
+        # Text.
+        line_height = (height - 2 * margin) / max(p['text'], 1)
+        fontsize = min(line_height * 0.8, 11)
+        for i in range(p['text']):
+            y = margin + (i + 1) * line_height
+            if p['cjk'] and i % p['cjk'] == 0:
+                fontname = _fonts_cjk[i // p['cjk'] % len(_fonts_cjk)]
+                words = [rng.choice(_words_cjk) for _ in range(8)]
+                text = ''.join(words)
+            else:
+                fontname = rng.choice(fonts)
+                words = [rng.choice(_words) for _ in range(12)]
+                text = ' '.join(words)
+            page.insert_text((margin, y), text, fontname=fontname, fontsize=fontsize)
+
+        # Images.
+        for i in range(p['images']):
+            w = h = p['image_res']
+            samples = bytes(rng.getrandbits(8) for _ in range(w * h * 3))
+            pix = pymupdf.Pixmap(pymupdf.csRGB, w, h, samples, False)
+            x = rng.uniform(margin, width - margin - 100)
+            y = rng.uniform(margin, height - margin - 100)
+            page.insert_image(pymupdf.Rect(x, y, x + 100, y + 100), pixmap=pix)
+
+        # Vector paths.
+        if p['paths']:
+            shape = page.new_shape()
+            point = pymupdf.Point(width / 2, height / 2)
+            for i in range(p['paths']):
+                p2 = pymupdf.Point(rng.uniform(0, width), rng.uniform(0, height))
+                if i % 2:
+                    p3 = pymupdf.Point(rng.uniform(0, width), rng.uniform(0, height))
+                    p4 = pymupdf.Point(rng.uniform(0, width), rng.uniform(0, height))
+                    shape.draw_bezier(point, p3, p4, p2)
+                else:
+                    shape.draw_line(point, p2)
+                point = p2
+            shape.finish(color=(0, 0, 0), width=0.3)
+            shape.commit()
+
+    # Extra objects.
+    for i in range(p['objects']):
+        xref = doc.get_new_xref()
+        doc.update_object(xref, f'<< /Synthetic {i} /Value {rng.getrandbits(32)} >>')
+
+    doc.set_metadata(dict(title=name(params), producer='PyMuPDF-performance corpus.py'))
+    doc.save(path, deflate=True)
+
+
+def describe(path):
+    '''
+    Returns manifest entry for PDF file `path`, a dict containing:
+
+        'pages': Number of pages.
+        'size': File size in bytes.
+        'images': Number of image references on all pages.
+        'fonts': Number of distinct fonts.
+        'objects': Number of objects in the xref table.
+        'chars': Number of text characters.
+        'drawings': Number of vector drawings.
+        'category':
+            One of 'scanned', 'cjk', 'vector-heavy', 'text-heavy' or
+            'mixed'; see _category().
+    '''
+    import pymupdf
+    doc = pymupdf.open(path)
+    fonts = set()
+    images = 0
+    image_pages = 0
+    chars = 0
+    chars_cjk = 0
+    drawings = 0
+    for page in doc:
+        page_images = page.get_images(full=True)
+        images += len(page_images)
+        for font in page.get_fonts(full=True):
+            fonts.add(font[0])
+        text = page.get_text()
+        chars += len(text)
+        chars_cjk += sum(1 for c in text if _is_cjk(c))
+        drawings += len(page.get_cdrawings())
+        if page_images and len(text.strip()) < 200:
+            image_pages += 1
+    ret = dict(
+            pages=len(doc),
+            size=os.path.getsize(path),
+            images=images,
+            fonts=len(fonts),
+            objects=doc.xref_length(),
+            chars=chars,
+            drawings=drawings,
+            )
+    ret['category'] = _category(ret, image_pages, chars_cjk)
+    return ret
+
+
+def _is_cjk(c):
+    o = ord(c)
+    return (
+            0x3040 <= o <= 0x30ff       # Hiragana, Katakana.
+            or 0x3400 <= o <= 0x4dbf    # CJK Extension A.
+            or 0x4e00 <= o <= 0x9fff    # CJK Unified Ideographs.
+            or 0xac00 <= o <= 0xd7af    # Hangul.
+            )
+
+
+def _category(entry, image_pages, chars_cjk):
+    '''
+    Returns category of document with manifest `entry`.
+
+        scanned: Most pages are images with little text.
+        cjk: More than 10% of text is CJK.
+        vector-heavy: Many vector drawings per page.
+        text-heavy: Lots of text per page.
+        mixed: Anything else.
+    '''
+    pages = max(entry['pages'], 1)
+    if image_pages > pages / 2:
+        return 'scanned'
+    if chars_cjk > entry['chars'] / 10:
+        return 'cjk'
+    if entry['drawings'] / pages > 500:
+        return 'vector-heavy'
+    if entry['chars'] / pages > 1000:
+        return 'text-heavy'
+    return 'mixed'
+
+
+def checksum(path):
+    '''
+    Returns SHA-256 checksum of file `path`.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while 1:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def manifest(paths, cache_path, describe_fn=None):
+    '''
+    Returns dict mapping from each path in `paths` to its manifest entry.
+
+    Entries are cached in JSON file `cache_path`, keyed by checksum. Missing
+    entries are computed with `describe_fn(path)` (default describe()), and
+    `cache_path` is updated.
+    '''
+    if describe_fn is None:
+        describe_fn = describe
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except Exception:
+        cache = dict()
+    ret = dict()
+    changed = False
+    for path in paths:
+        key = checksum(path)
+        if key not in cache:
+            entry = describe_fn(path)
+            if not entry:
+                continue
+            cache[key] = entry
+            changed = True
+        ret[path] = cache[key]
+    if changed:
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent='    ', sort_keys=1)
+    return ret
+
+
+def fit_power_law(xs, ts):
+    '''
+    Fits `t = a * x**b` to lists of floats `xs` and `ts` using least squares on
+    log(x) and log(t).
+
+    Returns `(a, b, r2)` where `r2` is the coefficient of determination of the
+    fit in log space, or None if there are fewer than two usable points.
+    '''
+    points = [(math.log(x), math.log(t)) for x, t in zip(xs, ts) if x and x > 0 and t and t > 0]
+    if len(set(lx for lx, lt in points)) < 2:
+        return None
+    n = len(points)
+    mx = sum(lx for lx, lt in points) / n
+    mt = sum(lt for lx, lt in points) / n
+    sxx = sum((lx - mx) ** 2 for lx, lt in points)
+    sxt = sum((lx - mx) * (lt - mt) for lx, lt in points)
+    b = sxt / sxx
+    a = mt - b * mx
+    ss_tot = sum((lt - mt) ** 2 for lx, lt in points)
+    ss_res = sum((lt - (a + b * lx)) ** 2 for lx, lt in points)
+    r2 = 1 - ss_res / ss_tot if ss_tot else 1
+    return math.exp(a), b, r2
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--describe':
+        for path in sys.argv[2:]:
+            print(f'{path}: {json.dumps(describe(path), sort_keys=1)}')
+        sys.exit()
+    path = sys.argv[1]
+    params = dict()
+    for arg in sys.argv[2:]:
+        k, v = arg.split('=')
+        params[k] = int(v)
+    generate(path, **params)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+'''
+Generates SVG flamegraphs from folded stack files, as written by `py-spy
+record --format raw`.
+
+Usage:
+
+    flamegraph.py <folded> <svg> [<title>]
+
+Each line of a folded stack file is a list of frames separated by `;`,
+outermost first, followed by a space and a sample count. The width of each
+box in the flamegraph is proportional to the number of samples that include
+the frame's stack. Frames from native code (e.g. MuPDF) and from Python are
+drawn in different colours.
+'''
+
+import hashlib
+import html
+import sys
+
+
+def parse(text):
+    '''
+    Returns tree of dicts `{'n': <count>, 'children': {<frame>: <tree>}}`
+    from folded stack text.
+    '''
+    root = dict(n=0, children=dict())
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        stack, _, count = line.rpartition(' ')
+        try:
+            count = int(count)
+        except ValueError:
+            continue
+        node = root
+        node['n'] += count
+        for frame in stack.split(';'):
+            node = node['children'].setdefault(frame, dict(n=0, children=dict()))
+            node['n'] += count
+    return root
+
+
+def _colour(frame):
+    # Python frames from py-spy look like `function (path/file.py:123)`;
+    # native frames do not have a `.py` file.
+    h = int(hashlib.md5(frame.encode('utf8')).hexdigest()[:4], 16) / 0xffff
+    if '.py:' in frame or '.py)' in frame:
+        return f'rgb({int(80 + 60 * h)},{int(140 + 60 * h)},{int(200 + 40 * h)})'
+    return f'rgb({int(205 + 50 * h)},{int(80 + 100 * h)},{int(40 * h)})'
+
+
+def svg(text, title='', width=1200, frame_height=16, min_width=0.1):
+    '''
+    Returns SVG text for flamegraph of folded stack text `text`. Boxes
+    narrower than `min_width` pixels are omitted.
+    '''
+    root = parse(text)
+    total = root['n'] or 1
+    scale = (width - 20) / total
+    boxes = list()
+
+    def walk(node, x, depth):
+        for frame, child in sorted(node['children'].items()):
+            w = child['n'] * scale
+            if w >= min_width:
+                boxes.append((x, depth, w, frame, child['n']))
+                walk(child, x, depth + 1)
+            x += w
+    walk(root, 10, 0)
+
+    depth_max = max((depth for x, depth, w, frame, n in boxes), default=0)
+    height = (depth_max + 1) * frame_height + 50
+    lines = list()
+    lines.append(f'<?xml version="1.0" standalone="no"?>')
+    lines.append(f'<svg version="1.1" width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="12">')
+    lines.append(f'<rect x="0" y="0" width="{width}" height="{height}" fill="rgb(250,250,240)"/>')
+    lines.append(f'<text x="{width / 2}" y="24" text-anchor="middle" font-size="16">{html.escape(title)}</text>')
+    for x, depth, w, frame, n in boxes:
+        # Root frames are at the bottom.
+        y = height - 10 - (depth + 1) * frame_height
+        tooltip = html.escape(f'{frame} ({n} samples, {100 * n / total:.2f}%)')
+        lines.append(f'<g><title>{tooltip}</title>')
+        lines.append(f'<rect x="{x:.2f}" y="{y}" width="{w:.2f}" height="{frame_height - 1}" fill="{_colour(frame)}" rx="2" ry="2"/>')
+        chars = int(w / 7)
+        if chars >= 3:
+            label = frame if len(frame) <= chars else frame[:chars - 2] + '..'
+            lines.append(f'<text x="{x + 3:.2f}" y="{y + frame_height - 4}">{html.escape(label)}</text>')
+        lines.append(f'</g>')
+    lines.append(f'</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+def write(folded_path, svg_path, title=''):
+    '''
+    Writes SVG flamegraph of folded stack file `folded_path` to `svg_path`.
+    '''
+    with open(folded_path) as f:
+        text = f.read()
+    with open(svg_path, 'w') as f:
+        f.write(svg(text, title))
+
+
+if __name__ == '__main__':
+    write(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else sys.argv[1])
@@ -2,11 +2,11 @@ import json
 import os
 import subprocess
 
-import main
+import common
 
 
 def run(command):
-    main.log(f'Running: {command}')
+    common.log(f'Running: {command}')
     subprocess.run(command, shell=1, check=1)
 
 def addpush_json(results, name, name_latest):
@@ -37,7 +37,7 @@ def addpush_json(results, name, name_latest):
 
     gh_key = os.environ.get('PYMUPDF_PERFORMANCE_RESULTS_RW')
     if gh_key is None:
-        main.log(f'Not pushing to {remote} because PYMUPDF_PERFORMANCE_RESULTS_RW not set')
+        common.log(f'Not pushing to {remote} because PYMUPDF_PERFORMANCE_RESULTS_RW not set')
         return
 
     ssh_id_path = os.path.abspath('ssh_id')
@@ -80,5 +80,5 @@ def addpush_json(results, name, name_latest):
         except Exception:
             log(f'Ignoring exception removing {ssh_id_path}: {e}')
 
-    main.log(f'Have pushed results to {remote}.')
+    common.log(f'Have pushed results to {remote}.')
     
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+'''
+Maintains a local SQLite database of performance results, for fast queries
+over many runs.
+
+Usage:
+
+    history.py [--db <path>] <command> ...
+
+Args:
+
+    --db <path>
+        Database file. Default is 'history.sqlite3'.
+
+Commands:
+
+    ingest <path> ...
+        Add results files to the database. Each <path> can be a results JSON
+        file or a directory, in which case we use all `*.json` files in it
+        (ignoring softlinks such as results-latest.json). Files that have
+        already been ingested, identified by their SHA-256 checksum, are
+        skipped, so this can be re-run cheaply after new results are
+        available.
+
+    series <testname> <path> <toolname> [<metric>]
+        Show time series of <metric> for the specified test. <metric> is one
+        of the columns of the `results` table such as `t` (the default),
+        `mean`, `stddev` or `maxrss_kb`.
+
+    best <testname> <path> <toolname> [<n>]
+    worst <testname> <path> <toolname> [<n>]
+        Show the <n> (default 5) fastest or slowest runs of the specified
+        test.
+
+    platforms <testname> <path> <toolname>
+        Show number of runs and median/min/max time of the specified test for
+        each platform fingerprint.
+
+    summary
+        Show summary of recent runs of each test, as used by main.py's
+        --history.
+
+    <testname>, <path> and <toolname> can be '%' to match anything, or
+    contain '%' to use SQL LIKE matching.
+
+Database tables:
+
+    files
+        One row for each ingested results file, with date, platform info and
+        tool versions.
+
+    results
+        One row for each item in a results file's `data` list, with the date,
+        platform fingerprint and the tool's PyMuPDF/MuPDF git shas copied
+        from `files` so that queries do not need a join.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+import common
+import stats
+
+
+_metrics = (
+        't',
+        'n',
+        'mean',
+        'median',
+        'stddev',
+        'min',
+        'max',
+        'maxrss_kb',
+        )
+
+
+def connect(db_path):
+    '''
+    Returns sqlite3 connection to database `db_path`, creating tables if
+    necessary.
+    '''
+    db = sqlite3.connect(db_path)
+    db.executescript('''
+            create table if not exists files(
+                id integer primary key,
+                name text,
+                sha256 text unique,
+                date_seconds real,
+                date_string text,
+                platform text,
+                platform_fingerprint text,
+                toolversions text
+                );
+            create table if not exists results(
+                file_id integer references files(id),
+                date_seconds real,
+                platform_fingerprint text,
+                testname text,
+                path text,
+                toolname text,
+                start text,
+                io text,
+                pymupdf_git_sha text,
+                mupdf_git_sha text,
+                e text,
+                t real,
+                n integer,
+                mean real,
+                median real,
+                stddev real,
+                min real,
+                max real,
+                maxrss_kb real
+                );
+            create index if not exists results_test
+                on results(testname, path, toolname, date_seconds);
+            create index if not exists results_platform
+                on results(platform_fingerprint);
+            create index if not exists results_sha
+                on results(toolname, pymupdf_git_sha, mupdf_git_sha);
+            ''')
+    return db
+
+
+def platform_fingerprint(results):
+    '''
+    Returns a short string identifying the platform that generated `results`.
+    '''
+    platform = results.get('platform', dict())
+    items = [platform.get(name) for name in ('system', 'machine', 'processor', 'python_version')]
+    return hashlib.sha256(json.dumps(items).encode('utf8')).hexdigest()[:16]
+
+
+def ingest(db, paths):
+    '''
+    Adds results files in `paths` to database `db`, skipping files that have
+    already been added. Returns number of files added.
+    '''
+    filenames = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for leaf in sorted(os.listdir(path)):
+                path2 = os.path.join(path, leaf)
+                if leaf.endswith('.json') and not os.path.islink(path2):
+                    filenames.append(path2)
+        else:
+            filenames.append(path)
+    num_added = 0
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        sha256 = hashlib.sha256(contents).hexdigest()
+        if db.execute('select 1 from files where sha256=?', (sha256,)).fetchone():
+            continue
+        try:
+            results = json.loads(contents)
+            date = results['date']
+            data = results['data']
+        except Exception as e:
+            common.log(f'Ignoring {filename=} because not a results file: {e}')
+            continue
+        fingerprint = platform_fingerprint(results)
+        toolversions = results.get('toolversions', dict())
+        with db:
+            cursor = db.execute(
+                    'insert into files(name, sha256, date_seconds, date_string, platform, platform_fingerprint, toolversions)'
+                    ' values(?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        os.path.basename(filename),
+                        sha256,
+                        date['seconds'],
+                        date['string'],
+                        json.dumps(results.get('platform')),
+                        fingerprint,
+                        json.dumps(toolversions),
+                    ),
+                    )
+            file_id = cursor.lastrowid
+            for result in data:
+                if result.get('params'):
+                    # Results with non-default params from main.py's --grid
+                    # would be mixed up with the default test's time series.
+                    continue
+                version = toolversions.get(result['toolname'])
+                if not isinstance(version, dict):
+                    version = dict()
+                result_stats = result.get('stats') or dict()
+                memory = result.get('memory') or dict()
+                db.execute(
+                        'insert into results values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (
+                            file_id,
+                            date['seconds'],
+                            fingerprint,
+                            result['testname'],
+                            result['path'],
+                            result['toolname'],
+                            result.get('start', 'cold'),
+                            result.get('io', 'disk'),
+                            version.get('pymupdf_git_sha'),
+                            version.get('mupdf_git_sha'),
+                            str(result['e']) if result['e'] else None,
+                            result['t'],
+                            result_stats.get('n', 1),
+                            result_stats.get('mean', result['t']),
+                            result_stats.get('median', result['t']),
+                            result_stats.get('stddev'),
+                            result_stats.get('min', result['t']),
+                            result_stats.get('max', result['t']),
+                            memory.get('maxrss_kb'),
+                        ),
+                        )
+        common.log(f'Have ingested {filename} with {len(data)} results.')
+        num_added += 1
+    return num_added
+
+
+def _where(testname, path, toolname):
+    return (
+            'testname like ? and path like ? and toolname like ?',
+            (testname, path, toolname),
+            )
+
+
+def series(db, testname, path, toolname, metric='t'):
+    '''
+    Returns list of `(date_string, toolname, path, start, io, pymupdf_git_sha,
+    mupdf_git_sha, value)` for successful runs, in order of date.
+    '''
+    assert metric in _metrics, f'Unrecognised {metric=}, should be one of: {_metrics}'
+    where, params = _where(testname, path, toolname)
+    return db.execute(
+            f'select files.date_string, toolname, path, start, io, pymupdf_git_sha, mupdf_git_sha, {metric}'
+            f' from results join files on files.id = results.file_id'
+            f' where {where} and e is null'
+            f' order by results.date_seconds',
+            params,
+            ).fetchall()
+
+
+def extremes(db, testname, path, toolname, n=5, worst=False):
+    '''
+    Returns list of up to `n` `(t, date_string, toolname, path, start, io,
+    platform_fingerprint)` for the fastest (or slowest if `worst` is true)
+    successful runs.
+    '''
+    where, params = _where(testname, path, toolname)
+    order = 'desc' if worst else 'asc'
+    return db.execute(
+            f'select t, files.date_string, toolname, path, start, io, results.platform_fingerprint'
+            f' from results join files on files.id = results.file_id'
+            f' where {where} and e is null'
+            f' order by t {order} limit ?',
+            params + (n,),
+            ).fetchall()
+
+
+def platforms(db, testname, path, toolname):
+    '''
+    Returns list of `(platform_fingerprint, platform, num_runs, median, min,
+    max)` for successful runs of the specified test.
+    '''
+    where, params = _where(testname, path, toolname)
+    ret = list()
+    for fingerprint, in db.execute(
+            f'select distinct platform_fingerprint from results where {where} and e is null',
+            params,
+            ).fetchall():
+        ts = [t for t, in db.execute(
+                f'select t from results where {where} and e is null and platform_fingerprint=? order by t',
+                params + (fingerprint,),
+                ).fetchall()]
+        platform, = db.execute(
+                'select platform from files where platform_fingerprint=? order by date_seconds desc limit 1',
+                (fingerprint,),
+                ).fetchone()
+        platform = json.loads(platform) or dict()
+        description = ' '.join(str(platform.get(name)) for name in ('system', 'machine', 'processor', 'python_version'))
+        ret.append((fingerprint, description, len(ts), stats.percentile(ts, 50), ts[0], ts[-1]))
+    return ret
+
+
+def summary(db, runs=20):
+    '''
+    Returns dict mapping from `(testname, path, toolname, start, io,
+    platform_fingerprint)` to a dict summarising the results of each test in
+    the most recent `runs` results files that contain it, for use by main.py
+    to choose timeouts and repetitions:
+
+        'n': Number of successful runs.
+        'median': Median of `t` of successful runs, or None.
+        'max': Maximum of `max` of successful runs, or None. With the default
+            `runs=20` this is what a 99th percentile would be anyway.
+        'timeouts':
+            Number of most recent consecutive results files in which the
+            test timed out.
+        'last_seconds': Date of most recent run.
+
+    Results with `e` starting with 'Skipped' are ignored, because they were
+    not run.
+    '''
+    rows = dict()
+    for file_id, testname, path, toolname, start, io, fingerprint, date_seconds, e, t, max_ in db.execute(
+            'select file_id, testname, path, toolname, start, io, platform_fingerprint, date_seconds, e, t, max'
+            ' from results'
+            " where e is null or e not like 'Skipped%'"
+            ' order by date_seconds desc, file_id desc'
+            ).fetchall():
+        files = rows.setdefault((testname, path, toolname, start, io, fingerprint), dict())
+        if file_id in files or len(files) < runs:
+            files.setdefault(file_id, list()).append((date_seconds, e, t, max_))
+    ret = dict()
+    for key, files in rows.items():
+        rr = [r for rr in files.values() for r in rr]
+        ts = sorted(t for date_seconds, e, t, max_ in rr if e is None and t is not None)
+        maxs = [max_ for date_seconds, e, t, max_ in rr if e is None and max_ is not None]
+        timeouts = 0
+        for rr2 in files.values():
+            # A test can have more than one row in a results file, so we count
+            # files rather than rows.
+            if not any(e == 'Timeout' for date_seconds, e, t, max_ in rr2):
+                break
+            timeouts += 1
+        ret[key] = dict(
+                n=len(ts),
+                median=stats.percentile(ts, 50) if ts else None,
+                max=max(maxs) if maxs else None,
+                timeouts=timeouts,
+                last_seconds=rr[0][0],
+                )
+    return ret
+
+
+if __name__ == '__main__':
+    db_path = 'history.sqlite3'
+    args = sys.argv[1:]
+    if args[:1] == ['--db']:
+        db_path = args[1]
+        args = args[2:]
+    if not args or args[0] in ('-h', '--help'):
+        common.log(__doc__)
+        sys.exit()
+    command = args[0]
+    args = args[1:]
+    db = connect(db_path)
+    if command == 'ingest':
+        n = ingest(db, args)
+        common.log(f'Have ingested {n} new results files into {db_path}.')
+    elif command == 'series':
+        for row in series(db, *args):
+            print(' '.join(str(i) for i in row))
+    elif command in ('best', 'worst'):
+        testname, path, toolname = args[:3]
+        n = int(args[3]) if len(args) > 3 else 5
+        for row in extremes(db, testname, path, toolname, n, worst=(command == 'worst')):
+            print(' '.join(str(i) for i in row))
+    elif command == 'platforms':
+        for row in platforms(db, *args):
+            print(' '.join(str(i) for i in row))
+    elif command == 'summary':
+        for key, value in sorted(summary(db).items()):
+            print(f'{" ".join(str(i) for i in key)}: {json.dumps(value, sort_keys=1)}')
+    else:
+        raise Exception(f'Unrecognised {command=}')
@@ -10,13 +10,156 @@ ArtifexSoftware/PyMuPDF-performance-results. See github.py for details.
 JSON format:
 
     {
+        'ab':   # Only if --ab specified. List of dicts, one for each (testname,
+                # path, start, io) whose tests were run interleaved.
+        [
+            {
+                'testname': str
+                'path': str
+                'params': dict
+                'start': str
+                'io': str
+                'toolnames': [str]  # In --ab order.
+                'rounds': int       # Number of rounds.
+                'order': [[str]]    # Order in which tools were run in each round.
+                'pairs':            # One for each pair of tools.
+                [
+                    {
+                        'a': str, 'b': str  # Toolnames.
+                        'n': int            # Number of paired samples.
+                        'change': float     # Geometric mean of b/a time, minus 1.
+                        'ci95': [float, float]
+                                            # 95% confidence interval of `change`.
+                        'verdict': str      # 'faster', 'slower' or 'no significant difference'.
+                        'equivalent': bool  # True if `ci95` is within
+                                            # +/- --compare-threshold.
+                    },
+                    ...
+                ]
+            },
+            ...
+        ]
         'data': # List of dicts, one for each timed test run.
         [
             {
+                'category': str     # Category of input file from corpus manifest,
+                                    # e.g. 'text-heavy'; see corpus.describe().
+                'concurrency': int  # Maximum number of tests running at the same time as this one.
+                'counters':         # Performance counters of test function in
+                                    # child process, user space only; median over
+                                    # samples. None if not available or
+                                    # --perf-counters is 0, and individual
+                                    # counters are omitted if not available; see
+                                    # _PerfCounters.
+                {
+                    'cycles': int, 'instructions': int,
+                    'cache_references': int, 'cache_misses': int,
+                    'branches': int, 'branch_misses': int,
+                    'task_clock_ns': int,
+                    'ipc': float                # `instructions / cycles`.
+                    'cache_miss_rate': float    # `cache_misses / cache_references`.
+                    'branch_miss_rate': float   # `branch_misses / branches`.
+                }
+                'cpu': int,None     # CPU that test was pinned to, or None if not pinned.
+                'diverged': [str]   # Only if --validate specified. Descriptions
+                                    # of differences between `fingerprints` and
+                                    # reference or other PyMuPDF variants.
                 'e': int,None,str   # 0 success, None timeout, non-zero error code, string exception text.
+                                    # Starts with 'Skipped' if not run; see --history.
+                't_failed': float,None
+                                    # Elapsed time of the run that failed or
+                                    # timed out, which is not in `samples`.
+                'flamegraph':       # Only if --py-spy specified.
+                {
+                    'folded': str   # Path of folded stacks file.
+                    'svg': str      # Path of SVG flamegraph.
+                }
+                'pstats': str       # Only if --cprofile specified. Path of cProfile output.
+                'fingerprints':     # Only if --validate specified. Output
+                                    # fingerprints from an extra untimed run,
+                                    # or None if not available.
+                {
+                    'text_length': int
+                    'text_pages': [[int, str], ...]
+                                    # [page number, checksum] of extracted text.
+                    'pixmaps': [[int, str, str], ...]
+                                    # [page number, checksum, perceptual hash]
+                                    # of rendered pages.
+                    'output_pages': int
+                    'output_size': int
+                                    # Total page count and size of output
+                                    # files, e.g. for copy, merge and split.
+                }
+                'io': str           # I/O mode, 'disk', 'memory' or 'mmap'; see --io.
+                'mb_per_sec': float # Input file size in MB (10**6 bytes) divided by `t`.
+                'memory':           # Resource usage of child process; median over samples.
+                {
+                    'maxrss_kb': int    # Peak resident set size in kilobytes, minus the
+                                        # peak when the child process started, so
+                                        # that memory inherited from the parent
+                                        # (e.g. preloaded inputs for --io memory)
+                                        # is not included. For warm runs, this is
+                                        # the peak for the lifetime of the worker
+                                        # process.
+                    'minflt': int       # Minor page faults.
+                    'majflt': int       # Major page faults.
+                    'nvcsw': int        # Voluntary context switches.
+                    'nivcsw': int       # Involuntary context switches.
+                    'rss_timeline': [[float, int], ...]
+                                        # Only if --rss-interval specified:
+                                        # [seconds, rss_kb] pairs for last
+                                        # sample.
+                }
+                'pages':            # Per-page timings, for tests that use timed_page().
+                {
+                    'n': int                # Number of pages.
+                    'p50': float, 'p95': float, 'p99': float, 'max': float,
+                                            # Percentiles of per-page time.
+                    'slowest': [[int, float], ...]
+                                            # [page number, time] of up to five
+                                            # slowest pages, slowest first.
+                    'pages_per_sec': float  # `n` divided by `t`.
+                    'pages_per_sec_pages': float
+                                            # `n` divided by sum of per-page
+                                            # times.
+                }
+                                    # Per-page times are the median over samples.
+                'pages_per_sec': float
+                                    # Number of pages in input file divided by `t`.
+                'params': dict      # Keyword params passed to test function,
+                                    # excluding those with default values;
+                                    # see --grid.
                 'path': str         # Name of input PDF file.
-                't': float          # Elapsed time.
-                'testname': str     # E.g. 'render' or 'text'.
+                'phases':           # Breakdown of `t` into phases; median over samples.
+                {
+                    'spawn': float  # Starting child process.
+                    'import': float # Importing library, e.g. pymupdf.
+                    'open': float   # Opening input file.
+                    'work': float   # Main processing, e.g. rendering.
+                    'write': float  # Writing output.
+                    'exit': float   # Child process exit and returning results.
+                    'other': float  # Remaining time not in any of the above.
+                    ...
+                }
+                'samples': [float]  # Elapsed time of each successful timed run, excluding warm-up runs.
+                'start': str        # 'cold' if each run is in a new child process,
+                                    # 'warm' if runs are in a persistent child
+                                    # process; see --warm.
+                'stats':            # Statistics of `samples`; see _stats().
+                {
+                    'n': int,
+                    'mean': float, 'median': float, 'stddev': float,
+                    'min': float, 'max': float,
+                    'q1': float, 'q3': float, 'iqr': float,
+                    'ci95': [float, float]  # 95% confidence interval of mean.
+                }
+                't': float,None     # Elapsed time; median of `samples`, or None if there are none.
+                't_normalised': float
+                                    # `t` converted to time on the calibration
+                                    # reference machine, `t * score / 1000`;
+                                    # see `calibration` below.
+                'testname': str     # E.g. 'render' or 'text'; see do_*() functions.
+                'timeout': float    # Timeout used for each run; see --history.
                 'toolname': str     # E.g. 'pymupdf' or 'poppler'.
             },
             ...
@@ -38,29 +181,268 @@ JSON format:
             'system':                   'OpenBSD'
             ...
         }
+        'builds':       # Information about PyMuPDF builds; see pymupdf_install().
+        {
+            toolname:str:
+            {
+                'cache': str,None   # 'hit', 'miss' or None if not cached.
+                'key': str,None     # Build cache key.
+                't': float          # Time taken to build or fetch from cache.
+                'e': str            # Only if build failed; exception text.
+            }
+        }
+        'calibration':  # Speed of machine at start and end of run; see calibrate().
+        {
+            'start':
+            {
+                'python': float, 'sha256': float, 'zlib': float, 'sort': float, 'score': float,
+                'builds_running': [str, ...]
+                                # PyMuPDF builds that were still running, so
+                                # may have slowed the machine down.
+            }
+            'end': {...}
+            'score': float      # Mean of start and end scores; 1000 is the
+                                # speed of the reference machine.
+            'drift': float      # Relative change in score from start to end.
+            'drifted': bool     # True if `drift` is more than 5%, so results
+                                # may be unreliable.
+        }
+        'categories':   # Throughput for each category of input file. List of
+                        # dicts, one for each (category, testname, toolname,
+                        # start, io).
+        [
+            {
+                'category': str
+                'testname': str
+                'toolname': str
+                'start': str
+                'io': str
+                'n': int                # Number of input files.
+                'pages_per_sec': float  # Median over input files.
+                'mb_per_sec': float     # Median over input files.
+            },
+            ...
+        ]
+        'comparison':   # Only if --compare specified; see compare.compare().
         'date': 1680704072.1528542
+        'environment':  # Machine state at start and end of run; see environment().
+                        # With --build-background 1, 'start' is from before
+                        # the builds were started.
+        {
+            'start': {'cpu_model': str, 'cpu_count': int, 'loadavg': [float, float, float], ...}
+            'end': {...}
+        }
+        'history': str  # Only if --history database was used.
+        'resumed': int  # Only if --resume continued an interrupted run;
+                        # number of results from the interrupted run.
+        'jobs': int     # Value of --jobs.
+        'manifest':     # Information about each input file, from the corpus
+                        # manifest; see corpus.describe().
+        {
+            path:str:
+            {
+                'pages': int, 'size': int, 'images': int, 'fonts': int,
+                'objects': int, 'chars': int, 'drawings': int,
+                'category': str
+            }
+        }
+        'sweeps':       # Only if --sweep specified. List of dicts, one for each
+                        # sweep parameter and (testname, toolname, start, io).
+        [
+            {
+                'param': str        # Name of swept parameter, e.g. 'pages'.
+                'testname': str
+                'toolname': str
+                'start': str
+                'io': str
+                'points': [[value, t], ...]
+                'a': float, 'b': float, 'r2': float
+                                    # Fit of `t = a * value**b`; `b` greater
+                                    # than 1 means super-linear scaling.
+                'superlinear': bool # True if `b` is more than 1.1.
+            },
+            ...
+        ]
+        'validation':   # Only if --validate specified.
+        {
+            'reference': str,None   # Value of --validate-reference.
+            'diverged': int         # Number of results whose output diverged.
+        }
+        'scaling':      # Only if --scaling specified. List of dicts, one for each
+                        # `scale_<testname>_<toolname>()` function and input
+                        # file.
+        [
+            {
+                'testname': str
+                'path': str
+                'toolname': str
+                'curve':
+                [
+                    {
+                        'workers': int          # Number of worker processes.
+                        'e': int,str            # As for `data` items.
+                        'pages': int            # Total pages processed.
+                        't': float              # Median wall-clock time.
+                        'samples': [float]
+                        'pages_per_sec': float
+                        'speedup': float        # Relative to 1 worker.
+                        'efficiency': float     # `speedup / workers`.
+                    },
+                    ...
+                ]
+            },
+            ...
+        ]
     }
 
 Args:
 
+    --ab <toolname>,<toolname>,...
+        Compare two or more tools, typically PyMuPDF variants such as
+        pymupdf_mupdf_master,pymupdf_mupdf_master_pla, using interleaved
+        runs. The tools are also added as if with --tool. For each test and
+        input file, we do rounds each containing one timed run of each tool,
+        in a new random order for each round, so that drift in the machine's
+        speed affects all tools equally instead of looking like a difference
+        between them. The number of rounds is --repeat, but at least 5; with
+        --repeat-ci we continue until the confidence intervals of all paired
+        differences are within +/- <fraction>, or --repeat-max rounds. We
+        report the paired difference of each pair of tools with its 95%
+        confidence interval, and 'no significant difference' if the interval
+        includes zero; see `ab` above and compare.paired(). A/B tests are run
+        one at a time before other tests, regardless of --jobs, except that
+        with --build-background 1, A/B tests of tools whose builds have not
+        finished are run after other tests.
+
     --austin <austin>
         Run everything via austin profiler; `austin` should be the austin
         executable, e.g. ./austin-3.5.0-gnu-linux-amd64/austin
     
+    --build-cache <directory>|0
+        Directory in which to cache PyMuPDF builds, keyed on PyMuPDF and
+        MuPDF git shas, Py_LIMITED_API, compiler and Python version; see
+        pymupdf_install(). Default is 'build-cache' in the same directory as
+        this script. If '0' we don't use a build cache.
+
+    --build-cache-max-days <days>
+    --build-cache-max-gb <size>
+        Remove cached builds not used for more than <days> days (default 30),
+        and least recently used builds if the total size of the build cache
+        exceeds <size> GB (default 10).
+
     --build-check 0|1
         If 0 (the default), build failures are ignored.
+
+    --build-background 0|1
+        If 1, PyMuPDF builds run in the background; tests of other tools, and
+        of PyMuPDF variants that have finished building, are run while the
+        remaining builds run. This requires --build-cpus, so that tests are
+        pinned to CPUs that builds do not use; even so, builds may affect
+        timings through shared caches and memory bandwidth. The start
+        calibration (see calibrate()) is done before the builds are started.
+        If a build fails (with --build-check 0), tests of that variant are
+        dropped.
+
+        Default is 0, which waits for all builds to finish before running any
+        tests.
+
+    --build-cpus <n>
+        Restrict PyMuPDF builds to <n> CPUs, which also limits the number of
+        concurrent compiler jobs. Tests run on the remaining CPUs. Default is
+        to use all CPUs for builds.
+
+    --build-jobs <n>
+        Build up to <n> PyMuPDF variants at the same time. Default is 1.
+        Builds that use the same local PyMuPDF or MuPDF checkout are never
+        run at the same time.
     
+    --compare <path>|previous
+        Compare results with results file <path>, or with the previous
+        results-latest.json if 'previous', and report significant regressions
+        and improvements; see compare.py.
+
+    --compare-alpha <alpha>
+    --compare-threshold <fraction>
+        Passed to compare.compare(); defaults are 0.05 and 0.05.
+
+    --compare-fail 0|1
+        If 1, we exit with non-zero code if --compare finds any significant
+        regressions.
+
     --cprofile 0|1
-        If 1, profile individual test runs with cProfile.
+        If 1, after timing each test we run it once more with cProfile, and
+        write the profile in pstats format to directory
+        'profiles/<results-name>/', with a name containing the testname,
+        toolname, start, I/O mode and path. Use profiles.py to show the
+        hottest functions and compare profiles of different PyMuPDF variants.
 
     --perf 0|1
-        If 1, run with `perf record`.
+        If 1, run with `perf record`. This profiles the entire run; for
+        per-test performance counters, see --perf-counters.
+
+    --perf-counters 0|1
+        If 1, we collect performance counters such as cycles and cache misses
+        for each test where available, see `counters` above. Setting up the
+        counters adds a little time to each timed run, so this is off by
+        default to keep times comparable with runs without it. Default is 0.
     
+    --grid 0|1
+        If 1, tests that have a parameter grid in `_params_grids`, such as
+        render (dpi, colorspace, alpha and image_format) and copy (garbage,
+        deflate, use_objstms and incremental save), are run with every
+        combination of params, giving a separate result for each
+        combination, with the params in `params`. Default is 0, which runs
+        each test once with default params.
+
+    --grid-only <name>=<value>,<value>,...
+        Implies --grid 1, and only uses combinations where param <name> is one
+        of the <value>s; can be specified multiple times. For example
+        `--grid-only dpi=72,300 --grid-only image_format=png`.
+
+    --history <path>|0
+        history.py database used to choose timeouts and repetitions for each
+        (testname, path, toolname, start, io) on this platform, using the
+        most recent 20 runs. Default is 'history.sqlite3' in the same
+        directory as this script. If '0', we don't use a history database.
+
+        At the end of each run (except with --internal-check 1) we add the
+        run's results to the database, creating it if necessary, so a local
+        checkout accumulates history over successive runs. A fresh checkout
+        such as a Github CI job has no database, so the workflow first
+        creates one from the results repository with `history.py ingest`.
+
+        Unless --timeout is specified, each test's timeout is --timeout-k
+        times the maximum historical time, clamped to 10..300 seconds; tests
+        without history get 300 seconds. Tests that timed out in each of their
+        last 3 runs are skipped, unless the last run was more than 7 days ago.
+
     --internal-check 0|1
 
         If 1, we don't run performance fns, instead pretending each one took 1
         second. Used to check the code.
 
+    --io disk|memory|mmap
+        I/O mode; can be specified multiple times to run each test with
+        different I/O modes. Default is 'disk'.
+
+        disk:
+            Test functions read input from and write output to files.
+        memory:
+            Input files are read into memory before running tests, and test
+            functions open them from memory and write output to memory.
+        mmap:
+            Test functions open input files using mmap, and write output to
+            memory.
+
+        Tools that can only use files, such as poppler, are run with 'disk'
+        only.
+
+    --jobs <n>
+        Run up to <n> tests at the same time, each in a child process pinned
+        to a different CPU. Tests are started in order of decreasing expected
+        time, using times from the previous results-latest.json if available.
+        Default is 1, which runs tests one at a time without pinning.
+
     --mupdf-branch <location>
     --mupdf-master <location>
     --mupdfpy <location>
@@ -89,15 +471,87 @@ Args:
         If 0 we don't install python packages; saves a little time if venv
         already set up.
 
+    --py-spy <py-spy>
+        If specified, after timing each test we run it once more with the
+        `py-spy` sampling profiler (e.g. 'py-spy') attached to the test's
+        child process, including native frames such as MuPDF's C code. Folded
+        stacks and an SVG flamegraph (see flamegraph.py) are written to
+        directory 'profiles/<results-name>/'. The child process waits until
+        py-spy has attached, so the whole test is sampled. py-spy needs
+        permission to ptrace the child process, e.g. Linux's
+        /proc/sys/kernel/yama/ptrace_scope must be 0 or 1. If <py-spy> is
+        'py-spy', it is also installed in the venv.
+
     --pymupdf-build 0|1
         If 0, do not rebuild mupdfpy or PyMuPDF. Default is 1.
 
+    --repeat <n>
+        Number of timed runs of each test. Default is 1.
+
+    --repeat-budget <seconds>
+        If specified, and we have historical times for a test (see
+        --history), the number of timed runs of the test is chosen so that
+        they take about <seconds> in total, within 1..--repeat-max. This
+        overrides --repeat, giving fast tests more repetitions and slow tests
+        fewer.
+
+    --repeat-ci <fraction>
+        If specified, after the `--repeat` timed runs we continue running
+        each test until the 95% confidence interval of the mean is within
+        +/- <fraction> of the mean, or `--repeat-max` runs have been done.
+
+    --repeat-max <n>
+        Maximum number of timed runs when using `--repeat-ci`. Default is 20.
+
+    --resume 0|1
+        While running, we append each result to a JSON Lines file
+        '<results-name>.jsonl', each line containing `{"data": <result>}`, or
+        `{"data": [<result>, ...], "ab": <ab>}` for a group of --ab tests.
+        The checkpoint file 'results-checkpoint.json' (or
+        'internal_results-checkpoint.json') contains the results file name,
+        date, name of the JSON Lines file, number of completed tests and the
+        arguments that affect which tests are run and how. Both are removed
+        when the run finishes. If 1 and the checkpoint file exists, we
+        continue the interrupted run: tests whose results are already in the
+        JSON Lines file are not rerun, and their results are included in the
+        final results file (which has the interrupted run's name and date)
+        and in the results pushed to Github. Tests are identified by
+        testname, path, toolname, start, I/O mode and params; see
+        common.result_key(). A group of --ab tests is resumed only if all of its
+        tests completed, otherwise the whole group is rerun. We fail if the
+        arguments differ from those of the interrupted run. Default is 0.
+
+    --rss-interval <seconds>
+        If specified, each test's child process runs a thread that records
+        resident set size every <seconds> seconds. Requires /proc.
+
+    --scaling <n>,<n>,...|auto
+        Also measure how throughput scales when each input file's pages are
+        split across different numbers of worker processes, using
+        `scale_<testname>_<toolname>()` functions. 'auto' uses powers of two
+        up to the number of available CPUs. Workers are pinned to different
+        CPUs where possible.
+
+    --sweep <param>=<value>,<value>,...
+        Generate synthetic PDF files using corpus.py, with <param> set to each
+        <value> and other parameters set to their defaults, and add them to
+        the input files. After running tests, fit `t = a * value**b` for each
+        test and tool, to detect super-linear scaling. Can be specified
+        multiple times. For example: --sweep pages=1,10,100,1000
+
+        Generated files are put in directory 'corpus' and reused if they
+        already exist.
+
     --test <testname>
         Adds to list of testnames. If not specified we use all tests.
 
     --timeout <timeout>
-        Set fixed timeout for all tests. Otherwise we use hard-coded variable
-        timeouts.
+        Set fixed timeout for all tests. Otherwise we use timeouts derived
+        from history; see --history.
+
+    --timeout-k <k>
+        Multiplier for maximum historical time when choosing
+        timeouts; see --history. Default is 5.
     
     --tool <toolname>
         Can be specified multiple times. Test specified tools only.
@@ -105,27 +559,71 @@ Args:
         To test PyMuPDF use `--tool pymupdf_mupdf_master` or `--tool
         pymupdf_mupdf_branch`.
 
+    --validate 0|1
+        If 1, after timing each test we run it once more, untimed, recording
+        fingerprints of its output (text checksums, rendered page checksums
+        and perceptual hashes, page count and size of copied files). Results
+        whose output differs between PyMuPDF variants, or from
+        --validate-reference, are marked with `diverged`, so that a speed-up
+        caused by broken output is not mistaken for an improvement.
+
+    --validate-reference <path>
+        JSON file containing reference fingerprints, keyed by testname, path
+        and tool (PyMuPDF variants share the same reference). If <path> does
+        not exist, it is created from this run's fingerprints.
+
     --venv-install 0|1
 
         If 0 we assume the venv is already set up; this can save a few seconds
         on startup. Otherwise (the default) we create it, upgrade pip, and
         install various PDF libraries.
 
+    --warm 0|1
+        If 1, as well as running each test in a new child process ('cold'), we
+        also run each test in a persistent worker process for each tool, that
+        has already imported the tool's library ('warm'). This gives
+        steady-state timings, excluding process creation and import costs.
+
+    --warmup <n>
+        Number of untimed runs of each test before the timed runs. Default
+        is 0.
+
 '''
 
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
 import json
+import math
+import mmap
 import multiprocessing
 import os
 import pickle
 import platform
+import random
 import re
 import shlex
+import shutil
+import signal
+import struct
 import subprocess
 import sys
+import sysconfig
 import tempfile
+import threading
 import time
 
+import common
+import compare
+import corpus
+import flamegraph
 import github
+import history
+import stats
+from common import log
 
 
 def performance(
@@ -136,6 +634,35 @@ def performance(
         internal_check=None,
         austin=None,
         cprofile=None,
+        warmup=0,
+        repeat=1,
+        repeat_ci=None,
+        repeat_max=20,
+        rss_interval=None,
+        jobs=1,
+        warm=False,
+        scaling=None,
+        io_modes=None,
+        compare_with=None,
+        compare_threshold=0.05,
+        compare_alpha=0.05,
+        builds=None,
+        pending=None,
+        cpus=None,
+        sweeps=None,
+        validate=False,
+        validate_reference=None,
+        py_spy=None,
+        history_path=None,
+        timeout_k=5,
+        repeat_budget=None,
+        ab=None,
+        grid=False,
+        grid_filters=None,
+        resume=False,
+        environment_start=None,
+        calibration_start=None,
+        perf_counters=False,
         ):
     '''
     Runs performance tests and saves to JSON results file whose name contains
@@ -150,13 +677,92 @@ def performance(
         internal_check:
             If true we don't actually run tests but instead pretend that all
             timings are 1.
+        cprofile:
+            If true, we also run each test with cProfile and save the
+            profile; see --cprofile.
+        warmup, repeat, repeat_ci, repeat_max, rss_interval:
+            Passed to run_samples().
+        jobs:
+            Maximum number of tests to run concurrently; see schedule().
+        warm:
+            If true, we also run each test in a persistent WarmWorker for
+            each tool.
+        scaling:
+            If not None, list of worker counts for
+            `scale_<testname>_<toolname>()` functions; see run_scaling().
+        io_modes:
+            List of I/O modes, 'disk', 'memory' or 'mmap'. If None we use
+            ['disk'].
+        compare_with:
+            If not None, path of results file to compare with, or 'previous'
+            to compare with previous results-latest.json.
+        compare_threshold, compare_alpha:
+            Passed to compare.compare().
+        builds:
+            If not None, dict of information about PyMuPDF builds, to be
+            included in results.
+        pending:
+            If not None, dict mapping from toolname to a
+            `concurrent.futures.Future` for a build that may still be running.
+            The future's result should be true if the build succeeded. Tests
+            for other tools are run first, and tests for a tool whose build
+            failed are dropped.
+        cpus:
+            If not None, list of CPUs to run tests on; see schedule().
+        sweeps:
+            If not None, list of `(param, values)` to generate synthetic PDF
+            files with corpus.generate().
+        validate:
+            If true, after timing each test we run it again untimed to get
+            fingerprints of its output, and check for differences between
+            PyMuPDF variants and with `validate_reference`.
+        validate_reference:
+            If not None, path of JSON file containing reference fingerprints.
+            If it does not exist, we create it from this run's fingerprints.
+        py_spy:
+            If not None, the py-spy executable, and we also run each test
+            under py-spy to create a flamegraph; see --py-spy.
+        history_path:
+            If not None, path of history.py database, used to choose a timeout
+            (`timeout_k` times the maximum historical time) and number of repetitions
+            (see `repeat_budget`) for each test, and to skip tests that have
+            recently timed out repeatedly; see --history. This run's results
+            are added to the database at the end.
+        timeout_k:
+            Multiplier for maximum historical time when choosing timeouts.
+        repeat_budget:
+            If not None, target time in seconds for the timed runs of each
+            test; using the historical median time, fast tests get more
+            repetitions and slow tests fewer, within 1..`repeat_max`.
+        ab:
+            If not None, list of two or more toolnames whose tests are run
+            with samples interleaved in random order, and compared using
+            paired differences; see run_ab() and --ab.
+        grid, grid_filters:
+            Passed to _params_combinations() to choose the keyword params
+            to run each test function with; see --grid.
+        resume:
+            If true and there is a checkpoint from an interrupted run, we
+            continue that run, skipping tests that it completed; see
+            --resume.
+        environment_start, calibration_start:
+            If not None, return values of environment() and calibrate_run()
+            from the start of the run, e.g. from before background builds
+            were started; see --build-background. Otherwise we call them
+            ourselves.
+        perf_counters:
+            If true we collect performance counters for each test; see
+            --perf-counters.
+
+    Returns results dict.
     '''
     time_now = time.time()
+    root = os.path.abspath(f'{__file__}/..')
 
     # Input files.
     #
     if paths:
-        pathnames = paths
+        pathnames = list(paths)
     else:
         pathnames = []
         for leaf in [
@@ -201,6 +807,9 @@ def performance(
     results['date'] = dict()
     results['date']['seconds'] = time_now
     results['date']['string'] = time.strftime("%Y-%m-%d-%H-%M", time.gmtime( time_now))
+    results['jobs'] = jobs
+    if builds is not None:
+        results['builds'] = builds
 
     # Find platform info. We use all items in the `platform` module that are
     # callable with no parameters. We exclude items whose names start with '_'
@@ -218,9 +827,16 @@ def performance(
         results['platform'][name] = value
         #log(f'Setting results["platform"]["{name}"] to: {value!r}')
 
-    # Find tool versions.
+    if environment_start is None:
+        environment_start = environment()
+
+    # Find tool versions. Tools whose builds are still pending are done by
+    # tool_ready() when the build has finished.
     #
-    for toolname in toolnames:
+    pending = pending or dict()
+    tool_lock = threading.Lock()
+
+    def tool_version(toolname):
         name = f'get_version_{toolname}'
         toolversion_fn = globals().get(name)
         if not toolversion_fn:
@@ -228,75 +844,808 @@ def performance(
         
         t, e, version, ee = multiprocessing_run(toolversion_fn, timeout=30, cprofile=cprofile)
         results['toolversions'][toolname] = ee if ee else version
+        log(f'toolversions[{toolname!r}]: {json.dumps(results["toolversions"][toolname], indent="    ", sort_keys=1)}')
+
+    def tool_ready(toolname):
+        '''
+        Waits for any pending build of `toolname`, and returns false if it
+        failed.
+        '''
+        future = pending.get(toolname)
+        if future:
+            ok = future.result()
+            with tool_lock:
+                if toolname not in results['toolversions']:
+                    if ok:
+                        tool_version(toolname)
+                    else:
+                        log(f'Dropping tests of {toolname=} because build failed.')
+                        results['toolversions'][toolname] = 'Build failed'
+            return ok
+        return True
+
+    for toolname in toolnames:
+        if toolname not in pending:
+            tool_version(toolname)
+
+    def corpus_fnname(fnname):
+        '''
+        Returns name of PyMuPDF variant of corpus function `fnname`. We use the
+        first PyMuPDF variant whose build has already finished successfully,
+        otherwise the installed pymupdf if there is one, so that we don't
+        wait for background builds (see --build-background). Otherwise we
+        wait for the first variant that builds successfully, or use the
+        default pymupdf if there are no variants.
+        '''
+        import importlib.util
+        toolnames2 = sorted(toolnames, key=lambda toolname: list(pending).index(toolname) if toolname in pending else -1)
+        for toolname in toolnames2:
+            future = pending.get(toolname)
+            if f'{fnname}_{toolname}' in globals() and (not future or future.done()) and tool_ready(toolname):
+                return f'{fnname}_{toolname}'
+        if importlib.util.find_spec('pymupdf'):
+            return fnname
+        for toolname in toolnames2:
+            if f'{fnname}_{toolname}' in globals() and tool_ready(toolname):
+                return f'{fnname}_{toolname}'
+        return fnname
+
+    # Generate synthetic input files.
+    #
+    sweep_paths = dict()    # Maps from path to list of `(param, value)`.
+    if sweeps:
+        generate_fnname = corpus_fnname('corpus_generate')
+        os.makedirs(f'{root}/corpus', exist_ok=1)
+        for param, values in sweeps:
+            for value in values:
+                params = {param: value}
+                path = os.path.relpath(f'{root}/corpus/{corpus.name(params)}')
+                if not os.path.exists(path):
+                    log(f'Generating {path=} with {generate_fnname}(): {params=}')
+                    t, e, ret, ee = multiprocessing_run(lambda: globals()[generate_fnname](path, **params), 600)
+                    if ee:
+                        raise Exception(f'Failed to generate {path=}: {ee}')
+                if path not in sweep_paths:
+                    # Files with all default params are in every sweep.
+                    sweep_paths[path] = list()
+                    pathnames.append(path)
+                sweep_paths[path].append((param, value))
 
     log(f'testnames:\n{json.dumps(list(testnames), indent="    ", sort_keys=1)}')
     log(f'toolnames:\n{json.dumps(list(toolnames), indent="    ", sort_keys=1)}')
     log(f'pathnames:\n{json.dumps(pathnames, indent="    ", sort_keys=1)}')
     log(f'toolversions:\n{json.dumps(results["toolversions"], indent="    ", sort_keys=1)}')
+    if pending:
+        log(f'Builds pending for: {", ".join(sorted(pending))}')
+
+    if tests or paths or tools or internal_check:
+        name_prefix = 'internal_results'
+    else:
+        name_prefix = 'results'
+    name = f'{name_prefix}-{time.strftime("%Y-%m-%d-%H-%M", time.gmtime( time_now))}.json'
+    name_latest = f'{name_prefix}-latest.json'
+    name_latest2 = os.path.relpath( os.path.abspath( f'{__file__}/../{name_latest}'))
+
+    # Each result is appended to a JSON Lines stream file as soon as it is
+    # available, and the checkpoint file says which run the stream belongs
+    # to, so that if we are killed, --resume can continue the run.
+    #
+    checkpoint_path = f'{root}/{name_prefix}-checkpoint.json'
+    checkpoint = None
+    resumed = dict()        # Maps from common.result_key() to result.
+    resumed_ab = dict()     # Maps from ab_key() to (results_, ab_item).
+    # Arguments that change which tests are run or how, stored in the
+    # checkpoint so that we don't mix results from different arguments. We
+    # round-trip through JSON so that we can compare with the checkpoint.
+    checkpoint_args = json.loads(json.dumps(dict(
+            tests=tests,
+            paths=paths,
+            tools=tools,
+            internal_check=internal_check,
+            timeout=timeout,
+            timeout_k=timeout_k,
+            warmup=warmup,
+            repeat=repeat,
+            repeat_ci=repeat_ci,
+            repeat_max=repeat_max,
+            repeat_budget=repeat_budget,
+            rss_interval=rss_interval,
+            jobs=jobs,
+            warm=warm,
+            scaling=scaling,
+            io_modes=io_modes,
+            sweeps=sweeps,
+            validate=validate,
+            ab=ab,
+            grid=grid,
+            grid_filters=grid_filters,
+            perf_counters=perf_counters,
+            )))
+
+    def ab_key(item):
+        '''
+        Returns key identifying the --ab group of test or result `item`.
+        '''
+        return item['testname'], item['path'], common.params_text(item.get('params')), item['start'], item['io']
+
+    if resume:
+        try:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except Exception as e:
+            log(f'Not resuming because cannot load {checkpoint_path=}: {e}')
+    if checkpoint and checkpoint.get('args') != checkpoint_args:
+        args_old = checkpoint.get('args') or dict()
+        differences = [
+                f'{k}: {args_old.get(k)!r} => {checkpoint_args.get(k)!r}'
+                for k in sorted(set(args_old) | set(checkpoint_args))
+                if args_old.get(k) != checkpoint_args.get(k)
+                ]
+        raise Exception(
+                f'Cannot resume {checkpoint["name"]} because arguments differ from the interrupted run:\n'
+                + ''.join(f'    {d}\n' for d in differences)
+                + f'Rerun with the same arguments, or remove {checkpoint_path}.'
+                )
+    if checkpoint:
+        name = checkpoint['name']
+        results['date']['seconds'] = checkpoint['date']
+        results['date']['string'] = time.strftime("%Y-%m-%d-%H-%M", time.gmtime(checkpoint['date']))
+        stream_path = f'{root}/{checkpoint["stream"]}'
+        lines = list()
+        with open(stream_path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # Last line will be incomplete if we were killed while
+                    # writing it.
+                    log(f'Ignoring invalid line in {stream_path}: {line!r}')
+                    continue
+                lines.append(line if line.endswith('\n') else line + '\n')
+                if 'ab' in item:
+                    # A/B groups are only ever resumed whole.
+                    resumed_ab[ab_key(item['ab'])] = item['data'], item['ab']
+                else:
+                    resumed[common.result_key(item['data'])] = item['data']
+        # Rewrite with just the valid lines, so that we can append.
+        with open(f'{stream_path}-', 'w') as f:
+            f.write(''.join(lines))
+        os.replace(f'{stream_path}-', stream_path)
+        log(f'Resuming {name} from {stream_path}.')
+        results['resumed'] = 0
+    else:
+        stream_path = f'{root}/{name[:-len(".json")]}.jsonl'
+        checkpoint = dict(
+                name=name,
+                date=time_now,
+                stream=os.path.relpath(stream_path, root),
+                completed=0,
+                args=checkpoint_args,
+                )
+        with open(stream_path, 'w') as f:
+            pass
+    stream = open(stream_path, 'a')
+    stream_lock = threading.Lock()
+
+    def checkpoint_write():
+        with open(f'{checkpoint_path}-', 'w') as f:
+            json.dump(checkpoint, f, indent='    ', sort_keys=1)
+        os.replace(f'{checkpoint_path}-', checkpoint_path)
+
+    def stream_write(**item):
+        '''
+        Appends `item` to the stream file and updates the checkpoint file.
+        '''
+        with stream_lock:
+            stream.write(json.dumps(item, sort_keys=1) + '\n')
+            stream.flush()
+            os.fsync(stream.fileno())
+            checkpoint['completed'] += len(item['data']) if 'ab' in item else 1
+            checkpoint_write()
+
+    checkpoint_write()
+
+    # Load results from previous run, if available.
+    #
+    previous = load_results(name_latest2)
+
+    if not io_modes:
+        io_modes = ['disk']
+    if 'memory' in io_modes:
+        for path in pathnames:
+            with open(path, 'rb') as f:
+                _io_input_data[path] = f.read()
 
     def all_tests():
         '''
-        Yields `(testname, path, toolname, fn)` for each test to run.
+        Yields a dict for each test to run, containing the same `testname`,
+        `path`, `toolname`, `params`, `start` and `io` items as the eventual
+        result, plus `pathname` (the path to pass to the test function) and
+        `fnname`.
         '''
+        starts = ['cold', 'warm'] if warm else ['cold']
         for testname in sorted(testnames):
             for path in pathnames:
                 for toolname in toolnames:
-                    fn = globals().get(f'do_{testname}_{toolname}')
-                    if fn:
-                        yield testname, path, toolname, fn
+                    fnname = f'do_{testname}_{toolname}'
+                    if fnname not in globals():
+                        continue
+                    fnname_base = f'do_{testname}_{_tool_base(toolname)}'
+                    for params in _params_combinations(fnname_base, grid, grid_filters):
+                        for io_mode in io_modes:
+                            if io_mode != 'disk' and fnname_base in _io_disk_only:
+                                continue
+                            if io_mode != 'disk' and _params_disk_only & set(params):
+                                continue
+                            for start in starts:
+                                yield dict(
+                                        testname=testname,
+                                        path=os.path.relpath(path, root),
+                                        toolname=toolname,
+                                        params=params,
+                                        start=start,
+                                        io=io_mode,
+                                        pathname=path,
+                                        fnname=fnname,
+                                        )
+
+    if py_spy and not shutil.which(py_spy):
+        log(f'Not creating flamegraphs because cannot find {py_spy=}.')
+        py_spy = None
+    if cprofile or py_spy:
+        profiles_dir = f'{root}/profiles/{name[:-len(".json")]}'
+        os.makedirs(profiles_dir, exist_ok=1)
 
-    # Run performance tests.
+    # Get summary of previous runs from history database.
     #
-    num_tests = 0
-    for _ in all_tests():
-        num_tests += 1
-    i = 0
-    for testname, path, toolname, fn in all_tests():
-        i += 1
-        log(f'### {i}/{num_tests}: {testname=} {path=} {toolname=} {fn.__name__=}')
-        if internal_check:
-            t, e, ret = 1, 0, None
+    timeout_default = 300
+    timeout_min = 10
+    calibrate_drift_max = 0.05
+    ab_repeat_min = 5
+    hopeless_timeouts = 3
+    hopeless_days = 7
+    history_summary = dict()
+    history_fingerprint = history.platform_fingerprint(results)
+    if history_path and os.path.exists(history_path):
+        history_summary = history.summary(history.connect(history_path))
+        log(f'Have loaded summary of {len(history_summary)} tests from {history_path=}.')
+        results['history'] = history_path
+
+    # Run performance tests. Tests of --ab tools are grouped so that tests
+    # that differ only in toolname are run together by run_ab().
+    #
+    items = list()
+    ab_groups = dict()
+    num_resumed = 0
+    for item in all_tests():
+        result = resumed.get(common.result_key(item))
+        if ab and item['toolname'] in ab:
+            ab_groups.setdefault(ab_key(item), list()).append(item)
+        elif result:
+            results['data'].append(result)
+            num_resumed += 1
         else:
-            if timeout:
-                timeout2 = timeout
-            elif 0 and fn.__name__ == 'do_copy_pypdf2':
-                timeout2 = 600
-            elif 0 and fn.__name__ == 'do_render_pdf2jpg':
-                timeout2 = 600
-            else:
-                timeout2 = 300
-            if 1:
-                t, e, ret, ee = multiprocessing_run(lambda : fn(path), timeout2)
-            else:
-                # Don't use multiprocessing.
-                log(f'### Not using multiprocessing.')
-                t0 = time.perf_counter()
-                ret = fn(path)
-                t = time.perf_counter() - t0
-                e = 0
-                ee = 0
-        log(f'### {i}/{num_tests}: {testname=} {path=} {toolname=} {fn.__name__=}: {t=} {ee=}')
-        root = os.path.abspath(f'{__file__}/..')
+            items.append(item)
+    if ab:
+        results['ab'] = list()
+    for key, group in list(ab_groups.items()):
+        results_, ab_item = resumed_ab.get(key, (None, None))
+        if ab_item and sorted(ab_item['toolnames']) == sorted(item['toolname'] for item in group):
+            results['data'] += results_
+            results['ab'].append(ab_item)
+            num_resumed += len(results_)
+            del ab_groups[key]
+    if 'resumed' in results:
+        log(f'Have resumed {num_resumed} completed tests.')
+        results['resumed'] = num_resumed
+    num_tests = len(items)
+    warm_workers = dict()
+
+    def item_text(item):
+        text = ' '.join(f'{k}={item[k]!r}' for k in ('testname', 'path', 'toolname', 'start', 'io'))
+        if item.get('params'):
+            text += f' params={common.params_text(item["params"])!r}'
+        return text
+
+    def item_setup(item):
+        '''
+        Returns `(fn, run, timeout2, repeat2, h)` for running test `item`,
+        where `h` is the test's history summary or None.
+        '''
+        # History only has tests with default params; see history.ingest().
+        h = None if item['params'] else history_summary.get((
+                item['testname'],
+                item['path'],
+                item['toolname'],
+                item['start'],
+                item['io'],
+                history_fingerprint,
+                ))
+        if timeout:
+            timeout2 = timeout
+        elif h and h['max']:
+            timeout2 = min(max(timeout_k * h['max'], timeout_min), timeout_default)
+        else:
+            timeout2 = timeout_default
+        repeat2 = repeat
+        if repeat_budget and h and h['median']:
+            repeat2 = max(1, min(repeat_max, int(repeat_budget / h['median'])))
+        args = item['io'], item['fnname'], item['params'], item['pathname']
+        if item['start'] == 'warm':
+            worker = warm_workers.setdefault(item['toolname'], WarmWorker(item['toolname']))
+            fn = '_io_call', args
+            run = worker.run
+        else:
+            fn = lambda : _io_call(*args)
+            run = multiprocessing_run
+        setup = _params_setups.get(f'do_{item["testname"]}_{_tool_base(item["toolname"])}')
+        if setup:
+            run0 = run
+            def run(*args, **kwargs):
+                setup(item['pathname'], **item['params'])
+                return run0(*args, **kwargs)
+        return fn, run, timeout2, repeat2, h
+
+    def run_item(i, item, cpu):
+        if not tool_ready(item['toolname']):
+            return None
+        log(f'### {i+1}/{num_tests}: {item_text(item)} {cpu=}')
+        fn, run, timeout2, repeat2, h = item_setup(item)
+        if (h
+                and h['timeouts'] >= hopeless_timeouts
+                and time_now - h['last_seconds'] < hopeless_days * 24 * 3600
+                ):
+            # Don't waste time on a test that is very likely to time out
+            # again. We retry after `hopeless_days` days, in case something
+            # has changed.
+            samples, ee, infos, t_failed = list(), f'Skipped: timed out in last {h["timeouts"]} runs', list(), None
+            log(f'### {i+1}/{num_tests}: {item_text(item)}: {ee}')
+        else:
+            samples, ee, infos, t_failed = run_samples(
+                    fn,
+                    timeout2,
+                    run=run,
+                    warmup=warmup,
+                    repeat=repeat2,
+                    repeat_ci=repeat_ci,
+                    repeat_max=repeat_max,
+                    internal_check=internal_check,
+                    rss_interval=rss_interval,
+                    cpu=cpu,
+                    perf_counters=perf_counters,
+                    )
+        return item_result(item, samples, ee, infos, t_failed, cpu, fn, run, timeout2)
+
+    def item_result(item, samples, ee, infos, t_failed, cpu, fn, run, timeout2):
+        '''
+        Returns result dict for test `item` from its timed runs, after doing
+        any extra untimed runs for validation and profiling.
+        '''
+        stats = _stats(samples)
+        t = stats['median'] if stats else None
+        fingerprints = None
+        if validate and not internal_check and not ee:
+            args = item['io'], item['fnname'], item['params'], item['pathname']
+            setup = _params_setups.get(f'do_{item["testname"]}_{_tool_base(item["toolname"])}')
+            if setup:
+                setup(item['pathname'], **item['params'])
+            _, _, fingerprints, ee2 = multiprocessing_run(lambda: _validate_call(*args), timeout2)
+            if ee2:
+                log(f'Failed to get output fingerprints for {item_text(item)}: {ee2}')
+                fingerprints = None
         result = dict(
-                testname=testname,
-                path=os.path.relpath(path, root),
-                toolname=toolname,
+                testname=item['testname'],
+                path=item['path'],
+                toolname=item['toolname'],
+                params=item['params'],
+                start=item['start'],
+                io=item['io'],
                 t=t,
                 e=ee,
+                t_failed=t_failed,
+                samples=samples,
+                stats=stats,
+                phases=_phases_median(infos),
+                memory=_memory_median(infos),
+                counters=_counters_median(infos),
+                pages=_pages_stats(infos, t),
+                cpu=cpu,
+                timeout=timeout2,
+                )
+        if validate:
+            result['fingerprints'] = fingerprints
+        # Profile extra untimed runs, so that profiling overhead does not
+        # affect timings.
+        leaf = re.sub('[^a-zA-Z0-9_.-]', '_', f'{item["testname"]}-{item["toolname"]}-{common.params_text(item["params"], "-")}-{item["start"]}-{item["io"]}-{item["path"]}')
+        if cprofile and not internal_check and not ee:
+            pstats_path = f'{profiles_dir}/{leaf}.pstats'
+            _, _, _, ee2 = run(fn, timeout2, cpu=cpu, cprofile=pstats_path)
+            if ee2:
+                log(f'Failed to profile {item_text(item)}: {ee2}')
+            else:
+                result['pstats'] = os.path.relpath(pstats_path, root)
+        if py_spy and not internal_check and not ee:
+            spy = PySpy(py_spy, f'{profiles_dir}/{leaf}.folded', f'{profiles_dir}/{leaf}.svg', item_text(item))
+            _, _, _, ee2 = run(fn, timeout2, cpu=cpu, attach=spy)
+            if spy.stop() and not ee2:
+                result['flamegraph'] = dict(
+                        folded=os.path.relpath(spy.folded_path, root),
+                        svg=os.path.relpath(spy.svg_path, root),
+                        )
+            else:
+                log(f'Failed to get flamegraph for {item_text(item)}: {ee2}')
+        return result
+
+    def run_ab(group, cpu):
+        '''
+        Runs tests in `group`, which differ only in toolname, in rounds. Each
+        round does one timed run of each test, in random order, so that
+        changes in the machine's speed during the run affect all tools
+        equally. Returns `(results_, ab_item)` where `results_` is a list of
+        result dicts and `ab_item` is an item for `results['ab']`.
+
+        `group` should contain at least two tests whose tools are ready.
+        '''
+        group = sorted(group, key=lambda item: ab.index(item['toolname']))
+        setups = [item_setup(item) for item in group]
+        # samples[j][r] is the time of group[j] in round r, or None if it
+        # failed or was not run, so that we only pair times from rounds in
+        # which both tools succeeded.
+        samples = [list() for item in group]
+        infos = [list() for item in group]
+        ees = [0 for item in group]
+        t_faileds = [None for item in group]
+        rounds_min = max([ab_repeat_min] + [repeat2 for fn, run, timeout2, repeat2, h in setups])
+        rng = random.Random()
+        order = list()
+        def pairs():
+            ret = list()
+            for i in range(len(group)):
+                for j in range(i + 1, len(group)):
+                    both = [(a, b) for a, b in zip(samples[i], samples[j]) if a is not None and b is not None]
+                    ret.append(dict(
+                            a=group[i]['toolname'],
+                            b=group[j]['toolname'],
+                            **compare.paired([a for a, b in both], [b for a, b in both], compare_threshold),
+                            ))
+            return ret
+        ab_text = ' '.join(f'{k}={group[0][k]!r}' for k in ('testname', 'path', 'start', 'io'))
+        if group[0]['params']:
+            ab_text += f' params={common.params_text(group[0]["params"])!r}'
+        for r in range(warmup + max(rounds_min, repeat_max)):
+            order_round = list(range(len(group)))
+            rng.shuffle(order_round)
+            for j in order_round:
+                if ees[j]:
+                    if r >= warmup:
+                        samples[j].append(None)
+                    continue
+                fn, run, timeout2, repeat2, h = setups[j]
+                samples2, ees[j], infos2, t_failed = run_samples(
+                        fn,
+                        timeout2,
+                        run=run,
+                        internal_check=internal_check,
+                        rss_interval=rss_interval,
+                        cpu=cpu,
+                        perf_counters=perf_counters,
+                        )
+                t_faileds[j] = t_failed
+                if r >= warmup:
+                    samples[j].append(samples2[0] if samples2 else None)
+                    infos[j] += infos2
+            if r < warmup:
+                continue
+            order.append([group[j]['toolname'] for j in order_round])
+            rounds = r + 1 - warmup
+            log(f'### A/B round {rounds}: {ab_text}: order: {" ".join(order[-1])}')
+            if all(ees):
+                break
+            if rounds < rounds_min:
+                continue
+            if repeat_ci is None:
+                break
+            # Stop when all paired differences are known precisely enough.
+            if all(p['ci95'] and (p['ci95'][1] - p['ci95'][0]) / 2 <= repeat_ci for p in pairs()):
+                break
+        results_ = list()
+        for item, (fn, run, timeout2, repeat2, h), samples2, ee, infos2, t_failed in zip(group, setups, samples, ees, infos, t_faileds):
+            samples2 = [t for t in samples2 if t is not None]
+            result = item_result(item, samples2, ee, infos2, t_failed, cpu, fn, run, timeout2)
+            result['concurrency'] = 1
+            results_.append(result)
+        ab_item = dict(
+                testname=group[0]['testname'],
+                path=group[0]['path'],
+                params=group[0]['params'],
+                start=group[0]['start'],
+                io=group[0]['io'],
+                toolnames=[item['toolname'] for item in group],
+                rounds=len(order),
+                order=order,
+                pairs=pairs(),
                 )
+        return results_, ab_item
+
+    def on_result(i, result):
+        if result is None:
+            return
+        t = result['t']
+        ee = result['e']
+        n = len(result['samples'])
+        log(f'### {i+1}/{num_tests}: {item_text(items[i])}: {t=} {n=} {ee=}')
         results['data'].append(result)
+        stream_write(data=result)
+
+    expected = dict()
+    if previous:
+        for result in previous['data']:
+            expected[common.result_key(result)] = result['t']
+
+    def order_key(i, item):
+        # Run tests of tools with pending builds last, in the order that the
+        # builds were started.
+        toolnames_pending = list(pending)
+        toolname = item['toolname']
+        pending_index = toolnames_pending.index(toolname) + 1 if toolname in pending else 0
+        if jobs > 1:
+            # Longest first. Tests with no previous time, or that previously
+            # failed or timed out, are assumed to be slow.
+            t = expected.get(common.result_key(item))
+            return pending_index, -(t if t is not None else math.inf)
+        return pending_index, i
+
+    def warm_group(i, item):
+        # Tests of a tool's WarmWorker are run one at a time, so we make sure
+        # schedule() doesn't run them concurrently and record that.
+        return item['toolname'] if item['start'] == 'warm' else None
+
+    def run_calibrate():
+        if internal_check:
+            return None
+        return calibrate_run(cpus[0] if cpus else None, pending)
+
+    def run_ab_group(n, key, group):
+        '''
+        Runs A/B group `group` with run_ab(). If fewer than two of its tools
+        built successfully we can't do an A/B comparison, so instead we return
+        list of the group's remaining tests to be run on their own.
+        '''
+        group = [item for item in group if tool_ready(item['toolname'])]
+        if len(group) < 2:
+            log(f'*** Warning: not running A/B {n+1}/{len(ab_groups)}: {key} because fewer than two tools'
+                    f' are ready, running remaining tests on their own: {[item["toolname"] for item in group]}'
+                    )
+            ret = list()
+            for item in group:
+                # These are written as ordinary results by on_result(), so a
+                # resumed run finds them in `resumed`, not `resumed_ab`.
+                result = resumed.get(common.result_key(item))
+                if result:
+                    results['data'].append(result)
+                    if 'resumed' in results:
+                        results['resumed'] += 1
+                else:
+                    ret.append(item)
+            return ret
+        log(f'### A/B {n+1}/{len(ab_groups)}: {key} toolnames={[item["toolname"] for item in group]}')
+        results_, ab_item = run_ab(group, cpus[0] if cpus else None)
+        results['data'] += results_
+        results['ab'].append(ab_item)
+        # The group's results are written together, so that a resumed run
+        # either skips or reruns the whole group.
+        stream_write(data=results_, ab=ab_item)
+        return list()
+
+    # Like order_key(), we run A/B groups with tools whose builds are still
+    # pending after all other tests, in the order that the builds were
+    # started, so that with --build-background we don't wait for builds
+    # while there are other tests to run.
+    #
+    ab_groups_ready = list()
+    ab_groups_pending = list()
+    for n, (key, group) in enumerate(sorted(ab_groups.items())):
+        toolnames_pending = [
+                item['toolname']
+                for item in group
+                if item['toolname'] in pending and not pending[item['toolname']].done()
+                ]
+        if toolnames_pending:
+            pending_index = max(list(pending).index(toolname) for toolname in toolnames_pending)
+            ab_groups_pending.append((pending_index, n, key, group))
+        else:
+            ab_groups_ready.append((n, key, group))
+    ab_groups_pending.sort(key=lambda x: x[:2])
+
+    if calibration_start is None:
+        calibration_start = run_calibrate()
+    try:
+        for n, key, group in ab_groups_ready:
+            items += run_ab_group(n, key, group)
+            num_tests = len(items)
+        schedule(items, run_item, on_result, jobs, order_key, cpus, warm_group)
+        for pending_index, n, key, group in ab_groups_pending:
+            for item in run_ab_group(n, key, group):
+                items.append(item)
+                num_tests = len(items)
+                on_result(num_tests - 1, run_item(num_tests - 1, item, cpus[0] if cpus else None))
+        if ab:
+            log(compare.ab_report(results['ab']))
+    finally:
+        for worker in warm_workers.values():
+            worker.stop()
+        # Make sure all builds have finished before we write results.
+        for toolname in pending:
+            tool_ready(toolname)
+    calibration_end = run_calibrate()
+
+    # Record machine state and speed, and normalise times using the machine
+    # score.
+    #
+    results['environment'] = dict(start=environment_start, end=environment())
+    results['calibration'] = dict(start=calibration_start, end=calibration_end)
+    if calibration_start and calibration_end:
+        score = (calibration_start['score'] + calibration_end['score']) / 2
+        drift = calibration_end['score'] / calibration_start['score'] - 1
+        results['calibration']['score'] = score
+        results['calibration']['drift'] = drift
+        results['calibration']['drifted'] = abs(drift) > calibrate_drift_max
+        if results['calibration']['drifted']:
+            log(f'*** Warning: machine speed changed by {drift*100:+.1f}% during run, e.g. because of thermal'
+                    f' throttling or other processes; loadavg was {environment_start["loadavg"]} at start'
+                    f' and {results["environment"]["end"]["loadavg"]} at end.'
+                    )
+        for result in results['data']:
+            if result['t'] and not result['e']:
+                result['t_normalised'] = result['t'] * score / 1000
+
+    # Check output fingerprints against reference and between PyMuPDF
+    # variants.
+    #
+    if validate:
+        reference = dict()
+        if validate_reference and os.path.exists(validate_reference):
+            with open(validate_reference) as f:
+                reference = json.load(f)
+        groups = dict()
+        for result in results['data']:
+            if not result.get('fingerprints'):
+                continue
+            result['diverged'] = list()
+            key = f'{result["testname"]} {result["path"]} {_tool_base(result["toolname"])}'
+            if result['params']:
+                key += f' {common.params_text(result["params"])}'
+            if key in reference:
+                for d in _fingerprints_diff(reference[key], result['fingerprints']):
+                    result['diverged'].append(f'reference: {d}')
+            groups.setdefault((key, result['io']), list()).append(result)
+        for rr in groups.values():
+            rr.sort(key=lambda r: (r['toolname'], r['start']))
+            for r in rr[1:]:
+                if r['toolname'] == rr[0]['toolname']:
+                    continue
+                for d in _fingerprints_diff(rr[0]['fingerprints'], r['fingerprints']):
+                    rr[0]['diverged'].append(f'{r["toolname"]}: {d}')
+                    r['diverged'].append(f'{rr[0]["toolname"]}: {d}')
+        num_diverged = 0
+        for result in results['data']:
+            if result.get('diverged'):
+                num_diverged += 1
+                log(f'*** Output diverged: {item_text(result)}: {"; ".join(result["diverged"])}')
+        results['validation'] = dict(reference=validate_reference, diverged=num_diverged)
+        if validate_reference and not reference:
+            for (key, io_mode), rr in sorted(groups.items()):
+                reference.setdefault(key, rr[0]['fingerprints'])
+            with open(validate_reference, 'w') as f:
+                json.dump(reference, f, indent='    ', sort_keys=1)
+            log(f'Have written reference fingerprints to: {validate_reference}')
+
+    # Get information about input files from corpus manifest, and normalise
+    # times to throughput. We do this after running tests so that we don't
+    # have to wait for a PyMuPDF build before starting.
+    #
+    describe_fnname = corpus_fnname('corpus_describe')
+    def describe(path):
+        t, e, ret, ee = multiprocessing_run(lambda: globals()[describe_fnname](path), 600)
+        if ee:
+            log(f'Not adding {path=} to corpus manifest because {describe_fnname}() failed: {ee}')
+            return None
+        return ret
+    manifest = corpus.manifest(pathnames, f'{root}/corpus-manifest.json', describe)
+    results['manifest'] = {os.path.relpath(path, root): entry for path, entry in manifest.items()}
+    categories = dict()
+    for result in results['data']:
+        entry = results['manifest'].get(result['path'])
+        if not entry:
+            continue
+        result['category'] = entry['category']
+        t = result['t']
+        if result['e'] or not t:
+            continue
+        result['pages_per_sec'] = entry['pages'] / t
+        result['mb_per_sec'] = entry['size'] / 1e6 / t
+        if result['params']:
+            # Categories summarise tests with default params.
+            continue
+        key = entry['category'], result['testname'], result['toolname'], result['start'], result['io']
+        categories.setdefault(key, list()).append(result)
+    results['categories'] = list()
+    for (category, testname, toolname, start, io_mode), rr in sorted(categories.items()):
+        results['categories'].append(dict(
+                category=category,
+                testname=testname,
+                toolname=toolname,
+                start=start,
+                io=io_mode,
+                n=len(rr),
+                pages_per_sec=stats.percentile(sorted(r['pages_per_sec'] for r in rr), 50),
+                mb_per_sec=stats.percentile(sorted(r['mb_per_sec'] for r in rr), 50),
+                ))
+
+    # Fit scaling curves for synthetic input files.
+    #
+    if sweeps:
+        results['sweeps'] = list()
+        groups = dict()
+        for result in results['data']:
+            path = os.path.relpath(f'{root}/{result["path"]}')
+            if result['e'] or result['params']:
+                continue
+            for param, value in sweep_paths.get(path, list()):
+                key = param, result['testname'], result['toolname'], result['start'], result['io']
+                groups.setdefault(key, list()).append([value, result['t']])
+        for (param, testname, toolname, start, io_mode), points in sorted(groups.items()):
+            points.sort()
+            sweep = dict(param=param, testname=testname, toolname=toolname, start=start, io=io_mode, points=points)
+            fit = corpus.fit_power_law([x for x, t in points], [t for x, t in points])
+            if fit:
+                sweep['a'], sweep['b'], sweep['r2'] = fit
+                sweep['superlinear'] = sweep['b'] > 1.1
+                log(f'Sweep {param=} {testname=} {toolname=} {start=} {io_mode=}: t = {sweep["a"]:.3g} * {param}**{sweep["b"]:.3f}, r2={sweep["r2"]:.3f}{" SUPERLINEAR" if sweep["superlinear"] else ""}')
+            results['sweeps'].append(sweep)
+
+    # Run scaling tests.
+    #
+    if scaling:
+        results['scaling'] = list()
+        for testname in sorted(testnames):
+            for path in pathnames:
+                for toolname in sorted(toolnames):
+                    fn = globals().get(f'scale_{testname}_{toolname}')
+                    if not fn or not tool_ready(toolname):
+                        continue
+                    log(f'### Scaling: {testname=} {path=} {toolname=} {scaling=}')
+                    curve = run_scaling(
+                            fn,
+                            path,
+                            scaling,
+                            timeout or 300,
+                            repeat=repeat,
+                            internal_check=internal_check,
+                            )
+                    log(f'### Scaling: {testname=} {path=} {toolname=}:\n{json.dumps(curve, indent="    ")}')
+                    results['scaling'].append(dict(
+                            testname=testname,
+                            path=os.path.relpath(path, root),
+                            toolname=toolname,
+                            curve=curve,
+                            ))
+
+    # Compare with previous results.
+    #
+    if compare_with:
+        baseline = previous if compare_with == 'previous' else load_results(compare_with)
+        if baseline:
+            comparison = compare.compare(baseline, results, compare_threshold, compare_alpha)
+            results['comparison'] = comparison
+            log(compare.report(comparison))
+        else:
+            log(f'Not comparing results because cannot load baseline {compare_with=}.')
 
     # Show results.
     #
     log(f'results:\n{json.dumps(results, indent="    ", sort_keys=1)}')
 
-    if tests or paths or tools or internal_check:
-        name_prefix = 'internal_results'
-    else:
-        name_prefix = 'results'
-    name = f'{name_prefix}-{time.strftime("%Y-%m-%d-%H-%M", time.gmtime( time_now))}.json'
-    name_latest = f'{name_prefix}-latest.json'
-    
     # Push results to Github results repository.
     #
     github.addpush_json(results, name, name_latest)
@@ -304,7 +1653,6 @@ def performance(
     # Save results locally.
     #
     name2 = os.path.relpath( os.path.abspath( f'{__file__}/../{name}'))
-    name_latest2 = os.path.relpath( os.path.abspath( f'{__file__}/../{name_latest}'))
     with open(name2, 'w') as f:
         json.dump(results, f, indent='    ', sort_keys=1)
     log(f'Have written results to: {name2}')
@@ -315,112 +1663,1443 @@ def performance(
     os.symlink(name, name_latest2)
     log(f'Have created symlink: {name_latest} -> {name}')
 
+    # Add this run's results to the history database, so that later runs can
+    # use them to choose timeouts and repetitions. Results from --internal-check
+    # are not real times so we don't add them.
+    #
+    if history_path and not internal_check:
+        history.ingest(history.connect(history_path), [name2])
 
-def multiprocessing_run(fn, timeout, cprofile=False):
-    '''
-    Runs `fn()` in a separate process using Python's `multiprocessing`
-    module.
-    
-    Returns (t, e, ret, ee):
-        t: is the time in seconds to run fn().
-        
-        e: 0 on success, or None on timeout, or non-zero exit code from
-        multiprocessing.Process, or an Exception instance raised by internal
-        call of pickle.load().
-        
-        ret: Value returned by, or exception raised by, fn(). None if timeout
-        or multiprocessing.Process invocation failed.
-        
-        ee: Convenience error information. A non-empty error description string
-        if e is not 0 or ret is an Exception instance; otherwise 0.
-    '''
-    # We don't use a multiprocessing.Queue() to read version from child
-    # process, because multiprocessing.Queue.get() hangs if the child
-    # process fails. Instead we use a temporary file; this requires that
-    # toolversions_fn() calls temp_file.flush() (or .close()) before returning,
-    # otherwise we can get error from pickle.load().
+    # The run is complete, so we no longer need the checkpoint.
     #
-    with tempfile.TemporaryFile() as temp_file:
-        def fn2(fn, temp_file):
-            # BTW trying to get austin to profile the current process with
-            # `f'austin -C -p {os.getpid()} -o out-austin2 &'` doesn't seem to
-            # generate any useful data.
-            if cprofile:
-                import cProfile
-                import pstats
-                with cProfile.Profile() as pr:
-                    try:
-                        ret = fn()
-                    except Exception as e:
-                        ret = e
-                ps = pstats.Stats(pr)
-                ps.sort_stats('calls', 'filename')
-                ps.print_stats()
-            else:
-                try:
-                    ret = fn()
-                except Exception as e:
-                    ret = e
-            if 0:
-                # Output extra resource usage information.
-                import resource
-                rusage = resource.getrusage( resource.RUSAGE_SELF)
-                print(f'{rusage=}')
-            pickle.dump(ret, temp_file)
-            temp_file.flush()
-        p = multiprocessing.Process(target=fn2, args=(fn, temp_file))
-        t0 = time.perf_counter()
-        p.start()
-        p.join(timeout)
-        t = time.perf_counter() - t0
-        #log(f'multiprocessing_run {fn=} {timeout=}: {p.exitcode=}')
-        if p.exitcode is None:
-            # Timeout.
-            #log(f'Multiprocessing timeout.')
-            e = None
-            ret = None
-            p.terminate()
-            p.join(10)
-            if p.exitcode is None:
-                p.kill()
-                p.join(10)
-                if p.exitcode is None:
-                    raise Exception(f'Cannot terminate multiprocess running {fn.__name__}')
-        else:
-            temp_file.seek(0)
-            e = 0
-            ret = None
-            try:
-                ret = pickle.load(temp_file)
-            except Exception as ee:
-                e = ee
-            if p.exitcode:
-                e = p.exitcode
-        if e is None:
-            ee = 'Timeout'
-        elif e != 0:
-            ee = f'multiprocessing.Process failure {e=}'
-        elif isinstance(ret, Exception):
-            ee = f'{type(ret)}: {ret}'
-        else:
-            ee = 0
-        return t, e, ret, ee
+    stream.close()
+    os.remove(checkpoint_path)
+    os.remove(stream_path)
+    return results
 
 
-def _import_pymupdf(install_dir):
+def environment():
     '''
-    Imports `pymupdf` from directory `install` by temporarily modifying
-    `sys.path`.
+    Returns dict describing the machine's current state, for comparing
+    results from different machines or runs. Items that cannot be found on
+    this platform are None.
+
+        'cpu_model': str        # From /proc/cpuinfo.
+        'cpu_count': int        # Number of CPUs.
+        'cpus_available': int   # Number of CPUs we are allowed to use.
+        'cpu_mhz': [min, max]   # Current frequency range of CPUs.
+        'governors': {governor: count}
+                                # Number of CPUs using each cpufreq governor.
+        'turbo': bool           # Whether turbo/boost is enabled.
+        'loadavg': [float, float, float]
+        'memory_total_kb': int
+        'memory_available_kb': int
+    '''
+    def read(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except Exception:
+            return None
+    ret = dict()
+
+    ret['cpu_model'] = None
+    cpu_mhz = list()
+    for line in (read('/proc/cpuinfo') or '').split('\n'):
+        name, _, value = line.partition(':')
+        name = name.strip()
+        if name == 'model name' and not ret['cpu_model']:
+            ret['cpu_model'] = value.strip()
+        elif name == 'cpu MHz':
+            cpu_mhz.append(float(value))
+    ret['cpu_count'] = os.cpu_count()
+    try:
+        ret['cpus_available'] = len(os.sched_getaffinity(0))
+    except Exception:
+        ret['cpus_available'] = None
+
+    governors = dict()
+    for cpu in range(os.cpu_count() or 0):
+        cpufreq = f'/sys/devices/system/cpu/cpu{cpu}/cpufreq'
+        governor = read(f'{cpufreq}/scaling_governor')
+        if governor:
+            governors[governor] = governors.get(governor, 0) + 1
+        khz = read(f'{cpufreq}/scaling_cur_freq')
+        if khz:
+            cpu_mhz.append(int(khz) / 1000)
+    ret['governors'] = governors or None
+    ret['cpu_mhz'] = [min(cpu_mhz), max(cpu_mhz)] if cpu_mhz else None
+
+    no_turbo = read('/sys/devices/system/cpu/intel_pstate/no_turbo')
+    boost = read('/sys/devices/system/cpu/cpufreq/boost')
+    if no_turbo is not None:
+        ret['turbo'] = no_turbo == '0'
+    elif boost is not None:
+        ret['turbo'] = boost == '1'
+    else:
+        ret['turbo'] = None
+
+    try:
+        ret['loadavg'] = list(os.getloadavg())
+    except Exception:
+        ret['loadavg'] = None
+
+    ret['memory_total_kb'] = None
+    ret['memory_available_kb'] = None
+    for line in (read('/proc/meminfo') or '').split('\n'):
+        name, _, value = line.partition(':')
+        if name == 'MemTotal':
+            ret['memory_total_kb'] = int(value.split()[0])
+        elif name == 'MemAvailable':
+            ret['memory_available_kb'] = int(value.split()[0])
+    return ret
+
+
+# Times taken by calibrate()'s workloads on a reference machine (a 2.1GHz
+# Xeon cloud VM with Python 3.11), used to calculate machine scores.
+#
+_calibrate_reference = dict(
+        python=0.045,
+        sha256=0.026,
+        zlib=0.040,
+        sort=0.021,
+        )
+
+
+def calibrate(repeat=5):
+    '''
+    Runs a fixed set of short workloads `repeat` times, and returns dict with
+    the median time of each workload and `score`, the geometric mean of
+    reference time divided by our time, times 1000. So a machine the same
+    speed as the reference machine has a score of 1000, and a machine twice
+    as fast has a score of 2000.
+
+    The workloads cover interpreter speed (python), C code with little memory
+    traffic (sha256, zlib) and memory allocation and access (sort).
+    '''
+    import random
+    import zlib
+    data = bytes(random.Random(0).getrandbits(8) for _ in range(1 << 16)) * 64
+    values = [random.Random(1).random() for _ in range(500000)]
+    def python():
+        x = 0
+        for i in range(500000):
+            x = (x * 31 + i) % 1000003
+    def sha256():
+        for _ in range(8):
+            hashlib.sha256(data).digest()
+    def zlib_():
+        zlib.compress(data, 6)
+        zlib.compress(data, 6)
+    def sort():
+        for _ in range(5):
+            sorted(values)
+    ret = dict()
+    for name, fn in ('python', python), ('sha256', sha256), ('zlib', zlib_), ('sort', sort):
+        ts = list()
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            ts.append(time.perf_counter() - t0)
+        ret[name] = stats.percentile(sorted(ts), 50)
+    ret['score'] = 1000 * math.exp(
+            sum(math.log(_calibrate_reference[name] / ret[name]) for name in _calibrate_reference)
+            / len(_calibrate_reference)
+            )
+    return ret
+
+
+def calibrate_run(cpu=None, pending=None):
+    '''
+    Runs calibrate() in a child process on `cpu`. Returns calibrate()'s dict
+    with extra item 'builds_running', a list of names of builds in `pending`
+    that had not finished, or None if calibration failed.
+    '''
+    builds_running = sorted(name for name, future in (pending or dict()).items() if not future.done())
+    t, e, ret, ee = multiprocessing_run(calibrate, 120, cpu=cpu)
+    if ee:
+        log(f'Calibration failed: {ee}')
+        return None
+    ret['builds_running'] = builds_running
+    log(f'Calibration: {ret}')
+    return ret
+
+
+def _tool_base(toolname):
+    '''
+    Returns name of the tool that `toolname` is a variant of, e.g. 'pymupdf'
+    for 'pymupdf_mupdf_master'.
+    '''
+    if toolname.startswith('pymupdf_'):
+        return 'pymupdf'
+    return toolname
+
+
+def load_results(path):
+    '''
+    Returns results dict loaded from JSON file `path`, or None if `path` does
+    not exist or cannot be read.
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        log(f'Cannot load results from {path=}: {e}')
+        return None
+
+
+# Queue of requests for the main thread to start a multiprocessing.Process,
+# while _threads_run() is running threads; see _process_start().
+_process_start_queue = None
+
+
+def _process_start(process):
+    '''
+    Calls `process.start()` for multiprocessing.Process `process`.
+
+    If we are in a thread started by _threads_run(), we get the main thread to
+    do this and wait for it. This only serialises forks in one thread; other
+    threads keep running and may hold arbitrary locks when we fork, so it
+    does not make forking from a multi-threaded process safe in general. The
+    one lock that test children are known to share with the parent is
+    log()'s, which the os.register_at_fork() handlers for `_log_lock` take
+    care of, so a child never inherits a locked stdout.
+    '''
+    queue_ = _process_start_queue
+    if queue_ is None or threading.current_thread() is threading.main_thread():
+        process.start()
+        return
+    done = threading.Event()
+    exceptions = list()
+    queue_.put((process, done, exceptions))
+    done.wait()
+    if exceptions:
+        raise exceptions[0]
+
+
+def _threads_run(fns):
+    '''
+    Calls each function in `fns` in a separate thread, and waits for them all
+    to return. Child processes started by the threads with _process_start()
+    are started by the calling thread, which should be the main thread.
+    '''
+    global _process_start_queue
+    import queue
+    if _process_start_queue is not None:
+        # We are in a thread of an outer _threads_run(), whose main thread
+        # will start processes for our threads too.
+        threads = [threading.Thread(target=fn) for fn in fns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return
+    assert threading.current_thread() is threading.main_thread()
+    _process_start_queue = queue.Queue()
+    def fn2(fn):
+        try:
+            fn()
+        finally:
+            _process_start_queue.put(None)
+    threads = [threading.Thread(target=fn2, args=(fn,)) for fn in fns]
+    for thread in threads:
+        thread.start()
+    num_running = len(threads)
+    while num_running:
+        request = _process_start_queue.get()
+        if request is None:
+            num_running -= 1
+            continue
+        process, done, exceptions = request
+        try:
+            process.start()
+        except Exception as e:
+            exceptions.append(e)
+        done.set()
+    for thread in threads:
+        thread.join()
+    _process_start_queue = None
+
+
+def schedule(items, run_item, on_result, jobs, order_key=None, cpus=None, group_key=None):
+    '''
+    Runs `run_item()` for each item in `items`, using up to `jobs` threads.
+
+    Args:
+        items:
+            List of items.
+        run_item:
+            Called as `run_item(i, items[i], cpu)`, should return a dict, or
+            None if the item was skipped. `cpu` is None if `jobs` is 1 and
+            `cpus` is None, otherwise the CPU number to which the child
+            process should be pinned. We set `concurrency` in the returned dict to the maximum
+            number of items that were running at the same time.
+        on_result:
+            Called as `on_result(i, result)` for each item, where `result` is
+            the dict (or None) returned by `run_item()`. Always called in
+            order of increasing `i`, and never concurrently.
+        jobs:
+            Maximum number of items to run at the same time. If greater than
+            1, each running item is given a different CPU.
+        order_key:
+            If not None, called as `order_key(i, items[i])`; we start items in
+            order of increasing key.
+        cpus:
+            If not None, list of CPUs to use; if `jobs` is 1 we use the first
+            one. Otherwise if `jobs` is greater than 1 we use all available
+            CPUs.
+        group_key:
+            If not None, called as `group_key(i, items[i])`; items with the
+            same key, other than None, are never run at the same time, for
+            example because they share a WarmWorker.
+
+    Child processes should be started with _process_start(); see
+    _threads_run().
+    '''
+    import queue
+
+    order = list(range(len(items)))
+    if order_key:
+        order.sort(key=lambda i: order_key(i, items[i]))
+    if jobs > 1:
+        if not cpus:
+            cpus = sorted(os.sched_getaffinity(0))
+        if jobs > len(cpus):
+            log(f'Reducing {jobs=} to number of available cpus {len(cpus)}.')
+            jobs = len(cpus)
+    elif not cpus:
+        cpus = [None]
+
+    lock = threading.Condition()
+    free_cpus = queue.Queue()
+    for cpu in cpus[:jobs]:
+        free_cpus.put(cpu)
+    running = dict()    # Maps from item index to max concurrency.
+    groups = set()      # group_key() of running items.
+    done = dict()       # Maps from item index to result.
+    next_on_result = 0
+    exceptions = list()
+
+    def group(i):
+        return group_key(i, items[i]) if group_key else None
+
+    def thread_fn():
+        nonlocal next_on_result
+        while 1:
+            with lock:
+                while 1:
+                    if not order or exceptions:
+                        return
+                    # First item that is not in the same group as a
+                    # running item.
+                    k = next((k for k, i in enumerate(order) if group(i) is None or group(i) not in groups), None)
+                    if k is not None:
+                        break
+                    lock.wait()
+                i = order.pop(k)
+                if group(i) is not None:
+                    groups.add(group(i))
+                running[i] = 0
+                for j in running:
+                    running[j] = max(running[j], len(running))
+            cpu = free_cpus.get()
+            try:
+                result = run_item(i, items[i], cpu)
+                with lock:
+                    concurrency = running.pop(i)
+                    groups.discard(group(i))
+                    if result is not None:
+                        result['concurrency'] = concurrency
+                    done[i] = result
+                    while next_on_result in done:
+                        on_result(next_on_result, done.pop(next_on_result))
+                        next_on_result += 1
+                    lock.notify_all()
+            except Exception as e:
+                with lock:
+                    exceptions.append(e)
+                    lock.notify_all()
+                return
+            finally:
+                free_cpus.put(cpu)
+
+    if jobs == 1:
+        thread_fn()
+    else:
+        _threads_run([thread_fn] * jobs)
+    if exceptions:
+        raise exceptions[0]
+
+
+def multiprocessing_run(fn, timeout, cprofile=False, info=None, rss_interval=None, cpu=None, attach=None, perf_counters=False):
+    '''
+    Runs `fn()` in a separate process using Python's `multiprocessing`
+    module.
+
+    If `info` is not None, it should be a dict and we set `info['phases']` to a
+    dict mapping from phase name to elapsed time. This will contain items
+    for `spawn`, `exit` and `other`, plus any phases recorded by `fn()` using
+    `phase()`, and `info['pages']` to a list of `[page number, time]` recorded
+    by `timed_page()`. We also set `info['memory']` to a dict containing the child
+    process's peak RSS, page faults and context switches; if `rss_interval`
+    is not None this also contains `rss_timeline`, a list of `[t, rss_kb]`
+    recorded every `rss_interval` seconds. And we set `info['counters']` to
+    the child's performance counters while running `fn()` if `perf_counters`
+    is true, or None if not available or `perf_counters` is false; see
+    _PerfCounters.
+
+    If `cpu` is not None, the child process is pinned to CPU number `cpu`.
+
+    If `cprofile` is a string, we run `fn()` with cProfile and write the
+    profile to file `cprofile` in pstats format. Otherwise if `cprofile` is
+    true, we print the profile to stdout.
+
+    If `attach` is not None, we call `attach(pid)` after starting the child
+    process, and the child process waits for this to return before calling
+    `fn()`. This allows an external profiler to attach to the child before it
+    does anything interesting; see PySpy.
+    
+    Returns (t, e, ret, ee):
+        t: is the time in seconds to run fn().
+        
+        e: 0 on success, or None on timeout, or non-zero exit code from
+        multiprocessing.Process, or an Exception instance raised by internal
+        call of pickle.load().
+        
+        ret: Value returned by, or exception raised by, fn(). None if timeout
+        or multiprocessing.Process invocation failed.
+        
+        ee: Convenience error information. A non-empty error description string
+        if e is not 0 or ret is an Exception instance; otherwise 0.
+    '''
+    # We don't use a multiprocessing.Queue() to read version from child
+    # process, because multiprocessing.Queue.get() hangs if the child
+    # process fails. Instead we use a temporary file; this requires that
+    # toolversions_fn() calls temp_file.flush() (or .close()) before returning,
+    # otherwise we can get error from pickle.load().
+    #
+    with tempfile.TemporaryFile() as temp_file:
+        attached = multiprocessing.Event() if attach else None
+        def fn2(fn, temp_file):
+            if attached:
+                attached.wait()
+            t_child_start = time.perf_counter()
+            if cpu is not None:
+                os.sched_setaffinity(0, {cpu})
+            _child_info_reset()
+            # Our peak RSS starts off including pages inherited from the
+            # parent, so we report the increase.
+            maxrss_kb0 = _rusage()['maxrss_kb']
+            sampler = _RssSampler(rss_interval) if rss_interval else None
+            counters = _PerfCounters() if perf_counters else None
+            # BTW trying to get austin to profile the current process with
+            # `f'austin -C -p {os.getpid()} -o out-austin2 &'` doesn't seem to
+            # generate any useful data. Instead use `attach`, so that the
+            # profiler is attached by the parent before we start.
+            if cprofile:
+                import cProfile
+                import pstats
+                with cProfile.Profile() as pr:
+                    try:
+                        ret = fn()
+                    except Exception as e:
+                        ret = e
+                if isinstance(cprofile, str):
+                    pr.dump_stats(cprofile)
+                else:
+                    ps = pstats.Stats(pr)
+                    ps.sort_stats('calls', 'filename')
+                    ps.print_stats()
+            else:
+                try:
+                    ret = fn()
+                except Exception as e:
+                    ret = e
+            _child_info['counters'] = counters.stop() if counters else None
+            memory = _rusage()
+            memory['maxrss_kb'] -= maxrss_kb0
+            if sampler:
+                memory['rss_timeline'] = sampler.stop()
+            _child_info['memory'] = memory
+            _child_info['t_child_start'] = t_child_start
+            _child_info['t_child_end'] = time.perf_counter()
+            pickle.dump((ret, _child_info), temp_file)
+            temp_file.flush()
+        p = multiprocessing.Process(target=fn2, args=(fn, temp_file))
+        t0 = time.perf_counter()
+        _process_start(p)
+        if attach:
+            try:
+                attach(p.pid)
+            finally:
+                attached.set()
+        p.join(timeout)
+        t = time.perf_counter() - t0
+        #log(f'multiprocessing_run {fn=} {timeout=}: {p.exitcode=}')
+        if p.exitcode is None:
+            # Timeout.
+            #log(f'Multiprocessing timeout.')
+            e = None
+            ret = None
+            p.terminate()
+            p.join(10)
+            if p.exitcode is None:
+                p.kill()
+                p.join(10)
+                if p.exitcode is None:
+                    raise Exception(f'Cannot terminate multiprocess running {fn.__name__}')
+        else:
+            temp_file.seek(0)
+            e = 0
+            ret = None
+            child_info = None
+            try:
+                ret, child_info = pickle.load(temp_file)
+            except Exception as ee:
+                e = ee
+            if info is not None and child_info:
+                # time.perf_counter() uses a system-wide monotonic clock on
+                # Linux and BSD, so we can compare the child's timestamps with
+                # our own.
+                phases = dict()
+                phases['spawn'] = child_info['t_child_start'] - t0
+                phases.update(child_info['phases'])
+                phases['exit'] = t0 + t - child_info['t_child_end']
+                phases['other'] = t - sum(phases.values())
+                info['phases'] = phases
+                info['memory'] = child_info['memory']
+                info['pages'] = child_info['pages']
+                info['counters'] = child_info['counters']
+            if p.exitcode:
+                e = p.exitcode
+        return t, e, ret, _error_text(e, ret)
+
+
+def _error_text(e, ret):
+    '''
+    Returns `ee` value for multiprocessing_run() and WarmWorker.run().
+    '''
+    if e is None:
+        return 'Timeout'
+    elif e != 0:
+        return f'multiprocessing.Process failure {e=}'
+    elif isinstance(ret, Exception):
+        return f'{type(ret)}: {ret}'
+    else:
+        return 0
+
+
+class PySpy:
+    '''
+    Records native and Python stacks of a single process using `py-spy
+    record`, for use as the `attach` arg of multiprocessing_run() and
+    WarmWorker.run(), and writes folded stacks and an SVG flamegraph.
+
+    Args:
+        py_spy:
+            The py-spy executable.
+        folded_path:
+            Path of folded stacks output file.
+        svg_path:
+            Path of SVG flamegraph output file.
+        title:
+            Title of flamegraph.
+        rate:
+            Samples per second.
+        native:
+            If true, include native (e.g. MuPDF) frames.
+    '''
+    def __init__(self, py_spy, folded_path, svg_path, title, rate=250, native=True):
+        self.py_spy = py_spy
+        self.folded_path = folded_path
+        self.svg_path = svg_path
+        self.title = title
+        self.rate = rate
+        self.native = native
+        self.process = None
+
+    def __call__(self, pid, timeout=10):
+        '''
+        Starts py-spy on process `pid`, and waits until it has attached.
+        '''
+        command = [
+                self.py_spy,
+                'record',
+                '--pid', str(pid),
+                '--rate', str(self.rate),
+                '--format', 'raw',
+                '--output', self.folded_path,
+                ]
+        if self.native:
+            command.append('--native')
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # py-spy writes a message to stdout when it has attached; we merge
+        # stderr into the same pipe in case this changes. We read in a thread
+        # so that we can time out, and so that py-spy never blocks on a full
+        # pipe.
+        attached = threading.Event()
+        def read_output():
+            for line in self.process.stdout:
+                if 'Sampling process' in line:
+                    attached.set()
+        self.output_thread = threading.Thread(target=read_output, daemon=True)
+        self.output_thread.start()
+        if not attached.wait(timeout):
+            log(f'py-spy has not attached to {pid=} after {timeout=}.')
+
+    def stop(self):
+        '''
+        Stops py-spy if the process it is attached to is still running (e.g. a
+        WarmWorker), and writes SVG flamegraph. Returns true if we have
+        written folded stacks and flamegraph.
+        '''
+        if not self.process:
+            return False
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        if not os.path.exists(self.folded_path):
+            return False
+        flamegraph.write(self.folded_path, self.svg_path, self.title)
+        return True
+
+
+class WarmWorker:
+    '''
+    A persistent child process for tool `toolname`, which imports the tool's
+    library once, by calling `get_version_<toolname>()`, and then runs test
+    functions sent to it over a pipe. This allows timing of steady-state cost
+    without process creation and import costs.
+
+    If the child process dies or times out, it is killed and a new one is
+    started for the next test.
+    '''
+    def __init__(self, toolname):
+        self.toolname = toolname
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _start(self, timeout):
+        '''
+        Starts child process and waits up to `timeout` seconds for it to
+        import the tool's library. Returns true on success.
+        '''
+        conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+                target=_warm_worker_main,
+                args=(child_conn, self.toolname),
+                )
+        _process_start(self.process)
+        child_conn.close()
+        self.conn = conn
+        log(f'Have started warm worker for {self.toolname=}: {self.process.pid=}')
+        try:
+            if self.conn.poll(timeout) and self.conn.recv() == 'ready':
+                return True
+        except Exception as e:
+            log(f'Warm worker for {self.toolname=} failed to start: {e}')
+        self.process.kill()
+        self.stop()
+        return False
+
+    def stop(self):
+        '''
+        Stops child process if it is running.
+        '''
+        if not self.process:
+            return
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(10)
+        if self.process.exitcode is None:
+            self.process.kill()
+            self.process.join(10)
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def run(self, fn, timeout, info=None, rss_interval=None, cpu=None, cprofile=None, attach=None, perf_counters=False):
+        '''
+        Runs a test function in our child process. Has the same API as
+        multiprocessing_run(), except that `fn` must be a tuple `(fnname,
+        args)`, and we run `globals()[fnname](*args)` in the child process.
+        `cprofile` must be None or a path.
+
+        Returned time excludes sending and receiving over the pipe. The time
+        taken to start the child process or import the tool's library is not
+        included.
+        '''
+        fnname, args = fn
+        with self.lock:
+            if not self.process and not self._start(timeout):
+                return timeout, None, None, 'Warm worker failed to start'
+            if cpu is not None:
+                os.sched_setaffinity(self.process.pid, {cpu})
+            if attach:
+                attach(self.process.pid)
+            t0 = time.perf_counter()
+            try:
+                self.conn.send((fnname, args, rss_interval, cprofile, perf_counters))
+                ok = self.conn.poll(timeout)
+            except Exception:
+                # Child process has died; poll() raises if the pipe is closed.
+                ok = True
+            if ok:
+                try:
+                    t, ret, child_info = self.conn.recv()
+                    e = 0
+                except Exception as ee:
+                    # Child process died.
+                    t, ret, child_info = time.perf_counter() - t0, None, None
+                    self.process.join(10)
+                    e = self.process.exitcode or ee
+                    self.stop()
+            else:
+                # Timeout.
+                t, ret, child_info = timeout, None, None
+                e = None
+                self.process.kill()
+                self.stop()
+            if info is not None and child_info:
+                phases = dict(child_info['phases'])
+                phases['other'] = t - sum(phases.values())
+                info['phases'] = phases
+                info['memory'] = child_info['memory']
+                info['pages'] = child_info['pages']
+                info['counters'] = child_info['counters']
+            return t, e, ret, _error_text(e, ret)
+
+
+def _warm_worker_main(conn, toolname):
+    '''
+    Main function of WarmWorker's child process.
+    '''
+    # As in multiprocessing_run(), don't include pages inherited from the
+    # parent in the peak RSS.
+    maxrss_kb0 = _rusage()['maxrss_kb']
+    globals()[f'get_version_{toolname}']()
+    conn.send('ready')
+    rusage0 = _rusage()
+    while 1:
+        message = conn.recv()
+        if message is None:
+            break
+        fnname, args, rss_interval, cprofile, perf_counters = message
+        _child_info_reset()
+        sampler = _RssSampler(rss_interval) if rss_interval else None
+        counters = _PerfCounters() if perf_counters else None
+        if cprofile:
+            import cProfile
+            pr = cProfile.Profile()
+            pr.enable()
+        t0 = time.perf_counter()
+        try:
+            ret = globals()[fnname](*args)
+        except Exception as e:
+            ret = e
+        t = time.perf_counter() - t0
+        if cprofile:
+            pr.disable()
+            pr.dump_stats(cprofile)
+        _child_info['counters'] = counters.stop() if counters else None
+        rusage = _rusage()
+        memory = dict()
+        for name, value in rusage.items():
+            memory[name] = value - (maxrss_kb0 if name == 'maxrss_kb' else rusage0[name])
+        rusage0 = rusage
+        if sampler:
+            memory['rss_timeline'] = sampler.stop()
+        _child_info['memory'] = memory
+        try:
+            conn.send((t, ret, _child_info))
+        except Exception as e:
+            # `ret` cannot be pickled.
+            conn.send((t, repr(ret), _child_info))
+
+
+def run_samples(
+        fn,
+        timeout,
+        warmup=0,
+        repeat=1,
+        repeat_ci=None,
+        repeat_max=20,
+        internal_check=False,
+        rss_interval=None,
+        cpu=None,
+        run=None,
+        perf_counters=False,
+        ):
+    '''
+    Runs `fn()` repeatedly using multiprocessing_run(), and returns `(samples,
+    ee, infos, t_failed)`.
+
+    Args:
+        fn:
+            Function to run. Passed to `run()`.
+        timeout:
+            Timeout for each run of `fn()`.
+        warmup:
+            Number of initial runs whose timings are discarded.
+        repeat:
+            Minimum number of timed runs.
+        repeat_ci:
+            If not None, we continue doing timed runs until the 95% confidence
+            interval of the mean is within +/- `repeat_ci * mean`, or we have
+            done `repeat_max` timed runs. We always do at least 3 timed runs
+            before checking the confidence interval.
+        repeat_max:
+            Maximum number of timed runs if `repeat_ci` is not None.
+        internal_check:
+            If true we don't run `fn()`, and instead pretend each run took 1
+            second.
+        rss_interval, cpu, perf_counters:
+            Passed to multiprocessing_run().
+        run:
+            If not None, used instead of multiprocessing_run(), for example
+            `WarmWorker.run`.
+
+    Returns `(samples, ee, infos, t_failed)`:
+        samples:
+            List of elapsed times of the successful timed runs. If a run fails
+            we stop immediately.
+        ee:
+            0 on success, otherwise error description string from
+            multiprocessing_run().
+        infos:
+            List of `info` dicts from multiprocessing_run(), one for each item
+            in `samples`.
+        t_failed:
+            Elapsed time of the failed run, or None if no run failed. This is
+            not in `samples` because it may be the timeout rather than the
+            time of a complete run.
+    '''
+    if run is None:
+        run = multiprocessing_run
+    samples = list()
+    infos = list()
+    t_failed = None
+    n = 0
+    while 1:
+        info = dict()
+        if internal_check:
+            t, ee = 1, 0
+        else:
+            t, e, ret, ee = run(fn, timeout, info=info, rss_interval=rss_interval, cpu=cpu, perf_counters=perf_counters)
+        n += 1
+        if ee:
+            t_failed = t
+            break
+        if n > warmup:
+            samples.append(t)
+            infos.append(info)
+        if len(samples) < repeat:
+            continue
+        if repeat_ci is None or len(samples) >= repeat_max:
+            break
+        if len(samples) < 3:
+            # Confidence interval is meaningless with fewer samples.
+            continue
+        stats = _stats(samples)
+        low, high = stats['ci95']
+        if (high - low) / 2 <= repeat_ci * stats['mean']:
+            break
+    return samples, ee, infos, t_failed
+
+
+def _phases_median(infos):
+    '''
+    Returns dict mapping from phase name to median time, from `info['phases']`
+    items in list `infos`. Returns None if there is no phase information.
+    '''
+    phases = dict()
+    for info in infos:
+        for name, t in info.get('phases', dict()).items():
+            phases.setdefault(name, list()).append(t)
+    if not phases:
+        return None
+    return {name: stats.percentile(sorted(ts), 50) for name, ts in phases.items()}
+
+
+def _pages_stats(infos, t):
+    '''
+    Returns dict with statistics of per-page times in `info['pages']` items of
+    list `infos`, or None if there are no per-page times. `t` is the overall
+    time of the test.
+
+    We use the median time for each page over all samples.
+    '''
+    page_times = dict()
+    for info in infos:
+        for pno, tt in info.get('pages', list()):
+            page_times.setdefault(pno, list()).append(tt)
+    if not page_times:
+        return None
+    page_times = {pno: stats.percentile(sorted(ts), 50) for pno, ts in page_times.items()}
+    values = sorted(page_times.values())
+    n = len(values)
+    slowest = sorted(page_times.items(), key=lambda item: item[1], reverse=True)
+    return dict(
+            n=n,
+            p50=stats.percentile(values, 50),
+            p95=stats.percentile(values, 95),
+            p99=stats.percentile(values, 99),
+            max=values[-1],
+            slowest=[list(item) for item in slowest[:5]],
+            pages_per_sec=n / t if t else None,
+            pages_per_sec_pages=n / sum(values) if sum(values) else None,
+            )
+
+
+def _memory_median(infos):
+    '''
+    Returns dict containing median of each numeric item in `info['memory']`
+    for items in list `infos`, plus `rss_timeline` from the last item that has
+    one. Returns None if there is no memory information.
+    '''
+    values = dict()
+    rss_timeline = None
+    for info in infos:
+        memory = info.get('memory')
+        if not memory:
+            continue
+        for name, value in memory.items():
+            if name == 'rss_timeline':
+                rss_timeline = value
+            else:
+                values.setdefault(name, list()).append(value)
+    if not values:
+        return None
+    ret = {name: stats.percentile(sorted(vs), 50) for name, vs in values.items()}
+    if rss_timeline is not None:
+        ret['rss_timeline'] = rss_timeline
+    return ret
+
+
+def _counters_median(infos):
+    '''
+    Returns dict containing median of each counter in `info['counters']` for
+    items in list `infos`, plus derived `ipc`, `cache_miss_rate` and
+    `branch_miss_rate` where possible. Returns None if there are no counters.
+    '''
+    values = dict()
+    for info in infos:
+        for name, value in (info.get('counters') or dict()).items():
+            values.setdefault(name, list()).append(value)
+    if not values:
+        return None
+    ret = {name: stats.percentile(sorted(vv), 50) for name, vv in values.items()}
+    for name, numerator, denominator in (
+            ('ipc', 'instructions', 'cycles'),
+            ('cache_miss_rate', 'cache_misses', 'cache_references'),
+            ('branch_miss_rate', 'branch_misses', 'branches'),
+            ):
+        if ret.get(denominator) and numerator in ret:
+            ret[name] = ret[numerator] / ret[denominator]
+    return ret
+
+
+def run_scaling(fn, path, worker_counts, timeout, repeat=1, internal_check=False):
+    '''
+    Measures how throughput of `fn()` scales with number of worker processes.
+
+    Args:
+        fn:
+            A `scale_<testname>_<toolname>()` function, called as `fn(path,
+            worker, num_workers)` in each of `num_workers` concurrent child
+            processes. Should process the `worker`-th share of the pages in
+            `path` and return the number of pages processed.
+        path:
+            Input file.
+        worker_counts:
+            List of numbers of worker processes.
+        timeout:
+            Timeout for each worker process.
+        repeat:
+            Number of times to run with each worker count; we use the median
+            wall-clock time.
+        internal_check:
+            If true we don't run `fn()` and pretend each run took 1 second.
+
+    Returns list of dicts, one for each item in `worker_counts`.
+    '''
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except Exception:
+        cpus = list()
+    curve = list()
+    for num_workers in worker_counts:
+        samples = list()
+        ee = 0
+        pages = 0
+        for _ in range(repeat):
+            if internal_check:
+                samples.append(1)
+                continue
+            rets = [None] * num_workers
+            def thread_fn(worker):
+                # Pin workers to different CPUs if there are enough.
+                cpu = cpus[worker] if len(cpus) >= num_workers else None
+                try:
+                    rets[worker] = multiprocessing_run(
+                            lambda: fn(path, worker, num_workers),
+                            timeout,
+                            cpu=cpu,
+                            )
+                except Exception as e:
+                    # Record the failure in the same form as a failure of
+                    # fn(), so that it is reported in `e` below.
+                    rets[worker] = None, 0, e, _error_text(0, e)
+            t0 = time.perf_counter()
+            _threads_run([functools.partial(thread_fn, worker) for worker in range(num_workers)])
+            t = time.perf_counter() - t0
+            samples.append(t)
+            pages = 0
+            for _, _, ret, ee in rets:
+                if ee:
+                    break
+                pages += ret
+            if ee:
+                break
+        t = stats.percentile(sorted(samples), 50)
+        item = dict(
+                workers=num_workers,
+                e=ee,
+                pages=pages,
+                t=t,
+                samples=samples,
+                pages_per_sec=pages / t if not ee else None,
+                )
+        curve.append(item)
+    # Add speedup and efficiency relative to the smallest number of workers.
+    base = curve[0] if curve and curve[0]['pages_per_sec'] else None
+    for item in curve:
+        if base and item['pages_per_sec']:
+            item['speedup'] = item['pages_per_sec'] / base['pages_per_sec'] * base['workers']
+            item['efficiency'] = item['speedup'] / item['workers']
+        else:
+            item['speedup'] = None
+            item['efficiency'] = None
+    return curve
+
+
+def _stats(samples):
+    '''
+    Returns dict with statistics for list of floats `samples`, or None if
+    `samples` is empty.
+    '''
+    if not samples:
+        return None
+    values = sorted(samples)
+    n = len(values)
+    mean = sum(values) / n
+    if n > 1:
+        stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+        h = stats.t95_critical(n - 1) * stddev / math.sqrt(n)
+    else:
+        stddev = 0
+        h = 0
+    q1 = stats.percentile(values, 25)
+    q3 = stats.percentile(values, 75)
+    return dict(
+            n=n,
+            mean=mean,
+            median=stats.percentile(values, 50),
+            stddev=stddev,
+            min=values[0],
+            max=values[-1],
+            q1=q1,
+            q3=q3,
+            iqr=q3 - q1,
+            ci95=[mean - h, mean + h],
+            )
+
+
+def _import_pymupdf(install_dir):
+    '''
+    Imports `pymupdf` from directory `install` by temporarily modifying
+    `sys.path`.
     '''
     assert isinstance(install_dir, str)
     sys.path.insert(0, install_dir)
     try:
-        import pymupdf
+        with phase('import'):
+            import pymupdf
         assert pymupdf.__file__.startswith(install_dir), f'Failed to import pymupdf from {install_dir}: {pymupdf.__file__=}'
     finally:
         del sys.path[0]
 
 
+# Child-side instrumentation.
+#
+# multiprocessing_run() clears `_child_info` in the child process before
+# calling the test function, and sends it back to the parent process
+# afterwards.
+#
+_child_info = dict()
+
+
+def _rusage():
+    '''
+    Returns dict with resource usage of the current process.
+    '''
+    import resource
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    maxrss_kb = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is in bytes on MacOS, kilobytes elsewhere.
+        maxrss_kb //= 1024
+    return dict(
+            maxrss_kb=maxrss_kb,
+            minflt=rusage.ru_minflt,
+            majflt=rusage.ru_majflt,
+            nvcsw=rusage.ru_nvcsw,
+            nivcsw=rusage.ru_nivcsw,
+            )
+
+
+def _rss_kb():
+    '''
+    Returns current resident set size of the current process in kilobytes.
+    '''
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class _RssSampler:
+    '''
+    Runs a thread that records resident set size of the current process every
+    `interval` seconds, until .stop() is called.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.timeline = list()
+        self.t0 = time.perf_counter()
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while 1:
+            try:
+                rss_kb = _rss_kb()
+            except Exception as e:
+                log(f'Cannot find RSS: {e}')
+                return
+            self.timeline.append([time.perf_counter() - self.t0, rss_kb])
+            if self.event.wait(self.interval):
+                return
+
+    def stop(self):
+        '''
+        Stops sampling and returns list of `[t, rss_kb]`.
+        '''
+        self.event.set()
+        self.thread.join()
+        try:
+            self.timeline.append([time.perf_counter() - self.t0, _rss_kb()])
+        except Exception:
+            pass
+        return self.timeline
+
+
+# Performance counters.
+#
+# We call perf_event_open() directly, as `perf stat` does, rather than running
+# `perf stat` itself, because test functions run in forked child processes,
+# and attaching `perf stat -p` to a child would miss its first few
+# milliseconds. This also means we only count events while the test function
+# is running, and don't need the `perf` tool to be installed.
+#
+
+# `(name, type, config)` for each counter; see `man perf_event_open`.
+_perf_counters = (
+        ('cycles',              0, 0),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_CPU_CYCLES
+        ('instructions',        0, 1),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_INSTRUCTIONS
+        ('cache_references',    0, 2),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_CACHE_REFERENCES
+        ('cache_misses',        0, 3),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_CACHE_MISSES
+        ('branches',            0, 4),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_BRANCH_INSTRUCTIONS
+        ('branch_misses',       0, 5),  # PERF_TYPE_HARDWARE, PERF_COUNT_HW_BRANCH_MISSES
+        ('task_clock_ns',       1, 1),  # PERF_TYPE_SOFTWARE, PERF_COUNT_SW_TASK_CLOCK
+        )
+
+# perf_event_open() system call number for each machine.
+_perf_event_open_syscall = dict(
+        x86_64=298,
+        aarch64=241,
+        i386=336,
+        i686=336,
+        armv7l=364,
+        ppc64le=319,
+        s390x=331,
+        )
+
+
+class _PerfCounters:
+    '''
+    Counts events in `_perf_counters` for the current process and any threads
+    that it creates, in user space only, from construction until stop() is
+    called.
+
+    Counters that cannot be opened, for example because we are not on Linux,
+    because /proc/sys/kernel/perf_event_paranoid is too high, or because we
+    are in a virtual machine without hardware counters, are omitted.
+    '''
+    def __init__(self):
+        self.fds = dict()
+        syscall_number = _perf_event_open_syscall.get(platform.machine())
+        if not sys.platform.startswith('linux') or not syscall_number:
+            return
+        import ctypes
+        class perf_event_attr(ctypes.Structure):
+            _fields_ = [
+                    ('type', ctypes.c_uint32),
+                    ('size', ctypes.c_uint32),
+                    ('config', ctypes.c_uint64),
+                    ('sample_period', ctypes.c_uint64),
+                    ('sample_type', ctypes.c_uint64),
+                    ('read_format', ctypes.c_uint64),
+                    ('flags', ctypes.c_uint64),
+                    ('reserved', ctypes.c_uint8 * 80),
+                    ]
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        except Exception:
+            return
+        for name, type_, config in _perf_counters:
+            attr = perf_event_attr(
+                    type=type_,
+                    size=ctypes.sizeof(perf_event_attr),
+                    config=config,
+                    # PERF_FORMAT_TOTAL_TIME_ENABLED | PERF_FORMAT_TOTAL_TIME_RUNNING.
+                    read_format=1 | 2,
+                    # inherit | exclude_kernel | exclude_hv.
+                    flags=(1 << 1) | (1 << 5) | (1 << 6),
+                    )
+            fd = libc.syscall(syscall_number, ctypes.byref(attr), 0, -1, -1, 0)
+            if fd >= 0:
+                self.fds[name] = fd
+
+    def stop(self):
+        '''
+        Returns dict mapping from counter name to count, or None if no
+        counters are available. If the kernel had to multiplex counters, counts
+        are scaled up to estimate the count for the whole time.
+        '''
+        ret = dict()
+        for name, fd in self.fds.items():
+            try:
+                value, enabled, running = struct.unpack('QQQ', os.read(fd, 24))
+                if running and running < enabled:
+                    value = value * enabled / running
+                ret[name] = int(value)
+            except Exception:
+                pass
+            os.close(fd)
+        self.fds = dict()
+        return ret or None
+
+
+def _child_info_reset():
+    '''
+    Resets `_child_info`; called in child process before running a test
+    function.
+    '''
+    _child_info.clear()
+    _child_info['phases'] = dict()
+    _child_info['pages'] = list()
+
+
+@contextlib.contextmanager
+def timed_page(number):
+    '''
+    Context manager for use by performance test functions, that records the
+    elapsed time of the body as the time taken to process page `number`. Page
+    loading should be inside the body, so that it is included. For example:
+
+        for i in range(len(doc)):
+            with timed_page(i):
+                page = doc[i]
+                page.get_text()
+
+    Does nothing if not called inside multiprocessing_run().
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        pages = _child_info.get('pages')
+        if pages is not None:
+            pages.append([number, time.perf_counter() - t0])
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Context manager for use by performance test functions, that adds the
+    elapsed time of the body to phase `name`. Can be used more than once with
+    the same `name`, e.g. within a loop over pages, in which case times are
+    accumulated. For example:
+
+        with phase('open'):
+            doc = pymupdf.open(path)
+
+    Does nothing if not called inside multiprocessing_run().
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = _child_info.get('phases')
+        if phases is not None:
+            phases[name] = phases.get(name, 0) + time.perf_counter() - t0
+
+
+# Output fingerprints.
+#
+# When validating (see --validate), each test function is run an extra time,
+# untimed, by _validate_call(), with `_fingerprints` set to a dict. Test
+# functions call the fingerprint_*() functions below to record checksums of
+# their output. In timed runs `_fingerprints` is None and these functions
+# return immediately, so test functions must not do any significant work to
+# create the args.
+#
+
+_fingerprints = None
+
+
+def _validate_call(io_mode, fnname, params, *args):
+    '''
+    Calls `_io_call(io_mode, fnname, params, *args)` with fingerprinting
+    enabled, and returns dict of fingerprints.
+    '''
+    global _fingerprints
+    _fingerprints = dict()
+    try:
+        _io_call(io_mode, fnname, params, *args)
+        return _fingerprints
+    finally:
+        _fingerprints = None
+
+
+def fingerprint_text(number, text):
+    '''
+    Records length and checksum of `text`, the text extracted from page
+    `number`.
+    '''
+    if _fingerprints is None:
+        return
+    _fingerprints['text_length'] = _fingerprints.get('text_length', 0) + len(text)
+    _fingerprints.setdefault('text_pages', list()).append(
+            [number, hashlib.sha256(text.encode('utf8', errors='replace')).hexdigest()[:16]]
+            )
+
+
+def fingerprint_pixmap(number, width, height, n, stride, samples):
+    '''
+    Records checksum and perceptual hash of the rendering of page `number`.
+    `samples` is a buffer of `height` rows of `stride` bytes, with `n` bytes
+    per pixel.
+    '''
+    if _fingerprints is None:
+        return
+    samples = memoryview(samples).cast('B')
+    _fingerprints.setdefault('pixmaps', list()).append([
+            number,
+            hashlib.sha256(samples).hexdigest()[:16],
+            _ahash(width, height, n, stride, samples),
+            ])
+
+
+def fingerprint_output(out, pages):
+    '''
+    Records size of `out` (a path or `io.BytesIO` as returned by
+    _io_output()), and `pages`, the number of pages written to it. If called
+    more than once, e.g. by tests that write a file for each page, sizes and
+    page counts are summed.
+    '''
+    if _fingerprints is None:
+        return
+    if isinstance(out, str):
+        size = os.path.getsize(out)
+    else:
+        size = len(out.getbuffer())
+    _fingerprints['output_size'] = _fingerprints.get('output_size', 0) + size
+    _fingerprints['output_pages'] = _fingerprints.get('output_pages', 0) + pages
+
+
+def _ahash(width, height, n, stride, samples, size=8):
+    '''
+    Returns average hash of image as hex string, so that renderings that look
+    the same but differ slightly (e.g. in anti-aliasing) have the same or a
+    similar hash. We divide the image into `size * size` cells, and set one
+    bit per cell depending on whether the cell's brightness is above the
+    mean. To keep this fast in Python, we only sample 16 pixels per cell.
+    '''
+    channels = min(n, 3)
+    cells = list()
+    for cy in range(size):
+        for cx in range(size):
+            total = 0
+            for sy in range(4):
+                y = min(((cy * 4 + sy) * height + height // 2) // (size * 4), height - 1)
+                for sx in range(4):
+                    x = min(((cx * 4 + sx) * width + width // 2) // (size * 4), width - 1)
+                    i = y * stride + x * n
+                    total += sum(samples[i:i + channels])
+            cells.append(total)
+    mean = sum(cells) / len(cells)
+    bits = 0
+    for c in cells:
+        bits = (bits << 1) | (c > mean)
+    return f'{bits:0{size * size // 4}x}'
+
+
+def _fingerprints_diff(a, b):
+    '''
+    Returns list of descriptions of significant differences between
+    fingerprint dicts `a` and `b`, or empty list if they match.
+
+    Text and output page counts must match exactly. Renderings match if their
+    perceptual hashes differ by at most 4 bits, and output sizes match if
+    within 5%.
+    '''
+    ret = list()
+    if a.get('text_length') != b.get('text_length'):
+        ret.append(f'text_length {a.get("text_length")} != {b.get("text_length")}')
+    pages_a = dict(a.get('text_pages', list()))
+    pages_b = dict(b.get('text_pages', list()))
+    if pages_a != pages_b:
+        pnos = sorted(pno for pno in set(pages_a) | set(pages_b) if pages_a.get(pno) != pages_b.get(pno))
+        ret.append(f'text differs on {len(pnos)} pages, first {pnos[0]}')
+    pix_a = {pno: ahash for pno, sha, ahash in a.get('pixmaps', list())}
+    pix_b = {pno: ahash for pno, sha, ahash in b.get('pixmaps', list())}
+    pnos = list()
+    for pno in sorted(set(pix_a) | set(pix_b)):
+        ha = pix_a.get(pno)
+        hb = pix_b.get(pno)
+        if ha is None or hb is None or bin(int(ha, 16) ^ int(hb, 16)).count('1') > 4:
+            pnos.append(pno)
+    if pnos:
+        ret.append(f'rendering differs on {len(pnos)} pages, first {pnos[0]}')
+    if a.get('output_pages') != b.get('output_pages'):
+        ret.append(f'output_pages {a.get("output_pages")} != {b.get("output_pages")}')
+    size_a = a.get('output_size')
+    size_b = b.get('output_size')
+    if (size_a is None) != (size_b is None) or (size_a and abs(size_b / size_a - 1) > 0.05):
+        ret.append(f'output_size {size_a} != {size_b}')
+    return ret
+
+
 # Tool version functions.
 #
 # There must be one of these for each tool. Should return anything that can be
@@ -467,32 +3146,177 @@ def get_version_pymupdf():
             Py_LIMITED_API=Py_LIMITED_API,
             )
 
-def get_version_pdfrw():
-    import pdfrw
-    return pdfrw.__version__
+def get_version_pdfrw():
+    import pdfrw
+    return pdfrw.__version__
+
+def get_version_pikepdf():
+    import pikepdf
+    return pikepdf.__version__
+
+def get_version_pypdf2():
+    import PyPDF2
+    return PyPDF2.__version__
+
+def get_version_pdf2jpg():
+    import pdf2jpg.pdf2jpg
+    return None
+
+def get_version_pdfminer():
+    import pdfminer
+    return pdfminer.__version__
+
+def get_version_poppler():
+    cp = subprocess.run('pdftotext -v', shell=1, check=1, capture_output=1, text=1)
+    return cp.stdout + cp.stderr
+
+def get_version_pypdfium2():
+    return None
+
+
+# I/O modes.
+#
+# Test functions use _io_input(), _io_input_file() and _io_output() to open
+# input and create output, so that they behave as specified by --io.
+#
+
+# Current I/O mode in child process; set by _io_call().
+_io_mode = 'disk'
+
+# Contents of input files for 'memory' I/O mode, read by performance() before
+# creating child processes.
+_io_input_data = dict()
+
+# Test functions that only support 'disk' I/O mode, because the underlying
+# tool can only read and write files.
+_io_disk_only = set((
+        'do_blocks_poppler',
+        'do_render_pdf2jpg',
+        'do_render_poppler',
+        'do_text_poppler',
+        'do_words_poppler',
+        ))
+
+
+def _io_call(io_mode, fnname, params, *args):
+    '''
+    Sets I/O mode to `io_mode` and calls global function `fnname(*args,
+    **params)`.
+    '''
+    global _io_mode
+    _io_mode = io_mode
+    return globals()[fnname](*args, **params)
+
+
+def _io_input(path):
+    '''
+    Returns `path` in 'disk' I/O mode, otherwise a buffer containing the
+    contents of `path`; either `bytes` or a `memoryview` of an mmap.
+    '''
+    if _io_mode == 'disk':
+        return path
+    if _io_mode == 'memory':
+        return _io_input_data[path]
+    if _io_mode == 'mmap':
+        return memoryview(_io_mmap(path))
+    assert 0, f'Unrecognised {_io_mode=}'
+
+
+def _io_input_file(path):
+    '''
+    Returns `path` in 'disk' I/O mode, otherwise a seekable file-like object
+    containing the contents of `path`; either a `io.BytesIO` or an mmap.
+    '''
+    if _io_mode == 'disk':
+        return path
+    if _io_mode == 'memory':
+        return io.BytesIO(_io_input_data[path])
+    if _io_mode == 'mmap':
+        return _io_mmap(path)
+    assert 0, f'Unrecognised {_io_mode=}'
+
+
+def _io_mmap(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _io_output(path):
+    '''
+    Returns `path` in 'disk' I/O mode, otherwise a `io.BytesIO`.
+    '''
+    if _io_mode == 'disk':
+        return path
+    return io.BytesIO()
 
-def get_version_pikepdf():
-    import pikepdf
-    return pikepdf.__version__
 
-def get_version_pypdf2():
-    import PyPDF2
-    return PyPDF2.__version__
+# Parameter grids of test functions, keyed by `do_<testname>_<toolname>`;
+# PyMuPDF variants use the grid of `do_<testname>_pymupdf`. Each grid is a
+# list of dicts mapping from keyword param name to list of values, and the
+# test is run with each combination of values from each dict; separate dicts
+# allow us to exclude combinations that do not make sense, such as JPEG with
+# alpha. The first value of each param is the default, and must be the same
+# as the default value of the function's keyword arg. See
+# _params_combinations() and --grid.
+#
+_params_grids = {
+        'do_copy_pymupdf': [
+                dict(garbage=[0, 1, 2, 3, 4], deflate=[0, 1], use_objstms=[0, 1]),
+                dict(incremental=[0, 1]),
+                ],
+        'do_render_pymupdf': [
+                dict(dpi=[150, 72, 300], colorspace=['rgb', 'gray'], alpha=[0, 1], image_format=['png', 'raw']),
+                dict(dpi=[150, 72, 300], colorspace=['rgb', 'gray'], image_format=['jpeg']),
+                ],
+        }
 
-def get_version_pdf2jpg():
-    import pdf2jpg.pdf2jpg
-    return None
+# Params that, if present, need 'disk' I/O mode.
+#
+_params_disk_only = set((
+        'incremental',
+        ))
 
-def get_version_pdfminer():
-    import pdfminer
-    return pdfminer.__version__
+# Untimed setup functions of test functions, keyed by `do_<testname>_<toolname>`
+# like `_params_grids`. Each is called as `setup(path, **params)` in the
+# parent process before each run of the test, so that its work is not
+# included in the time.
+#
+_params_setups = dict()
 
-def get_version_poppler():
-    cp = subprocess.run('pdftotext -v', shell=1, check=1, capture_output=1, text=1)
-    return cp.stdout + cp.stderr
 
-def get_version_pypdfium2():
-    return None
+def _params_combinations(fnname, grid=False, filters=None):
+    '''
+    Returns list of params dicts for test function `fnname`, one for each
+    combination of values in `_params_grids[fnname]`. Each dict only contains
+    non-default values, so default params are `{}`.
+
+    Args:
+        grid:
+            If false we only return `[{}]`, so tests are run with default
+            params.
+        filters:
+            If not None, dict mapping from param name to list of strings; we
+            only use combinations where `str(value)` is in the list.
+    '''
+    grids = _params_grids.get(fnname)
+    if not grid or not grids:
+        return [dict()]
+    defaults = dict()
+    for grid_ in grids:
+        for name, values in grid_.items():
+            defaults.setdefault(name, values[0])
+    ret = list()
+    for grid_ in grids:
+        names = sorted(grid_)
+        for combination in itertools.product(*[grid_[name] for name in names]):
+            values = dict(defaults)
+            values.update(zip(names, combination))
+            if filters and any(name in values and str(values[name]) not in v for name, v in filters.items()):
+                continue
+            params = {name: value for name, value in values.items() if value != defaults[name]}
+            if params not in ret:
+                ret.append(params)
+    return ret
 
 
 # Performance test functions.
@@ -500,47 +3324,126 @@ def get_version_pypdfium2():
 # Functions should be called `do_<testname>_<toolname>()`.
 #
 # Each of these functions is passed a single `path` arg, the PDF file to
-# process.
+# process, and keyword args for any params in `_params_grids`. Functions
+# should use _io_input(), _io_input_file() and
+# _io_output() instead of `path` where the tool supports it, otherwise they
+# should be listed in `_io_disk_only`. They should also call fingerprint_*()
+# where possible, to allow validation of their output.
 #
 
+def _open_pymupdf(path):
+    import pymupdf
+    input_ = _io_input(path)
+    if isinstance(input_, str):
+        return pymupdf.open(input_)
+    return pymupdf.open(stream=input_)
+
+def _io_input_pypdfium2(path):
+    # pypdfium2 accepts bytes, but file-like objects must support readinto(),
+    # which mmap does not, so we use a ctypes array backed by the mmap.
+    if _io_mode == 'mmap':
+        import ctypes
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return (ctypes.c_char * len(m)).from_buffer(m)
+    return _io_input(path)
+
+
 # do_copy_*()
 #
 
 def do_copy_pdfrw(path):
-    import pdfrw
-    doc = pdfrw.PdfReader(path)
-    writer = pdfrw.PdfWriter()
-    writer.trailer = doc
-    writer.write(f'{path}.copy.pdfrw')
+    with phase('import'):
+        import pdfrw
+    with phase('open'):
+        doc = pdfrw.PdfReader(_io_input_file(path))
+    with phase('write'):
+        writer = pdfrw.PdfWriter()
+        writer.trailer = doc
+        out = _io_output(f'{path}.copy.pdfrw')
+        writer.write(out)
+    fingerprint_output(out, len(doc.pages))
 
 def do_copy_pikepdf(path):
-    import pikepdf
-    doc = pikepdf.open(path)
-    doc.save(f'{path}.copy.pike')
+    with phase('import'):
+        import pikepdf
+    with phase('open'):
+        doc = pikepdf.open(_io_input_file(path))
+    with phase('write'):
+        out = _io_output(f'{path}.copy.pike')
+        doc.save(out)
+    fingerprint_output(out, len(doc.pages))
 
-def do_copy_pymupdf(path):
-    import pymupdf
-    doc = pymupdf.open(path)
-    doc.save(f'{path}.copy.pymupdf')
+def _setup_copy_pymupdf(path, incremental=0, **params):
+    if incremental:
+        # Incremental saves append to the file that was opened, so
+        # do_copy_pymupdf() opens a fresh copy of the input file.
+        shutil.copyfile(path, f'{path}.copy.pymupdf')
+
+_params_setups['do_copy_pymupdf'] = _setup_copy_pymupdf
+
+def do_copy_pymupdf(path, garbage=0, deflate=0, use_objstms=0, incremental=0):
+    with phase('import'):
+        import pymupdf
+    def edit(doc):
+        # An incremental save of an unmodified document writes almost
+        # nothing, so we make a small change in both modes.
+        with phase('work'):
+            doc.set_metadata(dict(doc.metadata, producer='PyMuPDF-performance'))
+    if incremental:
+        out = f'{path}.copy.pymupdf'
+        with phase('open'):
+            doc = pymupdf.open(out)
+        edit(doc)
+        with phase('write'):
+            doc.save(out, incremental=True, encryption=pymupdf.PDF_ENCRYPT_KEEP)
+    else:
+        with phase('open'):
+            doc = _open_pymupdf(path)
+        edit(doc)
+        # Only pass non-default args, so that we work with old PyMuPDF
+        # versions that don't have them, e.g. when run by perfbisect.py.
+        kwargs = dict()
+        if garbage:
+            kwargs['garbage'] = garbage
+        if deflate:
+            kwargs['deflate'] = True
+        if use_objstms:
+            kwargs['use_objstms'] = use_objstms
+        with phase('write'):
+            out = _io_output(f'{path}.copy.pymupdf')
+            doc.save(out, **kwargs)
+    fingerprint_output(out, len(doc))
 
 def do_copy_pypdf2(path):
-    import PyPDF2
-    pdfmerge = PyPDF2.PdfMerger()
-    pdfmerge.append(path)
-    pdfmerge.write(f'{path}.copy.pypdf2')
+    with phase('import'):
+        import PyPDF2
+    with phase('open'):
+        pdfmerge = PyPDF2.PdfMerger()
+        pdfmerge.append(_io_input_file(path))
+    with phase('write'):
+        out = _io_output(f'{path}.copy.pypdf2')
+        pdfmerge.write(out)
+    fingerprint_output(out, len(pdfmerge.pages))
     pdfmerge.close()
 
 def do_copy_pypdfium2(path):
-    import pypdfium2
-    doc = pypdfium2.PdfDocument(path)
-    doc.save(f'{path}.copy.pypdfium2')
+    with phase('import'):
+        import pypdfium2
+    with phase('open'):
+        doc = pypdfium2.PdfDocument(_io_input_pypdfium2(path))
+    with phase('write'):
+        out = _io_output(f'{path}.copy.pypdfium2')
+        doc.save(out)
+    fingerprint_output(out, len(doc))
     
 
 # do_render_*()
 #
 
 def do_render_pdf2jpg(path):
-    import pdf2jpg.pdf2jpg
+    with phase('import'):
+        import pdf2jpg.pdf2jpg
     outdir = f'{path}.render.pdf2jpg-images'
     os.makedirs(outdir, exist_ok=1)
     if not pdf2jpg.pdf2jpg.convert_pdf2jpg(path, outdir, pages='ALL', dpi=150):
@@ -551,26 +3454,53 @@ def do_render_poppler(path):
     print(f'Running: {command}')
     subprocess.run(command, shell=1, check=1)
 
-def do_render_pymupdf(path):
-    import pymupdf
-    doc = pymupdf.open(path)
-    for page in doc:
-        pix = page.get_pixmap(dpi=150)
-        out = f'{path}.render.pymupdf-image-{page.number}.png'
-        pix.save(out)
+def do_render_pymupdf(path, dpi=150, colorspace='rgb', alpha=0, image_format='png'):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    # As in do_copy_pymupdf(), only pass non-default args.
+    kwargs = dict()
+    if colorspace != 'rgb':
+        kwargs['colorspace'] = dict(gray=pymupdf.csGRAY)[colorspace]
+    if alpha:
+        kwargs['alpha'] = True
+    for i in range(len(doc)):
+        with timed_page(i):
+            with phase('work'):
+                page = doc[i]
+                pix = page.get_pixmap(dpi=dpi, **kwargs)
+            out = f'{path}.render.pymupdf-image-{i}.{image_format}'
+            fingerprint_pixmap(i, pix.width, pix.height, pix.n, pix.stride, pix.samples_mv)
+            with phase('write'):
+                if image_format == 'raw':
+                    out2 = _io_output(out)
+                    if isinstance(out2, str):
+                        with open(out2, 'wb') as f:
+                            f.write(pix.samples_mv)
+                    else:
+                        out2.write(pix.samples_mv)
+                else:
+                    pix.save(_io_output(out), image_format)
         log(f'Have written to: {out}')
         pix = None
     doc.close()
 
 def do_render_pypdfium2(path):
-    import pypdfium2
-    doc = pypdfium2.PdfDocument(path)
+    with phase('import'):
+        import pypdfium2
+    with phase('open'):
+        doc = pypdfium2.PdfDocument(_io_input_pypdfium2(path))
     for i in range(len(doc)):
-        page = doc[i]
-        bitmap = page.render(scale=150 / 72)
-        img = bitmap.to_pil()
-        out = f'{path}.render.pypdfium2-image-{i}.png'
-        img.save(out)
+        with timed_page(i):
+            with phase('work'):
+                page = doc[i]
+                bitmap = page.render(scale=150 / 72)
+                img = bitmap.to_pil()
+            out = f'{path}.render.pypdfium2-image-{i}.png'
+            fingerprint_pixmap(i, bitmap.width, bitmap.height, bitmap.n_channels, bitmap.stride, bitmap.buffer)
+            with phase('write'):
+                img.save(_io_output(out), 'png')
         log(f'Have written to: {out}')
     doc.close()
 
@@ -579,46 +3509,518 @@ def do_render_pypdfium2(path):
 #
 
 def do_text_pdfminer(path):
-    import pdfminer.high_level
-    pdfminer.high_level.extract_text(path)
+    with phase('import'):
+        import pdfminer.high_level
+    with phase('work'):
+        pdfminer.high_level.extract_text(_io_input_file(path))
 
 def do_text_poppler(path):
     subprocess.run(f'pdftotext {path} {path}.text.poppler', shell=1, check=1)
 
 def do_text_pymupdf(path):
-    import pymupdf
-    doc = pymupdf.open(path)
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
     length = 0
-    for page in doc:
-        text = page.get_text()
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            text = page.get_text()
+        fingerprint_text(i, text)
         l = len(text)
         length += l
     print(f'{length=}')
         
 
 def do_text_pypdf2(path):
-    import PyPDF2
-    reader = PyPDF2.PdfReader(path)
-    for page in reader.pages:
-        page.extract_text()
+    with phase('import'):
+        import PyPDF2
+    with phase('open'):
+        reader = PyPDF2.PdfReader(_io_input_file(path))
+    for i, page in enumerate(reader.pages):
+        with timed_page(i), phase('work'):
+            text = page.extract_text()
+        fingerprint_text(i, text)
 
 def do_text_pypdfium2(path):
+    with phase('import'):
+        import pypdfium2
+    with phase('open'):
+        doc = pypdfium2.PdfDocument(_io_input_pypdfium2(path))
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            text = page.get_textpage().get_text_range()
+        fingerprint_text(i, text)
+    doc.close()
+
+
+# do_textdict_*(), do_textrawdict_*()
+#
+# Structured text extraction, with fonts and positions of spans or
+# characters.
+#
+
+def _text_dict_pymupdf(path, option):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            d = page.get_text(option)
+        spans = [span for block in d['blocks'] for line in block.get('lines', ()) for span in line['spans']]
+        if option == 'rawdict':
+            text = ''.join(char['c'] for span in spans for char in span['chars'])
+        else:
+            text = ''.join(span['text'] for span in spans)
+        fingerprint_text(i, text)
+    doc.close()
+
+def do_textdict_pdfminer(path):
+    with phase('import'):
+        import pdfminer.high_level
+        import pdfminer.layout
+    with phase('work'):
+        for i, page in enumerate(pdfminer.high_level.extract_pages(_io_input_file(path))):
+            text = ''.join(
+                    element.get_text()
+                    for element in page
+                    if isinstance(element, pdfminer.layout.LTTextContainer)
+                    )
+            fingerprint_text(i, text)
+
+def do_textdict_pymupdf(path):
+    _text_dict_pymupdf(path, 'dict')
+
+def do_textrawdict_pymupdf(path):
+    _text_dict_pymupdf(path, 'rawdict')
+
+
+# do_words_*(), do_blocks_*()
+#
+
+def do_blocks_poppler(path):
+    subprocess.run(f'pdftotext -bbox-layout {path} {path}.blocks.poppler.html', shell=1, check=1)
+
+def do_blocks_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            blocks = page.get_text('blocks')
+        fingerprint_text(i, '\n'.join(block[4] for block in blocks))
+    doc.close()
+
+def do_words_poppler(path):
+    subprocess.run(f'pdftotext -bbox {path} {path}.words.poppler.html', shell=1, check=1)
+
+def do_words_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            words = page.get_text('words')
+        fingerprint_text(i, ' '.join(word[4] for word in words))
+    doc.close()
+
+
+# do_search_*()
+#
+# Searches every page for common words.
+#
+
+_search_words = ['the', 'and', 'PDF', 'lorem']
+
+def do_search_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            hits = [len(page.search_for(word)) for word in _search_words]
+        fingerprint_text(i, repr(hits))
+    doc.close()
+
+def do_search_pypdfium2(path):
+    with phase('import'):
+        import pypdfium2
+    with phase('open'):
+        doc = pypdfium2.PdfDocument(_io_input_pypdfium2(path))
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            textpage = page.get_textpage()
+            hits = list()
+            for word in _search_words:
+                searcher = textpage.search(word)
+                n = 0
+                while searcher.get_next():
+                    n += 1
+                hits.append(n)
+        fingerprint_text(i, repr(hits))
+    doc.close()
+
+
+# do_tables_*()
+#
+
+def do_tables_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            tables = [table.extract() for table in page.find_tables().tables]
+        fingerprint_text(i, json.dumps(tables))
+    doc.close()
+
+
+# do_images_*()
+#
+# Finds images on each page and extracts each image once.
+#
+
+def do_images_pikepdf(path):
+    with phase('import'):
+        import pikepdf
+        import pikepdf.models.image
+    with phase('open'):
+        doc = pikepdf.open(_io_input_file(path))
+    seen = set()
+    for i, page in enumerate(doc.pages):
+        sizes = list()
+        with timed_page(i), phase('work'):
+            for name, raw in page.images.items():
+                if raw.objgen in seen:
+                    continue
+                seen.add(raw.objgen)
+                out = io.BytesIO()
+                try:
+                    pikepdf.PdfImage(raw).extract_to(stream=out)
+                    sizes.append(len(out.getbuffer()))
+                except pikepdf.models.image.UnsupportedImageTypeError:
+                    sizes.append(len(raw.read_raw_bytes()))
+        fingerprint_text(i, repr(sizes))
+
+def do_images_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    seen = set()
+    for i in range(len(doc)):
+        sizes = list()
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            for image in page.get_images(full=True):
+                xref = image[0]
+                if xref in seen:
+                    continue
+                seen.add(xref)
+                sizes.append(len(doc.extract_image(xref)['image']))
+        fingerprint_text(i, repr(sizes))
+    doc.close()
+
+def do_images_pypdf2(path):
+    with phase('import'):
+        import PyPDF2
+    with phase('open'):
+        reader = PyPDF2.PdfReader(_io_input_file(path))
+    for i, page in enumerate(reader.pages):
+        with timed_page(i), phase('work'):
+            sizes = [len(image.data) for image in page.images]
+        fingerprint_text(i, repr(sizes))
+
+
+# do_merge_*(), do_split_*()
+#
+# Merge writes a document containing two copies of the input file's pages.
+# Split writes each page to a separate document.
+#
+
+def do_merge_pikepdf(path):
+    with phase('import'):
+        import pikepdf
+    with phase('open'):
+        src = pikepdf.open(_io_input_file(path))
+    with phase('work'):
+        doc = pikepdf.Pdf.new()
+        doc.pages.extend(src.pages)
+        doc.pages.extend(src.pages)
+    with phase('write'):
+        out = _io_output(f'{path}.merge.pikepdf')
+        doc.save(out)
+    fingerprint_output(out, len(doc.pages))
+
+def do_merge_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        src = _open_pymupdf(path)
+    with phase('work'):
+        doc = pymupdf.open()
+        doc.insert_pdf(src)
+        doc.insert_pdf(src)
+    with phase('write'):
+        out = _io_output(f'{path}.merge.pymupdf')
+        doc.save(out, garbage=1)
+    fingerprint_output(out, len(doc))
+
+def do_merge_pypdf2(path):
+    with phase('import'):
+        import PyPDF2
+    with phase('work'):
+        pdfmerge = PyPDF2.PdfMerger()
+        pdfmerge.append(_io_input_file(path))
+        pdfmerge.append(_io_input_file(path))
+    with phase('write'):
+        out = _io_output(f'{path}.merge.pypdf2')
+        pdfmerge.write(out)
+    fingerprint_output(out, len(pdfmerge.pages))
+    pdfmerge.close()
+
+def do_split_pikepdf(path):
+    with phase('import'):
+        import pikepdf
+    with phase('open'):
+        src = pikepdf.open(_io_input_file(path))
+    for i, page in enumerate(src.pages):
+        with timed_page(i):
+            with phase('work'):
+                doc = pikepdf.Pdf.new()
+                doc.pages.append(page)
+            with phase('write'):
+                out = _io_output(f'{path}.split.pikepdf-{i}.pdf')
+                doc.save(out)
+        fingerprint_output(out, 1)
+
+def do_split_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        src = _open_pymupdf(path)
+    for i in range(len(src)):
+        with timed_page(i):
+            with phase('work'):
+                doc = pymupdf.open()
+                doc.insert_pdf(src, from_page=i, to_page=i)
+            with phase('write'):
+                out = _io_output(f'{path}.split.pymupdf-{i}.pdf')
+                doc.save(out, garbage=1)
+        fingerprint_output(out, 1)
+        doc.close()
+    src.close()
+
+def do_split_pypdf2(path):
+    with phase('import'):
+        import PyPDF2
+    with phase('open'):
+        reader = PyPDF2.PdfReader(_io_input_file(path))
+    for i, page in enumerate(reader.pages):
+        with timed_page(i):
+            with phase('work'):
+                writer = PyPDF2.PdfWriter()
+                writer.add_page(page)
+            with phase('write'):
+                out = _io_output(f'{path}.split.pypdf2-{i}.pdf')
+                writer.write(out)
+        fingerprint_output(out, 1)
+
+
+# do_toc_*(), do_links_*()
+#
+
+def do_links_pikepdf(path):
+    with phase('import'):
+        import pikepdf
+    with phase('open'):
+        doc = pikepdf.open(_io_input_file(path))
+    for i, page in enumerate(doc.pages):
+        with timed_page(i), phase('work'):
+            links = [
+                    annot
+                    for annot in page.obj.get('/Annots', list())
+                    if annot.get('/Subtype') == pikepdf.Name.Link
+                    ]
+        fingerprint_text(i, repr(len(links)))
+
+def do_links_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    for i in range(len(doc)):
+        with timed_page(i), phase('work'):
+            page = doc[i]
+            links = page.get_links()
+        fingerprint_text(i, repr(len(links)))
+    doc.close()
+
+def do_toc_pikepdf(path):
+    with phase('import'):
+        import pikepdf
+    with phase('open'):
+        doc = pikepdf.open(_io_input_file(path))
+    titles = list()
+    with phase('work'):
+        # Resolve each item's destination page, like get_toc() and
+        # PyPDF2's get_destination_page_number() do.
+        page_numbers = {page.obj.objgen: i for i, page in enumerate(doc.pages)}
+        names = doc.Root.get('/Names')
+        named_dests = pikepdf.NameTree(names.Dests) if names is not None and '/Dests' in names else None
+        def page_number(item):
+            dest = item.destination
+            if dest is None and item.action is not None and item.action.get('/S') == pikepdf.Name.GoTo:
+                dest = item.action.get('/D')
+            if isinstance(dest, pikepdf.Name):
+                dest = doc.Root.get('/Dests', pikepdf.Dictionary()).get(dest)
+            elif isinstance(dest, (str, pikepdf.String)):
+                dest = named_dests.get(str(dest)) if named_dests is not None else None
+            if isinstance(dest, pikepdf.Dictionary):
+                dest = dest.get('/D')
+            if isinstance(dest, pikepdf.Array) and len(dest) and isinstance(dest[0], pikepdf.Dictionary):
+                return page_numbers.get(dest[0].objgen)
+            return None
+        with doc.open_outline() as outline:
+            items = list(outline.root)
+            while items:
+                item = items.pop(0)
+                titles.append(item.title)
+                page_number(item)
+                items[:0] = item.children
+    fingerprint_text(0, '\n'.join(titles))
+
+def do_toc_pymupdf(path):
+    with phase('import'):
+        import pymupdf
+    with phase('open'):
+        doc = _open_pymupdf(path)
+    with phase('work'):
+        toc = doc.get_toc(simple=False)
+    fingerprint_text(0, '\n'.join(item[1] for item in toc))
+    doc.close()
+
+def do_toc_pypdf2(path):
+    with phase('import'):
+        import PyPDF2
+    with phase('open'):
+        reader = PyPDF2.PdfReader(_io_input_file(path))
+    titles = list()
+    with phase('work'):
+        items = list(reader.outline)
+        while items:
+            item = items.pop(0)
+            if isinstance(item, list):
+                items[:0] = item
+            else:
+                titles.append(item.title)
+                reader.get_destination_page_number(item)
+    fingerprint_text(0, '\n'.join(titles))
+
+
+# Scaling test functions.
+#
+# Functions should be called `scale_<testname>_<toolname>()`. Each is passed
+# `(path, worker, num_workers)`, and should process the `worker`-th of
+# `num_workers` contiguous ranges of pages in `path`, returning the number of
+# pages processed. See run_scaling().
+#
+
+def _page_range(page_count, worker, num_workers):
+    '''
+    Returns `(first, end)` range of pages for `worker`.
+    '''
+    first = page_count * worker // num_workers
+    end = page_count * (worker + 1) // num_workers
+    return first, end
+
+def _page_count_poppler(path):
+    cp = subprocess.run(f'pdfinfo {path}', shell=1, check=1, capture_output=1, text=1)
+    m = re.search('^Pages:\\s+([0-9]+)$', cp.stdout, re.MULTILINE)
+    assert m, f'Cannot find page count in pdfinfo output: {cp.stdout!r}'
+    return int(m.group(1))
+
+def scale_render_poppler(path, worker, num_workers):
+    first, end = _page_range(_page_count_poppler(path), worker, num_workers)
+    if first == end:
+        return 0
+    # pdftoppm's -f and -l are 1-based and inclusive.
+    command = f'pdftoppm -r 150 -png -f {first+1} -l {end} {path} {path}.scale.poppler-image'
+    subprocess.run(command, shell=1, check=1)
+    return end - first
+
+def scale_render_pymupdf(path, worker, num_workers):
+    import pymupdf
+    doc = pymupdf.open(path)
+    first, end = _page_range(len(doc), worker, num_workers)
+    for pno in range(first, end):
+        pix = doc[pno].get_pixmap(dpi=150)
+        pix.save(f'{path}.scale.pymupdf-image-{pno}.png')
+    return end - first
+
+def scale_render_pypdfium2(path, worker, num_workers):
     import pypdfium2
     doc = pypdfium2.PdfDocument(path)
-    for page in doc:
-        page.get_textpage().get_text_range()
+    first, end = _page_range(len(doc), worker, num_workers)
+    for pno in range(first, end):
+        img = doc[pno].render(scale=150 / 72).to_pil()
+        img.save(f'{path}.scale.pypdfium2-image-{pno}.png')
     doc.close()
+    return end - first
 
+def scale_text_poppler(path, worker, num_workers):
+    first, end = _page_range(_page_count_poppler(path), worker, num_workers)
+    if first == end:
+        return 0
+    command = f'pdftotext -f {first+1} -l {end} {path} {path}.scale.poppler-text-{worker}'
+    subprocess.run(command, shell=1, check=1)
+    return end - first
 
-# Other
+def scale_text_pymupdf(path, worker, num_workers):
+    import pymupdf
+    doc = pymupdf.open(path)
+    first, end = _page_range(len(doc), worker, num_workers)
+    for pno in range(first, end):
+        doc[pno].get_text()
+    return end - first
+
+def scale_text_pypdfium2(path, worker, num_workers):
+    import pypdfium2
+    doc = pypdfium2.PdfDocument(path)
+    first, end = _page_range(len(doc), worker, num_workers)
+    for pno in range(first, end):
+        doc[pno].get_textpage().get_text_range()
+    doc.close()
+    return end - first
+
+
+# Synthetic input files.
 #
 
-def log(text):
-    print(f'{os.getpid()=}: {text}')
-    sys.stdout.flush()
+def corpus_generate(path, **params):
+    return corpus.generate(path, **params)
+
+def corpus_describe(path):
+    return corpus.describe(path)
 
 
-def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LIMITED_API=None):
+# Other
+#
+
+def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LIMITED_API=None, build_cache=None, cpus=None):
     '''
     Builds and installs PyMuPDF using pip.
 
@@ -635,9 +4037,56 @@ def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LI
         Local git directory if `pymupdf_location` starts with 'git:'.
     Py_LIMITED_API:
         If set we build for specified version of limited API.
+    build_cache:
+        If not None, a directory in which we cache builds. We look for a
+        build matching the key returned by _build_cache_key(), and if found
+        we copy it to `root` instead of cloning and building. Otherwise after
+        building we copy `root` into the build cache.
+    cpus:
+        If not None, list of CPUs to which the build is restricted, using
+        `taskset`. We also set MAKEFLAGS to use the same number of jobs.
+        This limits the number of concurrent compiler jobs, and keeps builds
+        off CPUs used by concurrently running tests.
+
+    Builds that use the same local PyMuPDF or MuPDF checkout are serialised;
+    see _build_tree_lock().
+
+    Returns a dict containing:
+        'cache': 'hit', 'miss' or None if not using the build cache.
+        'key': Build cache key or None.
+        't': Time taken.
     '''
     if not pymupdf_location:
         return
+    t0 = time.perf_counter()
+    ret = dict(cache=None, key=None)
+    def run(command, check=1):
+        # We may be running in a thread, where subprocess's `preexec_fn` is
+        # unsafe, so we use taskset to set CPU affinity.
+        if cpus:
+            command = f'taskset -c {",".join(str(cpu) for cpu in sorted(cpus))} sh -c {shlex.quote(command)}'
+        log(f'Running: {command}')
+        subprocess.run(command, shell=1, check=check)
+
+    if Py_LIMITED_API == 'default':
+        major, minor, patch = platform.python_version_tuple()
+        Py_LIMITED_API = f'0x{int(major):02x}{int(minor):02x}0000'
+
+    if build_cache and root:
+        key = _build_cache_key(pymupdf_location, mupdf_location, Py_LIMITED_API)
+        if key:
+            ret['key'] = key
+            if _build_cache_get(build_cache, key, root):
+                ret['cache'] = 'hit'
+                ret['t'] = time.perf_counter() - t0
+                return ret
+            ret['cache'] = 'miss'
+
+    # MuPDF git locations are cloned by the build itself, so we can only
+    # check that the branch has not moved while we were building.
+    mupdf_git_sha = None
+    if ret['cache'] == 'miss' and mupdf_location and mupdf_location.startswith('git:'):
+        mupdf_git_sha = _git_sha(mupdf_location)
 
     git_prefix = 'git:'
     if pymupdf_location.startswith(git_prefix):
@@ -648,14 +4097,11 @@ def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LI
         command += f' --depth 1'
         command += f' {command_suffix}'
         command += f' {pymupdf_location}'
-        log(f'Running: {command}')
-        subprocess.run(command, shell=1, check=1)
+        run(command)
 
         # Show sha of checkout.
-        command = f'cd {pymupdf_location} && git show --pretty=oneline|head -n 1'
-        log( f'Running: {command}')
         sys.stdout.flush()
-        subprocess.run( command, shell=1, check=0)
+        run(f'cd {pymupdf_location} && git show --pretty=oneline|head -n 1', check=0)
 
     assert os.path.isdir(pymupdf_location), f'{pymupdf_location=}'
 
@@ -668,10 +4114,9 @@ def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LI
         else:
             env += f'PYMUPDF_SETUP_MUPDF_BUILD="{os.path.relpath(mupdf_location, pymupdf_location)}" '
     if Py_LIMITED_API:
-        if Py_LIMITED_API == 'default':
-            major, minor, patch = platform.python_version_tuple()
-            Py_LIMITED_API = f'0x{int(major):02x}{int(minor):02x}0000'
         env += f'PYMUPDF_SETUP_Py_LIMITED_API={Py_LIMITED_API} '
+    if cpus:
+        env += f'MAKEFLAGS=-j{len(cpus)} '
     if platform.system() == 'OpenBSD':
         # Need to use system clang-python and swig because they are not
         # available in pypi.org and building from sdist fails.
@@ -683,13 +4128,223 @@ def pymupdf_install(pymupdf_location, mupdf_location, root, local_git_dir, Py_LI
         if root:
             # This creates `<root>/pymupdf/{pymupdf.py,...}`.
             command = f'{command} --upgrade --target {os.path.relpath(root, pymupdf_location)}'
-    log( f'Running: {command}')
-    subprocess.run( command, shell=1, check=1)
+    with _build_tree_lock(pymupdf_location, mupdf_location):
+        run(command)
+
+    if ret['cache'] == 'miss':
+        # The key we looked up used `git ls-remote` for git locations, but a
+        # branch may have moved before we cloned it, so we use the sha of
+        # the PyMuPDF checkout that we actually built.
+        key = _build_cache_key(pymupdf_location, mupdf_location, Py_LIMITED_API)
+        if mupdf_git_sha and _git_sha(mupdf_location) != mupdf_git_sha:
+            log(f'Not caching build because {mupdf_location=} has changed during the build.')
+            key = None
+        if key:
+            ret['key'] = key
+            _build_cache_put(build_cache, key, root)
+        else:
+            ret['cache'] = None
+            ret['key'] = None
+    ret['t'] = time.perf_counter() - t0
+    return ret
+
+
+# Locks for local checkouts used by PyMuPDF builds; see _build_tree_lock().
+#
+_build_tree_locks = dict()
+_build_tree_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _build_tree_lock(*locations):
+    '''
+    Context manager that holds a lock for each local directory in
+    `locations` (ignoring None and 'git:...' locations), so that concurrent
+    builds do not build in the same PyMuPDF or MuPDF checkout at the same
+    time.
+    '''
+    paths = sorted(set(
+            os.path.realpath(location)
+            for location in locations
+            if location and not location.startswith('git:')
+            ))
+    with _build_tree_locks_lock:
+        locks = [_build_tree_locks.setdefault(path, threading.Lock()) for path in paths]
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+
+def _git_sha(location):
+    '''
+    Returns git sha of `location`, or None if it cannot be found.
+
+    If `location` starts with `git:`, the remaining text is treated as `git
+    clone` args as in pymupdf_install(), and we use `git ls-remote` to find
+    the current sha of the specified branch or tag, without cloning. The
+    branch may have moved by the time it is cloned, so use a clone's own sha
+    where possible.
+
+    Otherwise `location` should be a local git checkout; if it has local
+    changes, we append a hash of `git diff HEAD`.
+    '''
+    if location.startswith('git:'):
+        args = shlex.split(location[len('git:'):])
+        url = args[-1]
+        branch = 'HEAD'
+        if '--branch' in args:
+            branch = args[args.index('--branch') + 1]
+        cp = subprocess.run(['git', 'ls-remote', url, branch], capture_output=1, text=1)
+        if cp.returncode:
+            log(f'Cannot find sha of {location=}: {cp.stderr}')
+            return None
+        shas = dict()
+        for line in cp.stdout.split('\n'):
+            if line.strip():
+                sha, ref = line.split('\t')
+                shas[ref] = sha
+        for ref in f'refs/tags/{branch}^{{}}', f'refs/tags/{branch}', f'refs/heads/{branch}', branch:
+            if ref in shas:
+                return shas[ref]
+        log(f'Cannot find sha of {location=} in: {cp.stdout}')
+        return None
+    cp = subprocess.run(f'cd {location} && git rev-parse HEAD', shell=1, capture_output=1, text=1)
+    if cp.returncode:
+        log(f'Cannot find sha of {location=}: {cp.stderr}')
+        return None
+    sha = cp.stdout.strip()
+    cp = subprocess.run(f'cd {location} && git diff HEAD', shell=1, capture_output=1)
+    if cp.stdout:
+        sha += '-' + hashlib.sha256(cp.stdout).hexdigest()[:16]
+    return sha
+
+
+def _build_cache_key(pymupdf_location, mupdf_location, Py_LIMITED_API):
+    '''
+    Returns build cache key for PyMuPDF build, or None if we cannot find git
+    shas.
+
+    The key is a hash of the PyMuPDF and MuPDF git shas, Py_LIMITED_API, the
+    compiler version and the Python version.
+    '''
+    pymupdf_sha = _git_sha(pymupdf_location)
+    if not pymupdf_sha:
+        return None
+    mupdf_sha = None
+    if mupdf_location:
+        mupdf_sha = _git_sha(mupdf_location)
+        if not mupdf_sha:
+            return None
+    cc = os.environ.get('CC') or sysconfig.get_config_var('CC') or 'cc'
+    cp = subprocess.run(f'{cc} --version', shell=1, capture_output=1, text=1)
+    compiler = cp.stdout.split('\n')[0]
+    items = [
+            pymupdf_sha,
+            mupdf_sha,
+            Py_LIMITED_API,
+            cc,
+            compiler,
+            platform.python_implementation(),
+            platform.python_version(),
+            platform.system(),
+            platform.machine(),
+            ]
+    key = hashlib.sha256(json.dumps(items).encode('utf8')).hexdigest()[:32]
+    log(f'Build cache key is {key} for: {items}')
+    return key
+
+
+def _build_cache_get(build_cache, key, root):
+    '''
+    If build cache contains `key`, copies it to `root` and returns True.
+    Otherwise returns False.
+    '''
+    meta_path = f'{build_cache}/{key}/meta.json'
+    if not os.path.exists(meta_path):
+        log(f'Build cache miss: {key=}.')
+        return False
+    log(f'Build cache hit: {key=}. Copying {build_cache}/{key}/tree to {root}.')
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    shutil.copytree(f'{build_cache}/{key}/tree', root, symlinks=True)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['last_used'] = time.time()
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent='    ', sort_keys=1)
+    return True
+
+
+def _build_cache_put(build_cache, key, root):
+    '''
+    Copies `root` into build cache as `key`.
+    '''
+    directory = f'{build_cache}/{key}'
+    directory_tmp = f'{directory}-{os.getpid()}'
+    if os.path.exists(directory_tmp):
+        shutil.rmtree(directory_tmp)
+    shutil.copytree(root, f'{directory_tmp}/tree', symlinks=True)
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(f'{directory_tmp}/tree'):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    with open(f'{directory_tmp}/meta.json', 'w') as f:
+        json.dump(dict(size=size, created=time.time(), last_used=time.time()), f, indent='    ', sort_keys=1)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(directory_tmp, directory)
+    log(f'Have added {root} to build cache: {key=} {size=}.')
+
+
+def build_cache_evict(build_cache, max_bytes=None, max_age_days=None):
+    '''
+    Removes builds from build cache that were last used more than
+    `max_age_days` ago, then removes least recently used builds until the
+    total size is no more than `max_bytes`.
+    '''
+    if not os.path.isdir(build_cache):
+        return
+    entries = list()
+    for key in os.listdir(build_cache):
+        try:
+            with open(f'{build_cache}/{key}/meta.json') as f:
+                meta = json.load(f)
+        except Exception:
+            # Incomplete entry, e.g. from an interrupted run.
+            continue
+        entries.append((meta['last_used'], meta['size'], key))
+    entries.sort()
+    total = sum(size for last_used, size, key in entries)
+    for last_used, size, key in entries:
+        too_old = max_age_days is not None and time.time() - last_used > max_age_days * 24 * 3600
+        too_big = max_bytes is not None and total > max_bytes
+        if not too_old and not too_big:
+            continue
+        log(f'Removing build from build cache: {key=} {size=} {too_old=} {too_big=}.')
+        shutil.rmtree(f'{build_cache}/{key}')
+        total -= size
 
 
 if __name__ == '__main__':
     venv_install = True
     internal_check = False
+    jobs = 1
+    warm = False
+    scaling = None
+    io_modes = []
+    compare_with = None
+    compare_threshold = 0.05
+    compare_alpha = 0.05
+    compare_fail = False
+    build_cache = os.path.abspath(f'{__file__}/../build-cache')
+    build_cache_max_days = 30
+    build_cache_max_gb = 10
+    build_background = False
+    build_cpus = None
+    build_jobs = 1
+    sweeps = []
+    validate = False
+    validate_reference = None
     do = None
     mupdf_master_location = 'git:--branch master https://github.com/ArtifexSoftware/mupdf.git'
     mupdf_branch_location = 'git:--branch 1.24.x https://github.com/ArtifexSoftware/mupdf.git'
@@ -702,9 +4357,23 @@ if __name__ == '__main__':
     paths = []
     tools = []
     austin = False
+    ab = None
+    grid = False
+    grid_filters = dict()
+    resume = False
+    py_spy = None
     cprofile = False
     build_check = True
     perf = False
+    perf_counters = False
+    rss_interval = None
+    warmup = 0
+    repeat = 1
+    repeat_ci = None
+    repeat_budget = None
+    history_path = os.path.abspath(f'{__file__}/../history.sqlite3')
+    timeout_k = 5
+    repeat_max = 20
 
     args = iter(sys.argv[1:])
     while 1:
@@ -717,18 +4386,79 @@ if __name__ == '__main__':
             log(__doc__)
             sys.exit()
 
+        elif arg == '--ab':
+            ab = next(args).split(',')
+            assert len(ab) >= 2, f'--ab needs at least two toolnames: {ab=}'
+            for name in ab:
+                assert not re.search( '[^a-zA-Z0-9_]', name), f'Tool name must contain just letters, numbers and underscores: {name!r}'
+                if name not in tools:
+                    tools.append(name)
+
         elif arg == '--austin':
             austin = next(args)
 
+        elif arg == '--build-cache':
+            build_cache = next(args)
+            if build_cache == '0':
+                build_cache = None
+
+        elif arg == '--build-cache-max-days':
+            build_cache_max_days = float(next(args))
+
+        elif arg == '--build-cache-max-gb':
+            build_cache_max_gb = float(next(args))
+
         elif arg == '--build-check':
             build_check = int( next(args))
 
+        elif arg == '--build-background':
+            build_background = int(next(args))
+
+        elif arg == '--build-cpus':
+            build_cpus = int(next(args))
+
+        elif arg == '--build-jobs':
+            build_jobs = int(next(args))
+
+        elif arg == '--compare':
+            compare_with = next(args)
+
+        elif arg == '--compare-alpha':
+            compare_alpha = float(next(args))
+
+        elif arg == '--compare-fail':
+            compare_fail = int(next(args))
+
+        elif arg == '--compare-threshold':
+            compare_threshold = float(next(args))
+
         elif arg == '--cprofile':
             cprofile = int(next(args))
 
+        elif arg == '--grid':
+            grid = int(next(args))
+
+        elif arg == '--grid-only':
+            name, values = next(args).split('=')
+            grid_filters[name] = values.split(',')
+            grid = True
+
+        elif arg == '--history':
+            history_path = next(args)
+            if history_path == '0':
+                history_path = None
+
         elif arg == '--internal-check':
             internal_check = int(next(args))
 
+        elif arg == '--io':
+            io_mode = next(args)
+            assert io_mode in ('disk', 'memory', 'mmap'), f'Unrecognised {io_mode=}'
+            io_modes.append(io_mode)
+
+        elif arg == '--jobs':
+            jobs = int(next(args))
+
         elif arg == '--mupdf-branch':
             mupdf_branch_location = next(args)
 
@@ -741,9 +4471,15 @@ if __name__ == '__main__':
         elif arg == '--perf':
             perf = int( next(args))
 
+        elif arg == '--perf-counters':
+            perf_counters = int(next(args))
+
         elif arg == '--pip-install':
             pip_install = int(next(args))
 
+        elif arg == '--py-spy':
+            py_spy = next(args)
+
         elif arg == '--pymupdf':
             pymupdf_location = next(args)
 
@@ -753,19 +4489,66 @@ if __name__ == '__main__':
         elif arg == '--pymupdf-build':
             pymupdf_build = int(next(args))
 
+        elif arg == '--repeat':
+            repeat = int(next(args))
+
+        elif arg == '--repeat-budget':
+            repeat_budget = float(next(args))
+
+        elif arg == '--repeat-ci':
+            repeat_ci = float(next(args))
+
+        elif arg == '--repeat-max':
+            repeat_max = int(next(args))
+
+        elif arg == '--resume':
+            resume = int(next(args))
+
+        elif arg == '--rss-interval':
+            rss_interval = float(next(args))
+
+        elif arg == '--scaling':
+            scaling = next(args)
+            if scaling == 'auto':
+                scaling = [1]
+                while scaling[-1] * 2 <= len(os.sched_getaffinity(0)):
+                    scaling.append(scaling[-1] * 2)
+            else:
+                scaling = [int(n) for n in scaling.split(',')]
+
         elif arg == '--timeout':
             timeout = float(next(args))
 
+        elif arg == '--timeout-k':
+            timeout_k = float(next(args))
+
         elif arg == '--tool':
             name = next(args)
             assert not re.search( '[^a-zA-Z0-9_]', name), f'Tool name must contain just letters, numbers and underscores: {name!r}'
             tools.append(name)
 
+        elif arg == '--sweep':
+            param, values = next(args).split('=')
+            assert param in corpus.params_default, f'Unrecognised sweep {param=}, should be one of: {list(corpus.params_default)}'
+            sweeps.append((param, [int(v) for v in values.split(',')]))
+
         elif arg == '--test':
             tests.append(next(args))
 
+        elif arg == '--validate':
+            validate = int(next(args))
+
+        elif arg == '--validate-reference':
+            validate_reference = next(args)
+
         elif arg == '--venv-install':
             venv_install = int(next(args))
+
+        elif arg == '--warm':
+            warm = int(next(args))
+
+        elif arg == '--warmup':
+            warmup = int(next(args))
         else:
             raise Exception(f'Unrecognised {arg=}')
 
@@ -792,6 +4575,8 @@ if __name__ == '__main__':
                 command += f' && python -m pip install --upgrade pypdf2 pdfminer.six pdfrw pikepdf pdf2jpg pypdfium2'
                 if not pymupdf_location:
                     command += ' && python -m pip install --upgrade pymupdf'
+                if py_spy == 'py-spy':
+                    command += ' && python -m pip install --upgrade py-spy'
         # Rerun ourselves inside the venv.
         command += f' &&'
         if austin:
@@ -837,12 +4622,12 @@ if __name__ == '__main__':
         
         def _make_pymupdf_variant(fnname, fn, install_dir):
             '''
-            Make global function `{fnname}(path)` that imports pymupdf from
-            `install_dir` and calls `fn(path)`.
+            Make global function `{fnname}(*args, **kwargs)` that imports
+            pymupdf from `install_dir` and calls `fn(*args, **kwargs)`.
             '''
-            def fn2(path, install_dir=install_dir):
+            def fn2(*args, **kwargs):
                 _import_pymupdf(install_dir)
-                return fn(path)
+                return fn(*args, **kwargs)
             assert getattr(globals(), fnname, None) is None
             globals()[fnname] = fn2
         
@@ -854,17 +4639,58 @@ if __name__ == '__main__':
             install_dir = os.path.abspath(f'{__file__}/../install_{name}')
             log(f'Building PyMuPDF, {name=} {pymupdf_location=} {mupdf_location=} {Py_LIMITED_API=} {install_dir=}.')
             _make_pymupdf_variant_norgs(f'get_version_{name}', get_version_pymupdf, install_dir)
-            _make_pymupdf_variant(f'do_copy_{name}', do_copy_pymupdf, install_dir)
-            _make_pymupdf_variant(f'do_render_{name}', do_render_pymupdf, install_dir)
-            _make_pymupdf_variant(f'do_text_{name}', do_text_pymupdf, install_dir)
+            for fnname, fn in list(globals().items()):
+                match = re.match('^(do|scale)_([a-z]+)_pymupdf$', fnname)
+                if match:
+                    _make_pymupdf_variant(f'{match.group(1)}_{match.group(2)}_{name}', fn, install_dir)
+            _make_pymupdf_variant(f'corpus_generate_{name}', corpus_generate, install_dir)
+            _make_pymupdf_variant(f'corpus_describe_{name}', corpus_describe, install_dir)
             if pymupdf_build:
-                try:
-                    pymupdf_install(pymupdf_location, mupdf_location, install_dir, name, Py_LIMITED_API)
-                except Exception as e:
-                    if build_check:
-                        raise
-                    log(f'*** Ignoring exception from building {name=} {pymupdf_location=} {mupdf_location=}: {e}')
+                pending[name] = build_executor.submit(_build, name, pymupdf_location, mupdf_location, install_dir, Py_LIMITED_API)
+
+        def _build(name, pymupdf_location, mupdf_location, install_dir, Py_LIMITED_API):
+            '''
+            Builds PyMuPDF variant `name`. Returns true on success. Run in
+            `build_executor` thread.
+            '''
+            t0 = time.perf_counter()
+            ok = True
+            try:
+                build = pymupdf_install(pymupdf_location, mupdf_location, install_dir, name, Py_LIMITED_API, build_cache, build_cpu_set)
+            except Exception as e:
+                if build_check:
+                    raise
+                log(f'*** Ignoring exception from building {name=} {pymupdf_location=} {mupdf_location=}: {e}')
+                build = dict(cache=None, key=None, t=time.perf_counter() - t0, e=str(e))
+                ok = False
+            if build:
+                builds[name] = build
+                log(f'Build of {name=}: cache={build["cache"]} t={build["t"]:.1f}s.')
+            return ok
         
+        builds = dict()
+        pending = dict()
+        build_executor = concurrent.futures.ThreadPoolExecutor(build_jobs)
+        build_cpu_set = None
+        test_cpus = None
+        assert build_cpus or not build_background, f'--build-background 1 requires --build-cpus.'
+        if build_cpus:
+            all_cpus = sorted(os.sched_getaffinity(0))
+            assert build_cpus < len(all_cpus), f'{build_cpus=} must be less than number of CPUs {len(all_cpus)}.'
+            build_cpu_set = set(all_cpus[-build_cpus:])
+            test_cpus = all_cpus[:-build_cpus]
+        if build_cache:
+            build_cache_evict(build_cache, build_cache_max_gb * 2**30, build_cache_max_days)
+
+        # Measure the machine before any background builds start competing
+        # with the tests, so that the drift between start and end
+        # calibrations is not just the builds finishing.
+        environment_start = None
+        calibration_start = None
+        if build_background and not internal_check:
+            environment_start = environment()
+            calibration_start = calibrate_run(test_cpus[0])
+
         #if mupdfpy_mupdf_master:
         #    _make(
         #            'mupdfpy_mupdf_master',
@@ -891,8 +4717,17 @@ if __name__ == '__main__':
                     mupdf_master_location,
                     Py_LIMITED_API='default',
                     )
+
+        if not build_background:
+            # Don't run any tests until all builds have finished. With
+            # --build-check 1, a failed build's exception is raised here by
+            # future.result(), before we spend time on tests. Otherwise tests
+            # of variants whose builds failed are dropped by performance().
+            concurrent.futures.wait(pending.values())
+            for future in pending.values():
+                future.result()
         
-        performance(
+        results = performance(
                 tests=tests,
                 paths=paths,
                 tools=tools,
@@ -900,4 +4735,37 @@ if __name__ == '__main__':
                 internal_check=internal_check,
                 austin=austin,
                 cprofile=cprofile,
+                warmup=warmup,
+                repeat=repeat,
+                repeat_ci=repeat_ci,
+                repeat_max=repeat_max,
+                rss_interval=rss_interval,
+                jobs=jobs,
+                warm=warm,
+                scaling=scaling,
+                io_modes=io_modes,
+                compare_with=compare_with,
+                compare_threshold=compare_threshold,
+                compare_alpha=compare_alpha,
+                builds=builds,
+                pending=pending,
+                cpus=test_cpus,
+                sweeps=sweeps,
+                validate=validate,
+                validate_reference=validate_reference,
+                py_spy=py_spy,
+                history_path=history_path,
+                timeout_k=timeout_k,
+                repeat_budget=repeat_budget,
+                ab=ab,
+                grid=grid,
+                grid_filters=grid_filters,
+                environment_start=environment_start,
+                calibration_start=calibration_start,
+                perf_counters=perf_counters,
+                resume=resume,
                 )
+        build_executor.shutdown()
+        if compare_fail and results.get('comparison', dict()).get('regressions'):
+            log(f'Exiting with error because of regressions.')
+            sys.exit(1)
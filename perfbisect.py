@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+'''
+Finds the first MuPDF or PyMuPDF commit that made a test slower, by bisecting
+between a good and a bad commit.
+
+Usage:
+
+    perfbisect.py <args>
+
+Args:
+
+    --alpha <alpha>
+        Significance level for the Mann-Whitney U test. Default is 0.05.
+
+    --bad <sha>
+    --good <sha>
+        Required. Shas of commits that are fast and slow. <good> must be an
+        ancestor of <bad>.
+
+    --build-cache <directory>|0
+        As main.py's --build-cache. Default is 'build-cache' in the same
+        directory as this script, so builds are reused between bisections and
+        with main.py.
+
+    --io disk|memory|mmap
+        As main.py's --io. Default is 'disk'.
+
+    --mupdf <location>
+    --pymupdf <location>
+        Locations of MuPDF and PyMuPDF, as in main.py. The repository being
+        bisected (see --repo) is cloned into 'bisect-<repo>'; the other
+        repository is used at a fixed version. Defaults are MuPDF master and
+        PyMuPDF main from github.com.
+
+    --out <path>
+        Write report as JSON to <path>. Default is
+        'bisect-<date>.json'.
+
+    --path <path>
+        Required. Input PDF file.
+
+    --repeat <n>
+        Initial number of timed runs for each commit. Default is 5.
+
+    --repeat-max <n>
+        If a commit cannot be confidently classified as good or bad, we do
+        more runs, doubling the number of samples up to <n>. Default is 40.
+
+    --repo mupdf|pymupdf
+        Repository to bisect. Default is 'mupdf'.
+
+    --test <testname>
+        Required. Test to run, e.g. 'render'; we use main.py's
+        do_<testname>_pymupdf().
+
+    --threshold <fraction>
+        Minimum relative change in median time that counts as a regression.
+        Default is 0.05.
+
+    --timeout <seconds>
+        Timeout for each run. Default is 300.
+
+We first time <good> and <bad>, and stop if <bad> is not significantly slower
+than <good>. Then we bisect the first-parent commits between them. Each commit
+is built with main.pymupdf_install(), using the build cache, and timed with
+--repeat runs in child processes. A commit is bad if it is significantly
+slower than <good> (p < --alpha with the Mann-Whitney U test) and its median
+time is closer to <bad>'s than to <good>'s; it is good if it is significantly
+faster than <bad> and closer to <good>. Otherwise we add more samples. Commits
+that fail to build are skipped, as with `git bisect skip`.
+'''
+
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+import compare
+import main
+
+
+def clone(location, directory):
+    '''
+    Makes `directory` a full clone of `location` (a local directory or
+    'git:...' location as in main.py), or fetches into it if it already
+    exists.
+    '''
+    if location.startswith('git:'):
+        args = location[len('git:'):].split()
+        url = args[-1]
+    else:
+        url = os.path.abspath(location)
+    if os.path.isdir(f'{directory}/.git'):
+        command = f'cd {directory} && git fetch -q {url} "+refs/heads/*:refs/remotes/origin/*"'
+    else:
+        command = f'git clone -q {url} {directory}'
+    main.log(f'Running: {command}')
+    subprocess.run(command, shell=1, check=1)
+
+
+def commits(directory, good, bad):
+    '''
+    Returns list of first-parent commits from `good` to `bad` inclusive, in
+    `directory`, as `(sha, subject)` tuples.
+    '''
+    def git(command):
+        return subprocess.run(f'cd {directory} && {command}', shell=1, check=1, capture_output=1, text=1).stdout.strip()
+    good = git(f'git rev-parse {good}')
+    bad = git(f'git rev-parse {bad}')
+    ret = list()
+    for line in git(f'git log --first-parent --ancestry-path --format="%H %s" {good}..{bad}').split('\n'):
+        if line:
+            sha, _, subject = line.partition(' ')
+            ret.append((sha, subject))
+    ret.reverse()
+    assert ret and ret[-1][0] == bad, f'{good=} is not an ancestor of {bad=}.'
+    ret.insert(0, (good, git(f'git log -1 --format=%s {good}')))
+    return ret
+
+
+def checkout(directory, sha):
+    '''
+    Checks out `sha` in `directory`, including submodules.
+    '''
+    command = f'cd {directory} && git checkout -q --detach {sha} && git submodule -q update --init --recursive'
+    main.log(f'Running: {command}')
+    subprocess.run(command, shell=1, check=1)
+
+
+class Bisect:
+    '''
+    State of a bisection; see module docstring for details.
+    '''
+    def __init__(
+            self,
+            repo,
+            mupdf_location,
+            pymupdf_location,
+            testname,
+            path,
+            io_mode='disk',
+            build_cache=None,
+            repeat=5,
+            repeat_max=40,
+            alpha=0.05,
+            threshold=0.05,
+            timeout=300,
+            ):
+        self.repo = repo
+        self.testname = testname
+        self.path = path
+        self.io_mode = io_mode
+        self.build_cache = build_cache
+        self.repeat = repeat
+        self.repeat_max = repeat_max
+        self.alpha = alpha
+        self.threshold = threshold
+        self.timeout = timeout
+        root = os.path.abspath(f'{__file__}/..')
+        self.install_dir = f'{root}/install_bisect'
+        self.directory = f'{root}/bisect-{repo}'
+        # The repository being bisected is cloned into `self.directory`;
+        # a git location for the other repository is cloned once so that
+        # its sha is fixed for the whole bisection.
+        if repo == 'mupdf':
+            clone(mupdf_location, self.directory)
+            self.mupdf_location = self.directory
+            self.pymupdf_location = self._fixed(pymupdf_location, f'{root}/bisect-pymupdf-fixed')
+        else:
+            assert repo == 'pymupdf', f'Unrecognised {repo=}'
+            clone(pymupdf_location, self.directory)
+            self.pymupdf_location = self.directory
+            self.mupdf_location = self._fixed(mupdf_location, f'{root}/bisect-mupdf-fixed')
+        if io_mode == 'memory':
+            with open(path, 'rb') as f:
+                main._io_input_data[path] = f.read()
+        self.evidence = dict()  # Maps from sha to dict.
+        self.installed = None   # Sha currently in `self.install_dir`.
+
+    def _fixed(self, location, directory):
+        if location and location.startswith('git:'):
+            if not os.path.isdir(directory):
+                command = f'git clone -q --depth 1 --recurse-submodules {location[len("git:"):]} {directory}'
+                main.log(f'Running: {command}')
+                subprocess.run(command, shell=1, check=1)
+            return directory
+        return location
+
+    def measure(self, sha, subject, samples_min=None):
+        '''
+        Builds `sha` if necessary and adds timings to `self.evidence[sha]`
+        until it has at least `samples_min` (default `self.repeat`) samples.
+        Returns the evidence dict, whose `e` item is non-zero if the build
+        or test failed.
+        '''
+        if samples_min is None:
+            samples_min = self.repeat
+        evidence = self.evidence.get(sha)
+        if evidence and (evidence['e'] or len(evidence['samples']) >= samples_min):
+            return evidence
+        if not evidence:
+            evidence = dict(sha=sha, subject=subject, samples=list(), e=0, build=None)
+            self.evidence[sha] = evidence
+        main.log(f'### Measuring {sha} {subject!r}: {samples_min=}')
+        # `self.install_dir` is shared by all commits, so we may need to
+        # reinstall a commit that we have measured before; with the build
+        # cache this is just a copy.
+        if self.installed != sha:
+            self.installed = None
+            checkout(self.directory, sha)
+            try:
+                evidence['build'] = main.pymupdf_install(
+                        self.pymupdf_location,
+                        self.mupdf_location,
+                        self.install_dir,
+                        None,
+                        build_cache=self.build_cache,
+                        )
+            except Exception as e:
+                main.log(f'Build of {sha} failed: {e}')
+                evidence['e'] = f'Build failed: {e}'
+                return evidence
+            self.installed = sha
+        install_dir = self.install_dir
+        args = self.io_mode, f'do_{self.testname}_pymupdf', dict(), self.path
+        def fn():
+            main._import_pymupdf(install_dir)
+            return main._io_call(*args)
+        samples, ee, infos, t_failed = main.run_samples(
+                fn,
+                self.timeout,
+                warmup=1,
+                repeat=samples_min - len(evidence['samples']),
+                )
+        evidence['samples'] += samples
+        evidence['e'] = ee
+        evidence['stats'] = main._stats(evidence['samples'])
+        main.log(f'### {sha}: {evidence["stats"]}')
+        return evidence
+
+    def classify(self, sha, subject, good, bad):
+        '''
+        Returns 'good', 'bad' or 'skip' for commit `sha`, given evidence dicts
+        for the good and bad commits. Adds more samples until we are confident
+        or have `self.repeat_max` samples, in which case we use the nearest
+        median.
+        '''
+        n = self.repeat
+        while 1:
+            evidence = self.measure(sha, subject, n)
+            if evidence['e']:
+                evidence['verdict'] = 'skip'
+                return 'skip'
+            t = evidence['stats']['median']
+            t_good = good['stats']['median']
+            t_bad = bad['stats']['median']
+            p_good = compare.mann_whitney_u(good['samples'], evidence['samples'])
+            p_bad = compare.mann_whitney_u(bad['samples'], evidence['samples'])
+            evidence['p_good'] = p_good
+            evidence['p_bad'] = p_bad
+            closer_to_bad = abs(math.log(t / t_bad)) < abs(math.log(t / t_good))
+            if closer_to_bad and p_good < self.alpha:
+                verdict = 'bad'
+            elif not closer_to_bad and p_bad < self.alpha:
+                verdict = 'good'
+            elif n >= self.repeat_max:
+                verdict = 'bad' if closer_to_bad else 'good'
+                evidence['uncertain'] = True
+            else:
+                n = min(n * 2, self.repeat_max)
+                # Also get more samples for the endpoints, so that
+                # significance tests have enough data.
+                self.measure(good['sha'], good['subject'], n)
+                self.measure(bad['sha'], bad['subject'], n)
+                continue
+            evidence['verdict'] = verdict
+            main.log(f'### {sha} is {verdict}: {t=} {t_good=} {t_bad=} {p_good=} {p_bad=}')
+            return verdict
+
+    def run(self, good, bad):
+        '''
+        Runs bisection and returns report dict.
+        '''
+        commits_ = commits(self.directory, good, bad)
+        main.log(f'Bisecting {len(commits_)} commits from {commits_[0]} to {commits_[-1]}.')
+        report = dict(
+                repo=self.repo,
+                testname=self.testname,
+                path=self.path,
+                io=self.io_mode,
+                good=commits_[0][0],
+                bad=commits_[-1][0],
+                num_commits=len(commits_),
+                first_bad=None,
+                evidence=list(),
+                )
+        e_good = self.measure(*commits_[0])
+        e_bad = self.measure(*commits_[-1])
+        if e_good['e'] or e_bad['e']:
+            report['e'] = f'Cannot measure good or bad commit: {e_good["e"]=} {e_bad["e"]=}'
+            return self._finish(report)
+        change = e_bad['stats']['median'] / e_good['stats']['median'] - 1
+        p = compare.mann_whitney_u(e_good['samples'], e_bad['samples'])
+        report['change'] = change
+        report['p'] = p
+        if change < self.threshold or p >= self.alpha:
+            report['e'] = f'Bad commit is not significantly slower than good commit: {change=} {p=}'
+            return self._finish(report)
+
+        lo = 0
+        hi = len(commits_) - 1
+        skipped = set()
+        while hi - lo > 1:
+            # Try the middle commit, or the nearest one that has not been
+            # skipped.
+            mid = (lo + hi) // 2
+            candidates = sorted(
+                    (i for i in range(lo + 1, hi) if i not in skipped),
+                    key=lambda i: abs(i - mid),
+                    )
+            if not candidates:
+                break
+            i = candidates[0]
+            verdict = self.classify(*commits_[i], e_good, e_bad)
+            if verdict == 'skip':
+                skipped.add(i)
+            elif verdict == 'good':
+                lo = i
+            else:
+                hi = i
+        if hi - lo == 1:
+            report['first_bad'] = commits_[hi][0]
+        else:
+            report['candidates'] = [sha for sha, subject in commits_[lo + 1:hi + 1]]
+        report['last_good'] = commits_[lo][0]
+        return self._finish(report)
+
+    def _finish(self, report):
+        report['evidence'] = list(self.evidence.values())
+        return report
+
+
+def text(report):
+    '''
+    Returns text description of bisection report.
+    '''
+    lines = list()
+    lines.append(f'Bisection of {report["repo"]} for {report["testname"]} {report["path"]} io={report["io"]}:')
+    lines.append(f'    good: {report["good"]}')
+    lines.append(f'    bad:  {report["bad"]}')
+    if report.get('change') is not None:
+        lines.append(f'    change: {report["change"]*100:+.1f}% p={report["p"]:.3g}')
+    if report.get('e'):
+        lines.append(f'    error: {report["e"]}')
+    if report['first_bad']:
+        lines.append(f'    first bad commit: {report["first_bad"]}')
+    elif report.get('candidates'):
+        lines.append(f'    first bad commit is one of (others failed to build): {" ".join(report["candidates"])}')
+    lines.append(f'    evidence:')
+    for evidence in report['evidence']:
+        stats = evidence.get('stats') or dict()
+        text = f'        {evidence["sha"][:12]} {evidence.get("verdict", "endpoint"):8}'
+        if stats:
+            text += f' median={stats["median"]:.4f}s ci95={stats["ci95"][0]:.4f}..{stats["ci95"][1]:.4f} n={stats["n"]}'
+        if 'p_good' in evidence:
+            text += f' p_good={evidence["p_good"]:.3g} p_bad={evidence["p_bad"]:.3g}'
+        if evidence.get('uncertain'):
+            text += ' (uncertain)'
+        if evidence['e']:
+            text += f' e={evidence["e"]}'
+        text += f' {evidence["subject"]}'
+        lines.append(text)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    alpha = 0.05
+    bad = None
+    build_cache = os.path.abspath(f'{__file__}/../build-cache')
+    good = None
+    io_mode = 'disk'
+    mupdf_location = 'git:--branch master https://github.com/ArtifexSoftware/mupdf.git'
+    out = None
+    path = None
+    pymupdf_location = 'git:--branch main https://github.com/pymupdf/PyMuPDF.git'
+    repeat = 5
+    repeat_max = 40
+    repo = 'mupdf'
+    testname = None
+    threshold = 0.05
+    timeout = 300
+    args = iter(sys.argv[1:])
+    while 1:
+        try:
+            arg = next(args)
+        except StopIteration:
+            break
+        if arg == '-h' or arg == '--help':
+            main.log(__doc__)
+            sys.exit()
+        elif arg == '--alpha':
+            alpha = float(next(args))
+        elif arg == '--bad':
+            bad = next(args)
+        elif arg == '--build-cache':
+            build_cache = next(args)
+            if build_cache == '0':
+                build_cache = None
+        elif arg == '--good':
+            good = next(args)
+        elif arg == '--io':
+            io_mode = next(args)
+        elif arg == '--mupdf':
+            mupdf_location = next(args)
+        elif arg == '--out':
+            out = next(args)
+        elif arg == '--path':
+            path = next(args)
+        elif arg == '--pymupdf':
+            pymupdf_location = next(args)
+        elif arg == '--repeat':
+            repeat = int(next(args))
+        elif arg == '--repeat-max':
+            repeat_max = int(next(args))
+        elif arg == '--repo':
+            repo = next(args)
+        elif arg == '--test':
+            testname = next(args)
+        elif arg == '--threshold':
+            threshold = float(next(args))
+        elif arg == '--timeout':
+            timeout = float(next(args))
+        else:
+            raise Exception(f'Unrecognised {arg=}')
+    assert good and bad and testname and path, f'--good, --bad, --test and --path are required.'
+    bisect = Bisect(
+            repo,
+            mupdf_location,
+            pymupdf_location,
+            testname,
+            path,
+            io_mode=io_mode,
+            build_cache=build_cache,
+            repeat=repeat,
+            repeat_max=repeat_max,
+            alpha=alpha,
+            threshold=threshold,
+            timeout=timeout,
+            )
+    report = bisect.run(good, bad)
+    main.log(text(report))
+    if not out:
+        out = f'bisect-{time.strftime("%Y-%m-%d-%H-%M", time.gmtime())}.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent='    ', sort_keys=1)
+    main.log(f'Have written report to: {out}')
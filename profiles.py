@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+'''
+Shows hottest functions in cProfile output from main.py's --cprofile, and
+compares profiles of different PyMuPDF variants or runs.
+
+Usage:
+
+    profiles.py [<args>] top <results.json> [<toolname>]
+        Show functions with most time, summed over all profiles in
+        <results.json>, optionally only for <toolname>.
+
+    profiles.py [<args>] diff <results.json> <toolname_a> <toolname_b>
+        Compare profiles of two tools in the same run, for example
+        pymupdf_mupdf_master and pymupdf_mupdf_branch.
+
+    profiles.py [<args>] diff <results_a.json> <results_b.json> [<toolname>]
+        Compare profiles of the same tools in two runs.
+
+Args:
+
+    --n <n>
+        Number of functions to show. Default is 20.
+
+    --sort cumulative|self
+        Sort by cumulative time (including time in callees) or self time.
+        Default is 'cumulative'.
+
+    --test <testname>
+        Only use profiles of <testname>. Can be specified multiple times.
+
+When comparing, we only use profiles of tests (testname, path, start, io) that
+are present on both sides, so that totals are comparable. Functions are
+identified by filename and function name, ignoring line numbers and the
+directory that a PyMuPDF variant was installed into, so that the same function
+in different variants is matched.
+'''
+
+import json
+import os
+import pstats
+import re
+import sys
+
+import main
+
+
+def load(results_path, toolname=None, tests=None):
+    '''
+    Returns dict mapping from `(testname, path, start, io)` to list of pstats
+    paths, for results in results file `results_path` that have a `pstats`
+    item.
+
+    Args:
+        toolname:
+            If not None, only use results for this tool.
+        tests:
+            If not None, only use results for these testnames.
+    '''
+    with open(results_path) as f:
+        results = json.load(f)
+    root = os.path.dirname(os.path.abspath(results_path))
+    ret = dict()
+    for result in results['data']:
+        if not result.get('pstats'):
+            continue
+        if toolname and result['toolname'] != toolname:
+            continue
+        if tests and result['testname'] not in tests:
+            continue
+        key = result['testname'], result['path'], result.get('start', 'cold'), result.get('io', 'disk')
+        ret.setdefault(key, list()).append(f'{root}/{result["pstats"]}')
+    return ret
+
+
+def _function_name(key):
+    '''
+    Returns normalised name for pstats function key `(filename, lineno,
+    funcname)`.
+    '''
+    filename, lineno, funcname = key
+    filename = re.sub('^.*/(site-packages|install_[^/]+)/', '', filename)
+    return f'{filename}:{funcname}'
+
+
+def aggregate(pstats_paths):
+    '''
+    Returns dict mapping from function name (see _function_name()) to dict
+    with `calls`, `self` and `cumulative` items, summed over all profiles in
+    `pstats_paths`.
+    '''
+    ret = dict()
+    for path in pstats_paths:
+        stats = pstats.Stats(path).stats
+        for key, (cc, nc, tt, ct, callers) in stats.items():
+            item = ret.setdefault(_function_name(key), dict(calls=0, self=0, cumulative=0))
+            item['calls'] += nc
+            item['self'] += tt
+            item['cumulative'] += ct
+    return ret
+
+
+def top(functions, n=20, sort='cumulative'):
+    '''
+    Returns text report of the `n` functions in `functions` (as returned by
+    aggregate()) with most time.
+    '''
+    lines = list()
+    lines.append(f'{"cumulative":>12} {"self":>12} {"calls":>10} function')
+    for name, item in sorted(functions.items(), key=lambda x: -x[1][sort])[:n]:
+        lines.append(f'{item["cumulative"]:12.6f} {item["self"]:12.6f} {item["calls"]:10} {name}')
+    return '\n'.join(lines)
+
+
+def diff(functions_a, functions_b, n=20, sort='cumulative'):
+    '''
+    Returns text report of the `n` functions whose time increased most, and
+    the `n` functions whose time decreased most, between `functions_a` and
+    `functions_b` (as returned by aggregate()).
+    '''
+    empty = dict(calls=0, self=0, cumulative=0)
+    deltas = list()
+    for name in set(functions_a) | set(functions_b):
+        a = functions_a.get(name, empty)
+        b = functions_b.get(name, empty)
+        deltas.append((b[sort] - a[sort], name, a, b))
+    deltas.sort(key=lambda x: x[0])
+    lines = list()
+    def show(title, items):
+        lines.append(f'{title} ({sort} time):')
+        lines.append(f'    {"delta":>12} {"a":>12} {"b":>12} {"calls a":>10} {"calls b":>10} function')
+        for delta, name, a, b in items:
+            lines.append(f'    {delta:+12.6f} {a[sort]:12.6f} {b[sort]:12.6f} {a["calls"]:10} {b["calls"]:10} {name}')
+    show('Slower', [x for x in reversed(deltas) if x[0] > 0][:n])
+    show('Faster', [x for x in deltas if x[0] < 0][:n])
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    n = 20
+    sort = 'cumulative'
+    tests = list()
+    positional = list()
+    args = iter(sys.argv[1:])
+    while 1:
+        try:
+            arg = next(args)
+        except StopIteration:
+            break
+        if arg == '-h' or arg == '--help':
+            main.log(__doc__)
+            sys.exit()
+        elif arg == '--n':
+            n = int(next(args))
+        elif arg == '--sort':
+            sort = next(args)
+            assert sort in ('cumulative', 'self'), f'Unrecognised {sort=}'
+        elif arg == '--test':
+            tests.append(next(args))
+        else:
+            positional.append(arg)
+    assert positional, f'No command specified.'
+    command = positional[0]
+    positional = positional[1:]
+    if command == 'top':
+        paths = load(positional[0], positional[1] if len(positional) > 1 else None, tests)
+        print(top(aggregate(path for key in sorted(paths) for path in paths[key]), n, sort))
+    elif command == 'diff':
+        if positional[1].endswith('.json'):
+            toolname = positional[2] if len(positional) > 2 else None
+            a = positional[0], toolname
+            b = positional[1], toolname
+        else:
+            a = positional[0], positional[1]
+            b = positional[0], positional[2]
+        paths_a = load(*a, tests)
+        paths_b = load(*b, tests)
+        keys = set(paths_a) & set(paths_b)
+        if not keys:
+            raise Exception(f'No profiles of the same tests in {a} and {b}.')
+        print(f'a: {a}')
+        print(f'b: {b}')
+        print(f'Using profiles of {len(keys)} tests.')
+        print(diff(
+                aggregate(path for key in sorted(keys) for path in paths_a[key]),
+                aggregate(path for key in sorted(keys) for path in paths_b[key]),
+                n,
+                sort,
+                ))
+    else:
+        raise Exception(f'Unrecognised {command=}')
@@ -0,0 +1,43 @@
+'''
+Statistics helpers shared by main.py, compare.py and history.py.
+
+These are in their own module so that compare.py and history.py do not need
+to import main.py just for these, which would load main.py a second time when
+it is run as a script.
+'''
+
+import math
+
+
+def percentile(values, p):
+    '''
+    Returns percentile `p` (0..100) of sorted list `values`, using linear
+    interpolation between closest ranks.
+    '''
+    assert values
+    k = (len(values) - 1) * p / 100
+    f = math.floor(k)
+    c = math.ceil(k)
+    if f == c:
+        return values[f]
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+# Two-tailed 95% critical values of Student's t distribution, indexed by
+# degrees of freedom. We use 1.96 for larger degrees of freedom.
+#
+_t95 = [
+        None,
+        12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+        ]
+
+def t95_critical(df):
+    '''
+    Returns two-tailed 95% critical value of Student's t distribution with
+    `df` degrees of freedom.
+    '''
+    if df < len(_t95):
+        return _t95[df]
+    return 1.96